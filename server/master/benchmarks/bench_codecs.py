@@ -0,0 +1,66 @@
+"""
+Benchmark: AACR payload codecs.
+
+Compares encode and decode time and the bytes on the wire of each installed codec
+(see comms.codecs) for typical AACR messages. Only pure serialization is timed,
+no sockets or database are involved.
+
+Usage (from server/master):
+    python -m benchmarks.bench_codecs [iterations]
+"""
+import sys
+import timeit
+
+from comms.codecs import CODECS, CODEC_NAMES, decode, encode
+
+
+def scooter(index):
+    "A scooter as returned by the AACR handlers."
+    return {
+        "scooter_id": index,
+        "make": "Xiaomi",
+        "longitude": 144.9631 + index / 10000,
+        "latitude": -37.8136 - index / 10000,
+        "remaining_power": 87.5,
+        "cost_per_time": 10.0,
+        "status": "available",
+        "colour": "black",
+        "address": f"{index} Collins Street, Melbourne VIC 3000",
+    }
+
+
+MESSAGES = {
+    "request GET /scooter": {"method": "GET", "uri": "/scooter", "params": {"scooter_id": 42}},
+    "response /scooter": scooter(42),
+    "response /customer/dashboard (50)": {"scooters": [scooter(i) for i in range(50)], "balance": 25.0},
+    "response /customer/dashboard (1000)": {"scooters": [scooter(i) for i in range(1000)], "balance": 25.0},
+    "telemetry batch (100 readings)": {
+        "method": "BATCH",
+        "requests": [
+            {"method": "UPDATE", "uri": "/scooter/location",
+             "params": {"scooter_id": i, "longitude": 144.96 + i / 1000, "latitude": -37.81, "power": 55.5}}
+            for i in range(100)
+        ]
+    },
+}
+
+
+def main(iterations=2000):
+    codecs = [(name, codec) for name, codec in CODEC_NAMES.items() if codec in CODECS]
+    missing = [name for name, codec in CODEC_NAMES.items() if codec not in CODECS]
+    if missing:
+        print(f"Not installed, skipped: {', '.join(missing)}")
+
+    for label, message in MESSAGES.items():
+        # Large messages get fewer rounds so every case takes about the same time
+        rounds = max(10, iterations // max(1, len(encode(message)) // 1000))
+        print(label)
+        for name, codec in codecs:
+            payload = encode(message, codec)
+            encode_us = timeit.timeit(lambda: encode(message, codec), number=rounds) / rounds * 1e6
+            decode_us = timeit.timeit(lambda: decode(payload, codec), number=rounds) / rounds * 1e6
+            print(f"  {name:<8} {len(payload):>9} bytes   encode {encode_us:10.1f} us   decode {decode_us:10.1f} us")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,86 @@
+"""
+Benchmark: AACR handler latency with the in-process backend against the HTTP loopback backend.
+
+Starts the master Flask app on an in-memory database, serves it on a local port for the
+HTTP backend, and times the same AACR handlers through both backends.
+
+Usage (from server/master):
+    python -m benchmarks.bench_dispatch [iterations]
+"""
+import logging
+import statistics
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from comms import methods
+from comms.backend import HttpBackend, LocalBackend
+from database.database_manager import db
+from database.models import Scooter, ScooterStatus, User, UserType
+from web.app import create_master_app
+
+HOST = "127.0.0.1"
+
+
+def seed():
+    "Insert one customer and a small fleet of scooters."
+    db.session.add(User(username="bench", password="password", email="bench@example.com",
+                        first_name="Bench", last_name="Mark", role=UserType.CUSTOMER.value,
+                        phone_number="0400000000", balance=100.0))
+    for index in range(50):
+        db.session.add(Scooter(make="Bench", longitude=144.96 + index / 1000, latitude=-37.81,
+                               remaining_power=100.0, cost_per_time=10.0,
+                               status=ScooterStatus.AVAILABLE.value, colour="black"))
+    db.session.commit()
+
+
+def time_calls(call, iterations):
+    "Run call() iterations times and return the latencies in milliseconds."
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{name:<46} mean {statistics.mean(samples):8.3f} ms   p50 {statistics.median(samples):8.3f} ms"
+          f"   p95 {p95:8.3f} ms")
+
+
+def main(iterations=200):
+    # Keep the request log of the loopback server out of the results
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    app = create_master_app(testing=True)
+    http_server = make_server(HOST, 0, app, threaded=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    calls = {
+        "GET /customer/dashboard": lambda: methods.fetch_available_scooters(customer_id=1),
+        "GET /scooter": lambda: methods.fetch_scooters_by_id(scooter_id=1),
+        "UPDATE /booking/cancel (missing booking)": lambda: methods.cancel_booking(booking_id=999),
+    }
+    backends = {
+        "http": HttpBackend(base_url=f"http://{HOST}:{http_server.server_port}"),
+        "local": LocalBackend(),
+    }
+
+    with app.app_context():
+        seed()
+        for uri, call in calls.items():
+            for name, backend in backends.items():
+                methods.backend = backend
+                call()  # warm up
+                report(f"{uri} [{name}]", time_calls(call, iterations))
+
+    http_server.shutdown()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
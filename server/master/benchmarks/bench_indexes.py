@@ -0,0 +1,126 @@
+"""
+Benchmark: hot filter queries without and with the indexes declared on the models.
+
+Seeds an in-memory database with a large booking table (1M rows by default), times the
+filter queries of the service classes with every secondary index dropped, then creates
+the indexes again and repeats the timings.
+
+Usage (from server/master):
+    python -m benchmarks.bench_indexes [bookings] [iterations]
+"""
+import datetime
+import random
+import statistics
+import sys
+import time
+
+from database.database_manager import db
+from database.models import (Booking, BookingState, Repairs, RepairStatus, Scooter, ScooterStatus,
+                             Transaction, User, UserType)
+from web.database.bookings import BookingAPI
+from web.database.scooters import ScooterAPI
+from web.app import create_master_app
+
+CHUNK = 20_000
+USERS = 20_000
+SCOOTERS = 5_000
+STATUSES = [state.value for state in BookingState]
+
+
+def insert(model, rows):
+    "Bulk insert rows, bypassing the ORM unit of work."
+    for start in range(0, len(rows), CHUNK):
+        db.session.execute(db.insert(model), rows[start:start + CHUNK])
+    db.session.commit()
+
+
+def seed(bookings):
+    "Insert the users, scooters, repairs, transactions and bookings."
+    rng = random.Random(42)
+    roles = [UserType.CUSTOMER.value] * 98 + [UserType.ENGINEER.value, UserType.ADMIN.value]
+    insert(User, [{"username": f"user{i}", "password": "-", "email": f"user{i}@example.com", "first_name": "Bench",
+                   "last_name": "Mark", "role": rng.choice(roles), "phone_number": None, "balance": 100.0}
+                  for i in range(USERS)])
+    insert(Scooter, [{"make": "Bench", "longitude": 144.9 + rng.random() / 10, "latitude": -37.8 - rng.random() / 10,
+                      "remaining_power": 100.0, "cost_per_time": 10.0,
+                      "status": rng.choice([status.value for status in ScooterStatus]), "colour": "black"}
+                     for _ in range(SCOOTERS)])
+    insert(Repairs, [{"scooter_id": rng.randint(1, SCOOTERS), "report": "Flat tyre",
+                      "status": rng.choice([status.value for status in RepairStatus])}
+                     for _ in range(bookings // 20)])
+    insert(Transaction, [{"user_id": rng.randint(1, USERS), "amount": 10.0} for _ in range(bookings // 5)])
+
+    start = datetime.datetime(2023, 1, 1, 9)
+    for offset in range(0, bookings, CHUNK):
+        rows = []
+        for _ in range(min(CHUNK, bookings - offset)):
+            begin = start + datetime.timedelta(hours=rng.randint(0, 24 * 365))
+            rows.append({"user_id": rng.randint(1, USERS), "scooter_id": rng.randint(1, SCOOTERS),
+                         "date": begin.replace(hour=0), "start_time": begin,
+                         "end_time": begin + datetime.timedelta(hours=1),
+                         # Most bookings of a busy system are in the past
+                         "status": rng.choices(STATUSES, weights=(1, 10, 89))[0], "event_id": "bench"})
+        db.session.execute(db.insert(Booking), rows)
+    db.session.commit()
+
+
+def set_indexes(create):
+    "Create or drop every secondary index declared on the models."
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if create:
+                    index.create(connection, checkfirst=True)
+                else:
+                    index.drop(connection, checkfirst=True)
+    db.session.remove()
+
+
+def time_calls(call, iterations):
+    "Run call() iterations times and return the latencies in milliseconds."
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main(bookings=1_000_000, iterations=20):
+    app = create_master_app(testing=True)
+    rng = random.Random(7)
+    queries = {
+        "BookingAPI.get_by_user_and_scooter": lambda: BookingAPI.get_by_user_and_scooter(
+            rng.randint(1, USERS), rng.randint(1, SCOOTERS)),
+        "BookingAPI.get_by_user": lambda: BookingAPI.get_by_user(rng.randint(1, USERS)),
+        "Booking status=active (count)": lambda: Booking.query.filter_by(status=BookingState.ACTIVE.value).count(),
+        "ScooterAPI.get_by_status": lambda: ScooterAPI.get_by_status(ScooterStatus.AVAILABLE.value),
+        "Repairs status=pending": lambda: Repairs.query.filter_by(status=RepairStatus.PENDING.value).all(),
+        "Transaction user_id": lambda: Transaction.query.filter_by(user_id=rng.randint(1, USERS)).all(),
+        "User role=engineer": lambda: User.query.filter_by(role=UserType.ENGINEER.value).all(),
+    }
+
+    with app.app_context():
+        start = time.perf_counter()
+        seed(bookings)
+        print(f"Seeded {bookings} bookings in {time.perf_counter() - start:.1f} s\n")
+
+        results = {}
+        for label, create in (("before", False), ("after", True)):
+            start = time.perf_counter()
+            set_indexes(create)
+            if create:
+                print(f"Created the indexes in {time.perf_counter() - start:.1f} s\n")
+            for name, call in queries.items():
+                call()  # warm up
+                results.setdefault(name, {})[label] = statistics.median(time_calls(call, iterations))
+
+        print(f"{'query':<38} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>9}")
+        for name, timings in results.items():
+            print(f"{name:<38} {timings['before']:12.3f} {timings['after']:12.3f} "
+                  f"{timings['before'] / max(timings['after'], 1e-9):8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 20)
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+from comms.batch import BATCH_METHOD, execute_batch
+from comms.codecs import CODEC_JSON, CODECS, UNSUPPORTED_RESPONSE, decode, encode
+from comms.framing import MESSAGE_LIMIT, V1, V2, FrameError, encode_frame, read_message_async
+from comms.methods import routes
+from comms.metrics import SERVER_APP_KEY, metrics
+from comms.server import HOST, PORT, REQUEST_TIMEOUT, KEEPALIVE_TIMEOUT, WORKERS, log_request
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncServer:
+    """
+    Handles a server using the protocol AACR (Adapted Application Communication and Routing)
+    on an asyncio event loop.
+
+    Serves the same functions as comms.server.Server, but connections do not hold an
+    OS thread each: idle and keep-alive connections only cost a coroutine. Blocking
+    handlers run on a thread pool, coroutine handlers run on the event loop.
+    """
+
+    def __init__(self, host: str = HOST, port: int = PORT, buffer_size: int = MESSAGE_LIMIT,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT, workers: int = WORKERS) -> None:
+        """
+        Create the server using the given host and port
+
+        Args:
+            host (str, optional): The host address, probably localhost. Defaults to HOST.
+            port (int, optional): The port to make communications. Defaults to PORT.
+            buffer_size (int, optional): The largest request accepted, in bytes. Defaults to MESSAGE_LIMIT.
+            keepalive_timeout (float, optional): Seconds a v2 connection may stay idle. Defaults to KEEPALIVE_TIMEOUT.
+            workers (int, optional): Threads running blocking handlers. Defaults to WORKERS.
+        """
+        self.host = host
+        self.port = port
+        self.buffer_size = buffer_size
+        self.keepalive_timeout = keepalive_timeout
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aacr")
+        self.app = None
+        self.server = None
+        self.open_connections = 0
+        self.requests_in_flight = 0
+        self.accepted = 0
+        # Blocking requests waiting for an executor thread or running on one, updated from both
+        self.stats_lock = threading.Lock()
+        self.queued = 0
+        self.active_workers = 0
+
+    def start_server(self, app: Flask) -> None:
+        """
+        Runs the server until the process exits. Same entry point as Server.start_server.
+        """
+        asyncio.run(self.serve(app))
+
+    async def serve(self, app: Flask) -> None:
+        """
+        Listens for connections and handles each one in its own coroutine.
+        """
+        self.app = app
+        # Reported by the metrics of the app
+        app.extensions[SERVER_APP_KEY] = self
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port, limit=self.buffer_size)
+        logger.info("Async server started on %s:%s", self.host, self.port)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Handles a client connection, see Server.handle_client.
+        """
+        self.open_connections += 1
+        self.accepted += 1
+        # The first request must arrive promptly, later ones may wait for the keep-alive timeout
+        idle_timeout = REQUEST_TIMEOUT
+        try:
+            while True:
+                try:
+                    version, codec, data = await read_message_async(reader, self.buffer_size, idle_timeout,
+                                                                REQUEST_TIMEOUT)
+                except FrameError as e:
+                    logger.info("Invalid request: %s", e, extra={"sample": True})
+                    await self.send_response(writer, {"errorCode": "400", "error": str(e)}, e.version)
+                    break
+                except EOFError:
+                    break
+
+                if version is None:
+                    break
+
+                if codec not in CODECS:
+                    await self.send_response(writer, UNSUPPORTED_RESPONSE, version)
+                else:
+                    await self.serve_request(writer, data, version, codec)
+
+                if version == V1:
+                    break
+                idle_timeout = self.keepalive_timeout
+        except (ConnectionError, OSError):
+            # The client went away while we were answering
+            pass
+        finally:
+            self.open_connections -= 1
+            writer.close()
+
+    async def serve_request(self, writer: asyncio.StreamWriter, data: bytes, version: int,
+                            codec: int = CODEC_JSON) -> None:
+        """
+        Runs a request, sends its response and records it in the metrics, see Server.serve_request.
+        """
+        start = time.perf_counter()
+        try:
+            # Parses the data with the codec of the request
+            data_json = decode(data, codec)
+        except ValueError as e:
+            data_json, response = None, {"errorCode": "500", "error": str(e)}
+        else:
+            response = await self.dispatch(data_json)
+        sent = await self.send_response(writer, response, version, codec)
+        elapsed = time.perf_counter() - start
+        metrics.record(data_json, elapsed, response, len(data), sent)
+        log_request(data_json, elapsed, response)
+
+    async def dispatch(self, data_json: dict) -> dict:
+        """
+        Runs the function registered for a request.
+
+        Args:
+            data_json (dict): the decoded request.
+
+        Returns:
+            dict: the response to send to the client.
+        """
+        self.requests_in_flight += 1
+        try:
+            # Batches touch the database request after request, run them off the event loop
+            if isinstance(data_json, dict) and data_json.get("method") == BATCH_METHOD:
+                return await self.run_blocking(execute_batch, data_json)
+
+            route = None
+            if isinstance(data_json, dict) and data_json.get("method") in routes.methods:
+                route = routes.resolve(data_json["method"], data_json.get("uri", "/"))
+            if route is None:
+                # Nothing to run, only the error to build
+                return routes.run(data_json)
+            if not route.is_coroutine:
+                return await self.run_blocking(routes.run, data_json)
+
+            with self.app.app_context():
+                return await route.call_async(data_json.get("params", {}))
+        except TypeError as e:
+            # This means the method called had errors in the parameters passed
+            return {"errorCode": "400", "error": str(e)}
+        except Exception as e:
+            # Any other error
+            return {"errorCode": "500", "error": str(e)}
+        finally:
+            self.requests_in_flight -= 1
+
+    async def run_blocking(self, func, *args):
+        """
+        Runs blocking code on the executor and waits for its result.
+        """
+        with self.stats_lock:
+            self.queued += 1
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.call, func, *args)
+
+    def call(self, func, *args):
+        """
+        Runs blocking code inside the app context, on an executor thread.
+        """
+        with self.stats_lock:
+            self.queued -= 1
+            self.active_workers += 1
+        try:
+            with self.app.app_context():
+                return func(*args)
+        finally:
+            with self.stats_lock:
+                self.active_workers -= 1
+
+    async def send_response(self, writer: asyncio.StreamWriter, response: dict, version: int = V1,
+                            codec: int = CODEC_JSON) -> int:
+        """
+        Sends a response to the client, in the AACR version and codec of its request.
+
+        Returns:
+            int: the size of the response payload.
+        """
+        payload = encode(response, codec)
+        writer.write(encode_frame(payload, codec) if version == V2 else payload)
+        await writer.drain()
+        return len(payload)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: the load of the server, with the same keys as Server.stats where they
+            apply: blocking requests waiting for an executor thread, busy executor threads,
+            open connections, requests being handled, and connections accepted since start.
+            Connections are never turned away, they wait on the event loop instead.
+        """
+        with self.stats_lock:
+            return {
+                "queue_depth": self.queued,
+                "active_workers": self.active_workers,
+                "workers": self.workers,
+                "open_connections": self.open_connections,
+                "requests_in_flight": self.requests_in_flight,
+                "accepted": self.accepted,
+                "rejected": 0,
+            }
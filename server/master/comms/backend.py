@@ -0,0 +1,170 @@
+"""
+AACR Handler Backends
+
+The AACR handlers in comms.methods reach the database through a backend object.
+LocalBackend calls the service classes of the web.database blueprints directly inside
+the current app context, while HttpBackend goes through the REST API of a master that
+runs in a separate process (split deployments).
+
+The backend is chosen with the AACR_BACKEND environment variable ("local" or "http").
+"""
+import os
+import requests
+from dotenv import load_dotenv
+
+from database.queries import NEAR_LIMIT
+from web.database.bookings import BookingAPI
+from web.database.repairs import RepairAPI
+from web.database.scooters import ScooterAPI
+from web.database.transactions import TransactionAPI
+from web.database.users import UserAPI
+
+# Load environment variables from the .env file
+load_dotenv()
+
+API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:5000")
+BACKEND = os.getenv("AACR_BACKEND", "local")
+HTTP_TIMEOUT = 5
+
+
+class LocalBackend:
+    """
+    Serves the AACR handlers from the same process, with no HTTP hop in between.
+    Must be used inside a Flask app context.
+    """
+
+    def get_user(self, user_id: int):
+        return UserAPI.get_by_id(user_id)
+
+    def get_user_by_email(self, email: str):
+        return UserAPI.get_by_email(email)
+
+    def create_user(self, user: dict):
+        return UserAPI.create(user)
+
+    def update_user(self, user_id: int, user: dict):
+        return UserAPI.update(user_id, user)
+
+    def top_up(self, user_id: int, amount: float, idempotency_key: str = None):
+        return UserAPI.top_up(user_id, amount, idempotency_key)
+
+    def get_dashboard(self, user_id: int, latitude: float = None, longitude: float = None, radius: float = None):
+        return UserAPI.dashboard(user_id, latitude, longitude, radius)
+
+    def get_scooter(self, scooter_id: int):
+        return ScooterAPI.get(scooter_id)
+
+    def get_scooters_by_status(self, status: str):
+        return ScooterAPI.get_by_status(status)
+
+    def get_scooters_near(self, latitude: float, longitude: float, radius: float = None, k: int = NEAR_LIMIT):
+        return ScooterAPI.near(latitude, longitude, radius, k)
+
+    def update_scooter_status(self, scooter_id: int, status: str):
+        return ScooterAPI.update_status(scooter_id, status)
+
+    def create_booking(self, booking: dict):
+        return BookingAPI.create(booking)
+
+    def get_user_bookings(self, user_id: int):
+        return BookingAPI.get_by_user(user_id)
+
+    def update_booking_status(self, booking_id: int, status: str):
+        return BookingAPI.update_status(booking_id, status)
+
+    def create_repair(self, repair: dict):
+        return RepairAPI.create(repair)
+
+    def create_transaction(self, transaction: dict):
+        return TransactionAPI.create(transaction)
+
+
+class HttpBackend:
+    """
+    Serves the AACR handlers through the REST API of the master Flask application.
+    Missing records (404) are returned as None, any other error status is raised.
+    """
+
+    def __init__(self, base_url: str = API_BASE_URL, timeout: float = HTTP_TIMEOUT) -> None:
+        self.base_url = base_url
+        self.timeout = timeout
+        # Reuse the TCP connection between calls
+        self.session = requests.Session()
+
+    def _request(self, method: str, endpoint: str, **kwargs):
+        response = self.session.request(method, self.base_url + endpoint, timeout=self.timeout, **kwargs)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def get_user(self, user_id: int):
+        return self._request("GET", f"/user/id/{user_id}")
+
+    def get_user_by_email(self, email: str):
+        return self._request("GET", f"/user/email/{email}")
+
+    def create_user(self, user: dict):
+        return self._request("POST", "/user", json=user)
+
+    def update_user(self, user_id: int, user: dict):
+        return self._request("PUT", f"/user/{user_id}", json=user)
+
+    def get_dashboard(self, user_id: int, latitude: float = None, longitude: float = None, radius: float = None):
+        params = {"latitude": latitude, "longitude": longitude, "radius": radius}
+        return self._request("GET", f"/user/{user_id}/dashboard", params=params)
+
+    def top_up(self, user_id: int, amount: float, idempotency_key: str = None):
+        response = self.session.post(f"{self.base_url}/user/{user_id}/top-up", timeout=self.timeout,
+                                     json={"amount": amount, "idempotency_key": idempotency_key})
+        if response.status_code in (400, 404):
+            # Same errors as the local backend
+            raise ValueError(response.json()["message"])
+        response.raise_for_status()
+        return response.json()
+
+    def get_scooter(self, scooter_id: int):
+        return self._request("GET", f"/scooter/id/{scooter_id}")
+
+    def get_scooters_by_status(self, status: str):
+        return self._request("GET", f"/scooters/status/{status}")
+
+    def get_scooters_near(self, latitude: float, longitude: float, radius: float = None, k: int = NEAR_LIMIT):
+        # requests leaves out the params set to None
+        params = {"latitude": latitude, "longitude": longitude, "radius": radius, "k": k}
+        return self._request("GET", "/scooters/near", params=params)
+
+    def update_scooter_status(self, scooter_id: int, status: str):
+        return self._request("PUT", f"/scooter/status/{scooter_id}", json={"status": status})
+
+    def create_booking(self, booking: dict):
+        return self._request("POST", "/bookings", json=booking)
+
+    def get_user_bookings(self, user_id: int):
+        return self._request("GET", f"/bookings/user/{user_id}")
+
+    def update_booking_status(self, booking_id: int, status: str):
+        return self._request("PUT", f"/booking/status/{booking_id}", json={"status": status})
+
+    def create_repair(self, repair: dict):
+        return self._request("POST", "/repair", json=repair)
+
+    def create_transaction(self, transaction: dict):
+        return self._request("POST", "/transaction", json=transaction)
+
+
+def create_backend(name: str = BACKEND):
+    """
+    Create the backend used by the AACR handlers.
+
+    Args:
+        name (str, optional): "local" or "http". Defaults to the AACR_BACKEND environment variable.
+
+    Returns:
+        LocalBackend | HttpBackend: the backend instance.
+    """
+    if name == "http":
+        return HttpBackend()
+    if name == "local":
+        return LocalBackend()
+    raise ValueError(f"Unknown AACR backend '{name}'")
@@ -0,0 +1,72 @@
+"""
+AACR Batch Requests
+
+A batch carries several AACR requests in one message, so a client can run a
+multi-step flow in a single round trip:
+
+    {
+        "method": "BATCH",
+        "transaction": true,
+        "requests": [
+            {"method": "UPDATE", "uri": "/booking/cancel", "params": {"booking_id": 1}},
+            {"method": "POST", "uri": "/scooter/damaged", "params": {"scooter_id": 1, "report": "..."}}
+        ]
+    }
+
+The requests run in order and the response holds their results in the same order:
+{"results": [...]}. Without "transaction" every request runs on its own, whatever
+the outcome of the others. With "transaction" the requests run in one database
+transaction: the batch stops at the first request that fails and every change
+made by the batch is rolled back. Transactions only cover handlers that reach the
+database in-process, see comms.backend.
+"""
+from comms.methods import routes
+from comms.routes import is_error
+from database.database_manager import single_transaction
+
+BATCH_METHOD = "BATCH"
+BATCH_LIMIT = 50  # Requests allowed in one batch
+
+
+class BatchAborted(Exception):
+    """
+    Raised inside a transactional batch to roll it back after a request failed.
+    """
+
+
+def execute_batch(batch: dict) -> dict:
+    """
+    Runs the requests of a batch in order. Must be called inside a Flask app context.
+
+    Args:
+        batch (dict): the BATCH message.
+
+    Returns:
+        dict: {"results": [...]} with one result per request. A transactional batch that
+        was rolled back also holds the error of the request that failed, and only the
+        results up to that request.
+    """
+    requests = batch.get("requests")
+    if not isinstance(requests, list) or not requests:
+        return {"errorCode": "400", "error": "A batch needs a non empty list of requests"}
+    if len(requests) > BATCH_LIMIT:
+        return {"errorCode": "400", "error": f"A batch accepts at most {BATCH_LIMIT} requests"}
+
+    if not batch.get("transaction", False):
+        return {"results": [routes.run(message) for message in requests]}
+
+    results = []
+    try:
+        with single_transaction():
+            for message in requests:
+                response = routes.run(message)
+                results.append(response)
+                if is_error(response):
+                    raise BatchAborted(response["error"])
+    except BatchAborted as e:
+        return {
+            "errorCode": results[-1].get("errorCode", "400"),
+            "error": f"Batch rolled back at request {len(results)}: {e}",
+            "results": results
+        }
+    return {"results": results}
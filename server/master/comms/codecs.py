@@ -0,0 +1,97 @@
+"""
+AACR Payload Codecs
+
+The codec byte of an AACR v2 frame says how its payload is encoded. JSON is always
+available and is the default. MessagePack and CBOR are compact binary encodings,
+useful for high-frequency or large messages such as the dashboard scooter list;
+they are available when the msgpack or cbor2 package is installed.
+
+The master answers a request with the codec of the request. A request with a codec
+the master cannot decode is answered with a 415 error encoded as JSON, so the client
+can fall back to JSON. AACR v1 messages are always JSON.
+
+The master and the public gateway run from their own directories and share no
+package, so the codec table is kept in both: keep this file the same as
+server/public/common/codecs.py.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+CODEC_CBOR = 2
+
+CODEC_NAMES = {
+    "json": CODEC_JSON,
+    "msgpack": CODEC_MSGPACK,
+    "cbor": CODEC_CBOR,
+}
+CODEC_PACKAGES = {
+    CODEC_MSGPACK: "msgpack",
+    CODEC_CBOR: "cbor2",
+}
+
+# codec byte -> (encode, decode), only for the codecs installed here
+CODECS = {
+    CODEC_JSON: (lambda message: json.dumps(message).encode(), lambda payload: json.loads(payload.decode())),
+}
+if msgpack is not None:
+    CODECS[CODEC_MSGPACK] = (lambda message: msgpack.packb(message, use_bin_type=True),
+                             lambda payload: msgpack.unpackb(payload, raw=False))
+if cbor2 is not None:
+    CODECS[CODEC_CBOR] = (cbor2.dumps, cbor2.loads)
+
+UNSUPPORTED_RESPONSE = {"errorCode": "415", "error": "Unsupported codec, use JSON"}
+
+
+def codec_by_name(name: str) -> int:
+    """
+    Finds the codec byte for a codec name.
+
+    Args:
+        name (str): "json", "msgpack" or "cbor".
+
+    Raises:
+        ValueError: If the codec is unknown or its package is not installed.
+
+    Returns:
+        int: the codec byte.
+    """
+    if name not in CODEC_NAMES:
+        raise ValueError(f"Unknown AACR codec '{name}', expected one of {list(CODEC_NAMES)}")
+    codec = CODEC_NAMES[name]
+    if codec not in CODECS:
+        raise ValueError(f"The AACR codec '{name}' needs the {CODEC_PACKAGES[codec]} package")
+    return codec
+
+
+def encode(message, codec: int = CODEC_JSON) -> bytes:
+    """
+    Encodes a message with the given codec.
+    """
+    return CODECS[codec][0](message)
+
+
+def decode(payload: bytes, codec: int = CODEC_JSON):
+    """
+    Decodes a payload encoded with the given codec.
+
+    Raises:
+        ValueError: If the payload is not valid for the codec.
+    """
+    try:
+        return CODECS[codec][1](payload)
+    except ValueError:
+        raise
+    except Exception as e:
+        # The binary codecs raise their own exception types
+        raise ValueError(str(e))
@@ -0,0 +1,315 @@
+"""
+AACR Wire Format
+
+Two versions of the AACR wire format are understood by the master:
+
+v1: the client sends one JSON document and waits for the server to close the
+    connection after writing the JSON response. One request per connection.
+
+v2: every message is a frame made of a 6 byte header followed by the payload.
+    The header holds a marker byte (0xA2), a codec byte (see comms.codecs) and
+    the payload length as a 4 byte big-endian unsigned integer. The connection stays
+    open so a client can send many requests over it, one frame at a time.
+
+A v1 request always starts with "{", so the first byte of a request tells the
+server which version the client speaks.
+"""
+import asyncio
+import re
+import socket
+import struct
+import time
+
+from comms.codecs import CODEC_JSON
+
+FRAME_MARKER = 0xA2
+HEADER = struct.Struct(">BBI")
+MESSAGE_LIMIT = 30_000_000  # 30 MB
+CHUNK_SIZE = 65536
+
+V1 = 1
+V2 = 2
+
+# The bytes that matter when looking for the end of a JSON document, outside and inside strings
+JSON_STRUCTURE = re.compile(rb'[\[\]{}"]')
+JSON_STRING = re.compile(rb'["\\]')
+
+
+class FrameError(Exception):
+    """
+    Raised when the peer sends bytes that are not a valid AACR message.
+
+    Attributes:
+        version (int): the AACR version to use when reporting the error to the peer.
+    """
+
+    def __init__(self, message: str, version: int = V1) -> None:
+        super().__init__(message)
+        self.version = version
+
+
+class JsonScanner:
+    """
+    Finds the end of a JSON object or array received in chunks, by keeping the nesting
+    depth and whether the scan is inside a string between chunks. Every byte is scanned
+    once, however many chunks the document arrives in. The document is not validated,
+    that is left to the decoder.
+    """
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False  # The previous chunk ended on a backslash inside a string
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Scans the next chunk of the document.
+
+        Returns:
+            bool: whether the document is complete.
+        """
+        position = 0
+        if self.escaped and chunk:
+            self.escaped = False
+            position = 1
+        while True:
+            if self.in_string:
+                match = JSON_STRING.search(chunk, position)
+                if match is None:
+                    return False
+                if match.group() == b"\\":
+                    if match.end() == len(chunk):
+                        self.escaped = True
+                        return False
+                    # Skip the escaped character, it may be a quote
+                    position = match.end() + 1
+                    continue
+                self.in_string = False
+            else:
+                match = JSON_STRUCTURE.search(chunk, position)
+                if match is None:
+                    return False
+                char = match.group()
+                if char == b'"':
+                    self.in_string = True
+                elif char in (b"{", b"["):
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth <= 0:
+                        return True
+            position = match.end()
+
+
+def encode_frame(payload: bytes, codec: int = CODEC_JSON) -> bytes:
+    """
+    Builds a v2 frame around the given payload.
+
+    Args:
+        payload (bytes): the encoded message.
+        codec (int, optional): the codec the payload is encoded with. Defaults to CODEC_JSON.
+
+    Returns:
+        bytes: the header followed by the payload.
+    """
+    return HEADER.pack(FRAME_MARKER, codec, len(payload)) + payload
+
+
+def recv(client_socket: socket.socket, size: int, deadline: float = None) -> bytes:
+    """
+    Receives up to size bytes from the socket.
+
+    Args:
+        deadline (float, optional): time.monotonic() by which the bytes must arrive,
+            else the timeout of the socket applies to each call. Defaults to None.
+
+    Raises:
+        socket.timeout: If nothing arrives in time.
+    """
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("Deadline passed")
+        client_socket.settimeout(remaining)
+    return client_socket.recv(size)
+
+
+def recv_exact(client_socket: socket.socket, size: int, deadline: float = None) -> bytes:
+    """
+    Reads exactly size bytes from the socket.
+
+    Raises:
+        EOFError: If the connection is closed before all the bytes arrive.
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = recv(client_socket, min(remaining, CHUNK_SIZE), deadline)
+        if not chunk:
+            raise EOFError("Connection closed in the middle of a message")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(client_socket: socket.socket, limit: int = MESSAGE_LIMIT, first: bytes = b"",
+               deadline: float = None):
+    """
+    Reads one v2 frame.
+
+    Args:
+        client_socket (socket.socket): socket connection to the peer.
+        limit (int, optional): the largest payload accepted. Defaults to MESSAGE_LIMIT.
+        first (bytes, optional): header bytes that were already read from the socket.
+        deadline (float, optional): time.monotonic() by which the whole frame must arrive.
+            Defaults to None, only the timeout of the socket.
+
+    Raises:
+        FrameError: If the header is invalid, the payload is larger than the limit or
+            the frame does not arrive before the socket times out.
+        EOFError: If the connection is closed in the middle of the frame.
+
+    Returns:
+        (int, bytes): the codec and the payload of the frame.
+    """
+    try:
+        header = first + recv_exact(client_socket, HEADER.size - len(first), deadline)
+        marker, codec, length = HEADER.unpack(header)
+        if marker != FRAME_MARKER:
+            raise FrameError("Invalid frame marker", V2)
+        if length > limit:
+            raise FrameError(f"Frame of {length} bytes exceeds the limit of {limit} bytes", V2)
+        return codec, recv_exact(client_socket, length, deadline)
+    except socket.timeout:
+        raise FrameError("Timed out waiting for the rest of the frame", V2)
+
+
+def read_v1(client_socket: socket.socket, first: bytes, limit: int = MESSAGE_LIMIT, deadline: float = None) -> bytes:
+    """
+    Reads a v1 request: bytes are read until they form a complete JSON document,
+    since a v1 client keeps its side of the connection open while it waits.
+
+    Raises:
+        FrameError: If the request is larger than the limit.
+    """
+    scanner = JsonScanner()
+    chunks = [first]
+    size = len(first)
+    complete = scanner.feed(first)
+    while not complete:
+        if size > limit:
+            raise FrameError(f"Request exceeds the limit of {limit} bytes")
+        try:
+            chunk = recv(client_socket, CHUNK_SIZE, deadline)
+        except socket.timeout:
+            chunk = b""
+        if not chunk:
+            # The client stopped sending, let the caller report the parse error
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        complete = scanner.feed(chunk)
+    return b"".join(chunks)
+
+
+def read_message(client_socket: socket.socket, limit: int = MESSAGE_LIMIT, deadline: float = None):
+    """
+    Reads the next request from a client, whatever version of AACR it speaks.
+
+    Args:
+        client_socket (socket.socket): socket connection to the client.
+        limit (int, optional): the largest request accepted. Defaults to MESSAGE_LIMIT.
+        deadline (float, optional): time.monotonic() by which the whole request must arrive.
+            Defaults to None, only the timeout of the socket.
+
+    Returns:
+        (int, int, bytes): the version, codec and payload of the request, or
+        (None, None, b"") when the client closed the connection or went idle.
+    """
+    try:
+        first = recv(client_socket, 1, deadline)
+    except socket.timeout:
+        return None, None, b""
+    if not first:
+        return None, None, b""
+
+    if first[0] == FRAME_MARKER:
+        codec, payload = read_frame(client_socket, limit, first, deadline)
+        return V2, codec, payload
+
+    return V1, CODEC_JSON, read_v1(client_socket, first, limit, deadline)
+
+
+def write_message(client_socket: socket.socket, version: int, payload: bytes, codec: int = CODEC_JSON) -> None:
+    """
+    Writes a response using the same version of AACR as the request.
+    """
+    if version == V2:
+        client_socket.sendall(encode_frame(payload, codec))
+    else:
+        client_socket.sendall(payload)
+
+
+async def read_message_async(reader: asyncio.StreamReader, limit: int = MESSAGE_LIMIT,
+                             idle_timeout: float = None, request_timeout: float = None):
+    """
+    Reads the next request from an asyncio stream, whatever version of AACR the client speaks.
+
+    Args:
+        reader (asyncio.StreamReader): the stream of the client connection.
+        limit (int, optional): the largest request accepted. Defaults to MESSAGE_LIMIT.
+        idle_timeout (float, optional): seconds to wait for the first byte of the request.
+        request_timeout (float, optional): seconds to wait for the rest of the request, as a whole.
+
+    Raises:
+        FrameError: If the request is invalid, too large or arrives too slowly.
+        EOFError: If the connection is closed in the middle of a frame.
+
+    Returns:
+        (int, int, bytes): the version, codec and payload of the request, or
+        (None, None, b"") when the client closed the connection or went idle.
+    """
+    try:
+        first = await asyncio.wait_for(reader.read(1), idle_timeout)
+    except asyncio.TimeoutError:
+        return None, None, b""
+    if not first:
+        return None, None, b""
+
+    loop = asyncio.get_running_loop()
+    deadline = None if request_timeout is None else loop.time() + request_timeout
+
+    def remaining():
+        # A client sending a byte at a time gets no more time than one sending it all at once
+        return None if deadline is None else max(deadline - loop.time(), 0)
+
+    if first[0] == FRAME_MARKER:
+        try:
+            header = first + await asyncio.wait_for(reader.readexactly(HEADER.size - 1), remaining())
+            _, codec, length = HEADER.unpack(header)
+            if length > limit:
+                raise FrameError(f"Frame of {length} bytes exceeds the limit of {limit} bytes", V2)
+            return V2, codec, await asyncio.wait_for(reader.readexactly(length), remaining())
+        except asyncio.IncompleteReadError:
+            raise EOFError("Connection closed in the middle of a message")
+        except asyncio.TimeoutError:
+            raise FrameError("Timed out waiting for the rest of the frame", V2)
+
+    scanner = JsonScanner()
+    chunks = [first]
+    size = len(first)
+    complete = scanner.feed(first)
+    while not complete:
+        if size > limit:
+            raise FrameError(f"Request exceeds the limit of {limit} bytes")
+        try:
+            chunk = await asyncio.wait_for(reader.read(CHUNK_SIZE), remaining())
+        except asyncio.TimeoutError:
+            chunk = b""
+        if not chunk:
+            # The client stopped sending, let the caller report the parse error
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        complete = scanner.feed(chunk)
+    return V1, CODEC_JSON, b"".join(chunks)
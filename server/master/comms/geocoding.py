@@ -0,0 +1,235 @@
+"""
+Reverse Geocoding
+
+Turns scooter coordinates into street addresses. Lookups go through GeocodeCache,
+keyed on the coordinates rounded to GEOCODE_PRECISION decimals (4 is about 11 m),
+so a parked scooter is geocoded once and not on every admin page load.
+
+The cache keeps the most recently used addresses in memory for GEOCODE_TTL seconds.
+With GEOCODE_CACHE_DB set to the path of an SQLite file, addresses are also kept
+there for GEOCODE_DB_TTL seconds, so they survive restarts and are shared by the
+processes of the host.
+
+The addresses come from Google by default, asked at most GEOCODE_RATE times a second
+by this process with the key in GOOGLE_API_KEY, which has no default. GEOCODER=fake, or a FakeGeocoder given to geocode_cache.reset,
+answers locally instead, for tests and offline runs.
+"""
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+GEOCODE_PRECISION = int(os.getenv("GEOCODE_PRECISION", 4))  # decimals of the coordinates in the key
+GEOCODE_TTL = float(os.getenv("GEOCODE_TTL", 24 * 60 * 60))  # seconds in memory
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", 4096))  # addresses in memory
+GEOCODE_CACHE_DB = os.getenv("GEOCODE_CACHE_DB")  # SQLite file of the persistent tier, none by default
+GEOCODE_DB_TTL = float(os.getenv("GEOCODE_DB_TTL", 30 * 24 * 60 * 60))  # seconds in the SQLite file
+GEOCODE_RATE = float(os.getenv("GEOCODE_RATE", 40))  # Google lookups a second, below its 50 QPS quota
+
+GOOGLE_GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")  # required by google_geocoder
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket, spacing calls to at most rate a second with bursts of up to burst calls.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        "Waits until a call is allowed."
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token now, so callers queue up in order while they sleep
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+google_rate = RateLimiter(GEOCODE_RATE, burst=int(GEOCODE_RATE))
+
+
+def google_geocoder(latitude: float, longitude: float):
+    """
+    Looks up the street address of a point with the Google Maps Geocoding API.
+
+    Raises:
+        RuntimeError: If GOOGLE_API_KEY is not set.
+        RequestException: If Google cannot be reached.
+
+    Returns:
+        str: the street address, or None if Google knows none.
+    """
+    if not GOOGLE_API_KEY:
+        raise RuntimeError("GOOGLE_API_KEY is not set, set it or GEOCODER=fake to geocode locally")
+    google_rate.acquire()
+    response = requests.get(GOOGLE_GEOCODE_URL, timeout=5, params={
+        "latlng": f"{latitude},{longitude}",
+        "location_type": "ROOFTOP",
+        "key": GOOGLE_API_KEY,
+    })
+    address_data = response.json()
+    if address_data.get("results") and "formatted_address" in address_data["results"][0]:
+        return address_data["results"][0]["formatted_address"]
+    return None
+
+
+class FakeGeocoder:
+    """
+    A geocoder that answers locally, counting its lookups.
+
+    Args:
+        addresses (dict, optional): the address of (latitude, longitude) keys. Other points
+            get a made-up address from their coordinates.
+    """
+
+    def __init__(self, addresses: dict = None) -> None:
+        self.addresses = addresses or {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, latitude: float, longitude: float):
+        with self.lock:
+            self.calls += 1
+        return self.addresses.get((latitude, longitude), f"{latitude}, {longitude} Fake Street")
+
+
+class GeocodeCache:
+    """
+    Thread-safe LRU cache of street addresses, in front of a geocoder.
+
+    Args:
+        geocoder (callable): looks up the address of (latitude, longitude), None if there is none.
+        ttl (float): seconds an address is kept in memory.
+        size (int): the most addresses kept in memory.
+        path (str, optional): SQLite file of the persistent tier. Defaults to none.
+        db_ttl (float): seconds an address is kept in the SQLite file.
+    """
+
+    def __init__(self, geocoder, ttl: float = GEOCODE_TTL, size: int = GEOCODE_CACHE_SIZE,
+                 path: str = None, db_ttl: float = GEOCODE_DB_TTL) -> None:
+        self.geocoder = geocoder
+        self.ttl = ttl
+        self.size = size
+        self.db_ttl = db_ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key: (address, expires), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS geocodes (latitude REAL, longitude REAL, "
+                                    "address TEXT NOT NULL, created_at REAL NOT NULL, "
+                                    "PRIMARY KEY (latitude, longitude))")
+            self.connection.commit()
+
+    def key(self, latitude: float, longitude: float) -> tuple:
+        return round(float(latitude), GEOCODE_PRECISION), round(float(longitude), GEOCODE_PRECISION)
+
+    def address(self, latitude: float, longitude: float):
+        """
+        The street address of a point, geocoded only when no cached one is near enough.
+
+        Raises:
+            RequestException: If the geocoder cannot be reached.
+
+        Returns:
+            str: the street address, or None if the geocoder knows none.
+        """
+        address = self.cached_address(latitude, longitude)
+        if address is not None:
+            return address
+        return self.geocode(latitude, longitude)
+
+    def geocode(self, latitude: float, longitude: float):
+        """
+        Geocodes a point, whether or not its address is cached, and caches the address.
+
+        Raises:
+            RequestException: If the geocoder cannot be reached.
+
+        Returns:
+            str: the street address, or None if the geocoder knows none.
+        """
+        key = self.key(latitude, longitude)
+        # Outside the lock, other lookups go on while this one waits on the network
+        address = self.geocoder(*key)
+        if address is not None:
+            # Points without an address are not stored, a failed lookup is retried next time
+            with self.lock:
+                self.remember(key, address, persist=True)
+        return address
+
+    def cached_address(self, latitude: float, longitude: float):
+        """
+        The cached street address of a point, without geocoding it.
+
+        Returns:
+            str: the street address, or None if none is cached.
+        """
+        with self.lock:
+            address = self.cached(self.key(latitude, longitude))
+            if address is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return address
+
+    def cached(self, key: tuple):
+        "The address of key in memory, else in the SQLite file. Called with the lock held."
+        entry = self.entries.get(key)
+        if entry is not None:
+            if time.monotonic() < entry[1]:
+                self.entries.move_to_end(key)
+                return entry[0]
+            del self.entries[key]
+
+        if self.connection is not None:
+            row = self.connection.execute("SELECT address FROM geocodes WHERE latitude = ? AND longitude = ? "
+                                          "AND created_at > ?", (*key, time.time() - self.db_ttl)).fetchone()
+            if row:
+                self.remember(key, row[0], persist=False)
+                return row[0]
+        return None
+
+    def remember(self, key: tuple, address: str, persist: bool) -> None:
+        "Stores the address of key, evicting the least recently used. Called with the lock held."
+        self.entries[key] = (address, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        if persist and self.connection is not None:
+            self.connection.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)", (*key, address, time.time()))
+            self.connection.commit()
+
+    def reset(self, geocoder=None) -> None:
+        """
+        Empties the memory of the cache, and replaces its geocoder if one is given.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+            if geocoder is not None:
+                self.geocoder = geocoder
+
+
+geocode_cache = GeocodeCache(FakeGeocoder() if os.getenv("GEOCODER") == "fake" else google_geocoder,
+                             path=GEOCODE_CACHE_DB)
+if geocode_cache.geocoder is google_geocoder and not GOOGLE_API_KEY:
+    logger.warning("GOOGLE_API_KEY is not set, street addresses cannot be looked up")
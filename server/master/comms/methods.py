@@ -1,7 +1,11 @@
 import re
-import requests
 from passlib.hash import sha256_crypt
 from database.models import RepairStatus, ScooterStatus, BookingState
+from comms.backend import create_backend
+from comms.metrics import metrics, server_stats
+from database.database_manager import db, read_replica
+from database.pool import pool_metrics
+from comms.routes import RouteRegistry
 from comms.utils import message_scooter
 import database.queries as queries
 
@@ -9,78 +13,30 @@ import datetime
 
 from web.database.bookings import BookingAPI
 from web.database.scooters import ScooterAPI
-from web.database.transactions import TransactionAPI
-from web.database.users import UserAPI
 
-API_BASE_URL = "http://localhost:5000"
-
-get_functions = {}
-post_functions = {}
-update_functions = {}
-delete_functions = {}
+# Where the handlers read and write their data, see comms.backend
+backend = create_backend()
 
 VALID_METHODS = ["GET", "POST", "UPDATE", "DELETE"]
 
-
-def http_method_decorator(method, functions_dict):
-    def decorator(key, param_types={}):
-        def wrapper(func):
-            def inner_wrapper(*args, **kwargs):
-                # Check parameter types
-                for param, param_type in param_types.items():
-                    if param in kwargs and not isinstance(kwargs[param], param_type):
-                        raise TypeError(
-                            f"Invalid type for parameter '{param}'. Expected {param_type.__name__}, got {type(kwargs[param]).__name__}")
-
-                # Execute the wrapped function
-                result = func(*args, **kwargs)
-
-                # Return the result of the wrapped function
-                return result
-
-            functions_dict[key] = inner_wrapper
-            return inner_wrapper
-
-        return wrapper
-
-    return decorator
+# Every AACR handler of the master, see comms.routes
+routes = RouteRegistry(VALID_METHODS)
 
 
 def get(key, param_types={}):
-    return http_method_decorator("GET", get_functions)(key, param_types)
+    return routes.register("GET", key, param_types)
 
 
 def post(key, param_types={}):
-    return http_method_decorator("POST", post_functions)(key, param_types)
+    return routes.register("POST", key, param_types)
 
 
 def update(key, param_types={}):
-    return http_method_decorator("UPDATE", update_functions)(key, param_types)
+    return routes.register("UPDATE", key, param_types)
 
 
 def delete(key, param_types={}):
-    return http_method_decorator("DELETE", delete_functions)(key, param_types)
-
-
-def get_request(endpoint, check_status=True):
-    request = requests.get(API_BASE_URL + endpoint)
-    if check_status:
-        request.raise_for_status()
-    return request
-
-
-def post_request(endpoint, check_status=True, **kwargs):
-    request = requests.post(API_BASE_URL + endpoint, **kwargs)
-    if check_status:
-        request.raise_for_status()
-    return request
-
-
-def put_request(endpoint, check_status=True, **kwargs):
-    request = requests.put(API_BASE_URL + endpoint, **kwargs)
-    if check_status:
-        request.raise_for_status()
-    return request
+    return routes.register("DELETE", key, param_types)
 
 
 @post("/register", {"user": dict})
@@ -94,15 +50,14 @@ def register(user: dict):
         if not re.match(email_regex, email):
             raise ValueError("Invalid email address format.")
 
-        response = get_request(f"/user/email/{email}", check_status=False)
-        if response.status_code == 200:
+        if backend.get_user_by_email(email):
             raise ValueError("Email address already registered.")
 
         phone_regex = r'^[0-9]{10}$'
         if not re.match(phone_regex, phone_number):
             raise ValueError("Invalid phone number format.")
 
-        user = post_request("/user", json=user).json()
+        user = backend.create_user(user)
 
         return {"user": user, "response": "yes"}
     except ValueError as error:
@@ -111,13 +66,11 @@ def register(user: dict):
 
 @get("/login", {"email": str, "password": str})
 def login(email: str, password: str):
-    response = get_request(f"/user/email/{email}", check_status=False)
+    user = backend.get_user_by_email(email)
 
-    if response.status_code == 404:
+    if user is None:
         return {"error": "Email not found."}
 
-    user = response.json()
-
     if not sha256_crypt.verify(password, user["password"]):
         return {"error": "Password is incorrect."}
 
@@ -154,10 +107,15 @@ def update_status(scooter_id: int, repair_id: int):
         return {"error": status}
 
 
-@get("/customer/dashboard", {"customer_id": int})
-def fetch_available_scooters(customer_id: int):
+# JSON numbers without a fraction decode as int
+COORDINATE = (int, float)
+
+
+@get("/customer/dashboard", {"customer_id": int, "latitude": COORDINATE, "longitude": COORDINATE, "radius": COORDINATE})
+def fetch_available_scooters(customer_id: int, latitude: float = None, longitude: float = None, radius: float = None):
     """
-        Fetch a list of available scooters.
+        Fetch a list of available scooters, only the closest ones when the
+        customer sends their position.
 
         Returns:
             dict: A dictionary containing the fetched data or an error message.
@@ -166,19 +124,13 @@ def fetch_available_scooters(customer_id: int):
         if not customer_id:
             raise ValueError("customer_id was not supplied.")
 
-        scooters = get_request(f"/scooters/status/{ScooterStatus.AVAILABLE.value}").json()
-        bookings = get_request(f"/bookings/user/{customer_id}").json()
-        response = get_request(f"/user/id/{customer_id}", check_status=False)
+        # From a replica, unless the customer just booked or topped up
+        with read_replica(customer_id):
+            data = backend.get_dashboard(customer_id, latitude, longitude, radius)
 
-        if response.status_code == 404:
+        if data is None:
             raise ValueError("Customer not found.")
 
-        data = {
-            "scooters": scooters,
-            "bookings": bookings,
-            "user_details": response.json()
-        }
-
         return data
     except ValueError as error:
         return {"error": str(error)}
@@ -186,6 +138,20 @@ def fetch_available_scooters(customer_id: int):
         return {"error": str(error)}
 
 
+@get("/scooters/near", {"latitude": COORDINATE, "longitude": COORDINATE, "radius": COORDINATE, "k": int})
+def fetch_scooters_near(latitude: float, longitude: float, radius: float = None, k: int = queries.NEAR_LIMIT):
+    """
+        Fetch the available scooters closest to a point, closest first.
+
+        Returns:
+            list: The scooters with their distance in meters, or a dictionary with an error message.
+        """
+    try:
+        return backend.get_scooters_near(latitude, longitude, radius, k)
+    except ValueError as error:
+        return {"errorCode": "400", "error": str(error)}
+
+
 @post("/booking/create", {"booking_data": dict})
 def make_booking(booking_data: dict):
     """
@@ -204,14 +170,12 @@ def make_booking(booking_data: dict):
         if booking_data is None:
             raise ValueError("Booking data not passed!")
 
-        booking = post_request("/bookings", json=booking_data).json()
+        booking = backend.create_booking(booking_data)
         scooter_id = booking.get("scooter_id")
 
         if scooter_id:
-            data = {"status": ScooterStatus.BOOKED.value}
-            response = put_request(f"/scooter/status/{scooter_id}", json=data)
-            if response.status_code == 400 or response.status_code == 404:
-                return {"error": response.json['message']}
+            if backend.update_scooter_status(scooter_id, ScooterStatus.BOOKED.value) is None:
+                return {"error": "Scooter not found"}
             return {"message": "Booking successfully made"}
         else:
             raise ValueError("Invalid scooter ID in the booking data.")
@@ -231,17 +195,12 @@ def cancel_booking(booking_id: int):
         """
     try:
 
-        data = {"status": BookingState.CANCELLED.value}
-        response = put_request(f"/booking/status/{booking_id}", json=data)
-        if response.status_code != 404:
-            booking = response.json()
+        booking = backend.update_booking_status(booking_id, BookingState.CANCELLED.value)
+        if booking is not None:
             scooter_id = booking["scooter_id"]
 
-            data = {"status": ScooterStatus.AVAILABLE.value}
-            response = put_request(f"/scooter/status/{scooter_id}", json=data)
-
-            if response.status_code in [400, 404]:
-                return {"error": response.json['message']}
+            if backend.update_scooter_status(scooter_id, ScooterStatus.AVAILABLE.value) is None:
+                return {"error": "Scooter not found"}
             return {"message": "Booking successfully cancelled"}
         else:
             return {"error": "Booking not found."}
@@ -270,16 +229,10 @@ def submit_repair_request(scooter_id: int, report: str):
             "status": RepairStatus.PENDING.value
         }
 
-        response = post_request("/repair", json=data)
-
-        if response.status_code in [400, 404]:
-            return {"error": response.json['message']}
-
-        data = {"status": ScooterStatus.UNAVAILABLE.value}
+        backend.create_repair(data)
 
-        response = put_request(f"/scooter/status/{scooter_id}", json=data)
-        if response.status_code in [400, 404]:
-            return {"error": response.json['message']}
+        if backend.update_scooter_status(scooter_id, ScooterStatus.UNAVAILABLE.value) is None:
+            return {"error": "Scooter not found"}
 
         return {"message": "Repair request submitted successfully."}
     except ValueError as error:
@@ -288,32 +241,20 @@ def submit_repair_request(scooter_id: int, report: str):
         return {"error": str(error)}
 
 
-@update('/top-up', {'user_id': int, 'amount': float})
-def top_up_balance(user_id: int, amount: float):
+@update('/top-up', {'user_id': int, 'amount': (int, float), 'idempotency_key': str})
+def top_up_balance(user_id: int, amount: float, idempotency_key: str = None):
     """
-        Updates the balance of a user.
+        Adds to the balance of a user and records the transaction atomically.
+        Retries with the idempotency key of an earlier top-up return its result again.
 
         Returns:
-            dict: An empty dictionary if no errors occured.
+            dict: The new balance and the transaction ID, or an error message.
         """
     try:
-        response = get_request(f"/user/id/{user_id}")
-        if response.status_code == 404:
-            raise ValueError("User not found")
-        user = response.json()
-        user["balance"] += amount
-
-        response = put_request(f"/user/{user_id}", json=user, check_status=False)
-        if response.status_code == 404:
-            raise ValueError("Update user failed!")
-
-        data = {"user_id": user_id, "amount": amount}
-        post_request("/transaction", json=data)
-        return {"new_balance": user["balance"]}
+        result = backend.top_up(user_id, amount, idempotency_key)
+        return {"new_balance": result["new_balance"], "transaction_id": result["transaction_id"]}
     except ValueError as error:
         return {"error": str(error)}
-    except Exception as error:
-        return {"error": str(error)}
 
 
 @get('/scooter', {'scooter_id': int})
@@ -329,10 +270,11 @@ def fetch_scooters_by_id(scooter_id: int):
         if scooter_id is None:
             raise ValueError("ScooterID not found passed!")
 
-        scooters = requests.get(f"{API_BASE_URL}/scooter/id/{scooter_id}", timeout=5).json()
-        data = scooters
+        scooter = backend.get_scooter(scooter_id)
+        if scooter is None:
+            raise ValueError("Scooter not found")
 
-        return data
+        return scooter
 
     except ValueError as error:
         return {"error": str(error)}
@@ -367,70 +309,56 @@ def lock_scooter(scooter_id: int, user_id: int):
 
     message_scooter(scooter_id, {'method': 'UNLOCK'})
 
-    booking = BookingAPI.get_by_user_and_scooter(user_id=user_id, scooter_id=scooter_id)
-
-    # Update Booking
-    booking.end_time = datetime.datetime.now()
-    booking.status = BookingState.COMPLETED.value
-
-    updated_booking = BookingAPI.update(booking.id, booking)
-
-    # Get Scooter Information
-    scooter = ScooterAPI.get(scooter_id)
-
-    # Update Scooter
+    # Ask the scooter where it is before locking any row
     location = message_scooter(scooter_id, {'method': 'LOCATION'})
 
-    scooter['status'] = ScooterStatus.AVAILABLE.value
-    scooter['longitude'] = float(location['lng'])
-    scooter['latitude'] = float(location['lat'])
-
-    ScooterAPI.update(scooter_id, scooter)
-
-    # Calculate Ride Cose
-    duration = (updated_booking.end_time - updated_booking.start_time).total_seconds() / 60
-
-    cost = duration * (scooter['cost_per_time'] / 60)
-
-    rounded_cost = round(cost, 2)
-
-    TransactionAPI.create({'user_id': user_id, 'amount': rounded_cost})
-
-    # Update User Balance
-
-    user = UserAPI.get_by_id(user_id)
-
-    user['balance'] = user['balance'] - rounded_cost
-
-    UserAPI.update(user_id,user)
+    # End the booking, free the scooter and charge the user in one transaction
+    try:
+        ride = queries.settle_ride(user_id, scooter_id, float(location['lat']), float(location['lng']))
+    except ValueError as error:
+        return {"error": str(error)}
 
-    return {"message": "Scooter Successfully Returned"}
+    return {"message": "Scooter Successfully Returned", "cost": ride["cost"]}
 
 
 @update('/scooter/repair', {'scooter_id': int})
 def request_repair(scooter_id: int):
-    scooter_update = {'status': ScooterStatus.AWAITING_REPAIR.value}
-    requests.put(f"{API_BASE_URL}/scooter/status/{scooter_id}", json=scooter_update, timeout=5).json()
+    backend.update_scooter_status(scooter_id, ScooterStatus.AWAITING_REPAIR.value)
     return {"message": "Scooter Waiting for Repair"}
 
 
 @get('/customer/bookings', {'user_id': int})
 def check_booking(user_id: int):
-    response = requests.get(f"{API_BASE_URL}/booking/user/{user_id}")
-    if response.status_code == 404:
+    """
+    Tells a customer whether the scooter can be unlocked for them. Only an active
+    booking counts, completed and cancelled bookings do not unlock a scooter.
+    """
+    bookings = backend.get_user_bookings(user_id)
+    if not any(booking['status'] == BookingState.ACTIVE.value for booking in bookings):
         return {'message': 'You don\'t have any bookings'}
-    if response['user_id'] != user_id:
-        return {'message': 'This scooter isn\'t booked by you'}
     else:
         return {'message': 'Unlocking Scooter'}
 
 
 @get("/user", {'email': str})
 def get_user(email: str):
-    response = requests.get(f"{API_BASE_URL}/user/email/{email}")
-    if response.status_code == 404:
+    user = backend.get_user_by_email(email)
+    if user is None:
         return {'message': 'invalid email', 'user_id': 0}
     else:
-        response = response.json()
-        print(response)
-        return {'message': 'user found', 'user_id': response['id']}
+        return {'message': 'user found', 'user_id': user['id']}
+
+
+@get("/metrics")
+def get_metrics():
+    """
+        Reports how the AACR server is doing.
+
+        Returns:
+            dict: the request metrics by "METHOD uri" (count, errors, p50/p95/p99 latency,
+            bytes in and out), the call stats of every handler, the load of the server
+            (queue depth, active workers, connections turned away) and the use of the
+            database connection pool.
+    """
+    return {"requests": metrics.snapshot(), "handlers": routes.stats(), "server": server_stats(),
+            "database": pool_metrics.snapshot(db.engine.pool)}
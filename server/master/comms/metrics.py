@@ -0,0 +1,206 @@
+"""
+AACR Request Metrics
+
+Records, for every (method, uri) served by the master AACR server, the number of
+requests, how many failed, their latency and the bytes received and sent. Latency
+percentiles are computed over a window of the most recent requests of each route.
+
+The numbers are served through the AACR route GET /metrics and, in the Prometheus
+text format, through the /metrics endpoint of the master Flask application, along
+with the load of the AACR server registered on the app, see server_stats.
+"""
+import collections
+import math
+import threading
+
+from flask import current_app
+
+from comms.routes import is_error
+
+WINDOW = 2048  # Latest latencies kept per route for the percentiles
+MAX_ROUTES = 256  # Distinct (method, uri) pairs tracked, the rest are counted together
+OTHER = ("OTHER", "*")
+QUANTILES = (0.5, 0.95, 0.99)
+SERVER_APP_KEY = "aacr_server"  # Key of the AACR server in the extensions of the Flask app
+
+# Server.stats and AsyncServer.stats keys reported to Prometheus: (key, name, type, help)
+SERVER_METRICS = (
+    ("queue_depth", "aacr_queue_depth", "gauge", "AACR requests waiting for a free worker."),
+    ("active_workers", "aacr_active_workers", "gauge", "AACR workers running a request."),
+    ("workers", "aacr_workers", "gauge", "AACR worker threads."),
+    ("idle_connections", "aacr_idle_connections", "gauge", "AACR connections waiting for their next request."),
+    ("open_connections", "aacr_open_connections", "gauge", "Open AACR connections."),
+    ("requests_in_flight", "aacr_requests_in_flight", "gauge", "AACR requests being handled."),
+    ("accepted", "aacr_connections_accepted_total", "counter", "AACR connections accepted."),
+    ("rejected", "aacr_connections_rejected_total", "counter", "AACR connections turned away as busy."),
+)
+
+
+class RouteMetrics:
+    """
+    The metrics of one (method, uri) pair. Updated under the lock of Metrics.
+    """
+
+    def __init__(self, window: int = WINDOW) -> None:
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def snapshot(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "total_seconds": self.total_time,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+class Metrics:
+    """
+    Thread-safe metrics of the requests served, by (method, uri).
+    """
+
+    def __init__(self, window: int = WINDOW, max_routes: int = MAX_ROUTES) -> None:
+        """
+        Args:
+            window (int, optional): latencies kept per route for the percentiles. Defaults to WINDOW.
+            max_routes (int, optional): (method, uri) pairs tracked on their own, so clients
+                sending made up uris cannot grow the metrics forever. Defaults to MAX_ROUTES.
+        """
+        self.window = window
+        self.max_routes = max_routes
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, message, seconds: float, response, bytes_in: int, bytes_out: int) -> None:
+        """
+        Adds a served request to the metrics.
+
+        Args:
+            message: the decoded request, None if it could not be decoded.
+            seconds (float): time taken to run the request and send its response.
+            response: the response sent, an error if it holds an "error" key.
+            bytes_in (int): size of the request payload.
+            bytes_out (int): size of the response payload.
+        """
+        key = request_key(message)
+        with self.lock:
+            route = self.routes.get(key)
+            if route is None:
+                if len(self.routes) >= self.max_routes:
+                    key = OTHER
+                route = self.routes.setdefault(key, RouteMetrics(self.window))
+            route.count += 1
+            route.errors += is_error(response)
+            route.total_time += seconds
+            route.bytes_in += bytes_in
+            route.bytes_out += bytes_out
+            route.latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+            dict: the metrics of every route, keyed by "METHOD uri".
+        """
+        with self.lock:
+            return {f"{method} {uri}": route.snapshot() for (method, uri), route in self.routes.items()}
+
+    def prometheus(self) -> str:
+        """
+        Returns:
+            str: the metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            routes = [(method, uri, route, sorted(route.latencies)) for (method, uri), route in self.routes.items()]
+
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        def labels(method, uri, **extra):
+            pairs = [("method", method), ("uri", uri)] + list(extra.items())
+            return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+        family("aacr_requests_total", "counter", "AACR requests served.",
+               [f"aacr_requests_total{labels(m, u)} {r.count}" for m, u, r, _ in routes])
+        family("aacr_request_errors_total", "counter", "AACR requests answered with an error.",
+               [f"aacr_request_errors_total{labels(m, u)} {r.errors}" for m, u, r, _ in routes])
+
+        durations = []
+        for method, uri, route, latencies in routes:
+            for quantile in QUANTILES:
+                durations.append(f"aacr_request_duration_seconds{labels(method, uri, quantile=str(quantile))} "
+                                 f"{percentile(latencies, quantile)}")
+            durations.append(f"aacr_request_duration_seconds_sum{labels(method, uri)} {route.total_time}")
+            durations.append(f"aacr_request_duration_seconds_count{labels(method, uri)} {route.count}")
+        family("aacr_request_duration_seconds", "summary",
+               f"Time to run an AACR request and send its response, over the last {self.window} requests.",
+               durations)
+
+        family("aacr_request_bytes_total", "counter", "Bytes of AACR request payloads received.",
+               [f"aacr_request_bytes_total{labels(m, u)} {r.bytes_in}" for m, u, r, _ in routes])
+        family("aacr_response_bytes_total", "counter", "Bytes of AACR response payloads sent.",
+               [f"aacr_response_bytes_total{labels(m, u)} {r.bytes_out}" for m, u, r, _ in routes])
+        return "\n".join(lines) + "\n"
+
+
+def server_stats() -> dict:
+    """
+    Returns:
+        dict: the load of the AACR server serving the current app, see Server.stats,
+        empty if the app is not served over AACR.
+    """
+    server = current_app.extensions.get(SERVER_APP_KEY)
+    return server.stats() if server is not None else {}
+
+
+def server_prometheus(stats: dict) -> str:
+    """
+    Returns:
+        str: the load of an AACR server, see server_stats, in the Prometheus text exposition format.
+    """
+    lines = []
+    for key, name, kind, help_text in SERVER_METRICS:
+        if key in stats:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {stats[key]}"]
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def request_key(message) -> tuple:
+    """
+    Returns:
+        tuple: the (method, uri) a request is recorded under.
+    """
+    if not isinstance(message, dict) or not isinstance(message.get("method"), str):
+        return ("INVALID", "*")
+    uri = message.get("uri", "/")
+    return (message["method"], uri if isinstance(uri, str) else "*")
+
+
+def percentile(values: list, quantile: float) -> float:
+    """
+    Nearest-rank percentile of sorted values, 0 when there are none.
+    """
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(quantile * len(values)) - 1)]
+
+
+def escape(value: str) -> str:
+    "Escapes a Prometheus label value."
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# The metrics of the AACR server of this process
+metrics = Metrics()
@@ -0,0 +1,240 @@
+"""
+AACR Route Registry
+
+Every AACR handler is registered once as a Route, keyed by its (method, uri) pair.
+Registration inspects the handler's signature and compiles the checks its params
+need, so serving a request is a single dictionary lookup followed by those checks:
+unknown or missing params and params of the wrong type are rejected before the
+handler runs.
+
+Each route also counts its calls, errors and rejected requests, and keeps a
+histogram of its latencies.
+"""
+import asyncio
+import bisect
+import inspect
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in milliseconds. The last bucket has no bound.
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Route:
+    """
+    A handler registered for a (method, uri) pair, with its compiled param checks and stats.
+    """
+
+    def __init__(self, method: str, uri: str, func, param_types: dict) -> None:
+        """
+        Args:
+            method (str): the AACR method, such as "GET".
+            uri (str): the endpoint, such as "/scooter".
+            func (callable): the handler, a function or a coroutine function.
+            param_types (dict): the type, or tuple of types, each param must have, by param name.
+
+        Raises:
+            ValueError: If param_types names a param the handler does not take.
+        """
+        self.method = method
+        self.uri = uri
+        self.func = func
+        self.is_coroutine = inspect.iscoroutinefunction(func)
+
+        parameters = inspect.signature(func).parameters.values()
+        # A handler taking **kwargs accepts any param
+        self.accepts_any = any(p.kind == p.VAR_KEYWORD for p in parameters)
+        self.accepted = frozenset(p.name for p in parameters if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+        self.required = frozenset(p.name for p in parameters
+                                  if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY) and p.default is p.empty)
+        unknown = set(param_types) - self.accepted
+        if unknown and not self.accepts_any:
+            raise ValueError(f"{method} {uri} declares types for params it does not take: {sorted(unknown)}")
+        self.validators = tuple(param_types.items())
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.total_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def validate(self, params: dict) -> None:
+        """
+        Checks the params of a request against the handler.
+
+        Raises:
+            TypeError: If a param is unknown, missing or of the wrong type.
+        """
+        if not isinstance(params, dict):
+            raise TypeError(f"Params must be an object, got {type(params).__name__}")
+        if not self.accepts_any and not self.accepted.issuperset(params):
+            raise TypeError(f"Unknown parameter(s) {sorted(set(params) - self.accepted)} for {self.method} {self.uri}")
+        if not self.required.issubset(params):
+            raise TypeError(f"Missing parameter(s) {sorted(self.required - set(params))} for {self.method} {self.uri}")
+        for param, param_type in self.validators:
+            if param in params and not isinstance(params[param], param_type):
+                raise TypeError(
+                    f"Invalid type for parameter '{param}'. Expected {type_name(param_type)}, "
+                    f"got {type(params[param]).__name__}")
+
+    def call(self, params: dict):
+        """
+        Validates the params and runs a blocking handler with them.
+
+        Raises:
+            TypeError: If the params are not valid for the handler.
+        """
+        self._check(params)
+        start = time.perf_counter()
+        error = True
+        try:
+            response = self.func(**params)
+            error = is_error(response)
+            return response
+        finally:
+            self.record(time.perf_counter() - start, error)
+
+    async def call_async(self, params: dict):
+        """
+        Validates the params and awaits a coroutine handler with them.
+
+        Raises:
+            TypeError: If the params are not valid for the handler.
+        """
+        self._check(params)
+        start = time.perf_counter()
+        error = True
+        try:
+            response = await self.func(**params)
+            error = is_error(response)
+            return response
+        finally:
+            self.record(time.perf_counter() - start, error)
+
+    def _check(self, params: dict) -> None:
+        try:
+            self.validate(params)
+        except TypeError:
+            with self.lock:
+                self.rejected += 1
+            raise
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        """
+        Adds a call to the stats of the route.
+
+        Args:
+            seconds (float): how long the handler took.
+            error (bool, optional): whether the handler failed or answered with an error. Defaults to False.
+        """
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds * 1000)
+        with self.lock:
+            self.calls += 1
+            self.errors += error
+            self.total_time += seconds
+            self.histogram[bucket] += 1
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: the calls, errors, rejected requests, mean latency in milliseconds and
+            the latency histogram, as counts per bucket upper bound ("inf" for the last).
+        """
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "mean_ms": self.total_time * 1000 / self.calls if self.calls else 0.0,
+                "histogram": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["inf"], self.histogram)),
+            }
+
+
+class RouteRegistry:
+    """
+    The AACR routes of the master, resolved by (method, uri).
+    """
+
+    def __init__(self, methods) -> None:
+        """
+        Args:
+            methods (iterable): the AACR methods routes may be registered for.
+        """
+        self.methods = frozenset(methods)
+        self.routes = {}
+
+    def register(self, method: str, uri: str, param_types: dict = None):
+        """
+        Returns a decorator registering a handler for method and uri. The handler
+        itself is returned unchanged, so calling it directly skips the route checks.
+
+        Raises:
+            ValueError: If the method is unknown or the route is registered twice.
+        """
+        if method not in self.methods:
+            raise ValueError(f"Unknown AACR method '{method}'")
+
+        def decorator(func):
+            if (method, uri) in self.routes:
+                raise ValueError(f"Route {method} {uri} is already registered")
+            self.routes[(method, uri)] = Route(method, uri, func, param_types or {})
+            return func
+
+        return decorator
+
+    def resolve(self, method: str, uri: str):
+        """
+        Returns:
+            Route: the route registered for method and uri, or None.
+        """
+        return self.routes.get((method, uri))
+
+    def run(self, message: dict):
+        """
+        Runs a single AACR request on its route. Must be called inside a Flask app context.
+
+        Args:
+            message (dict): the request, with its method, uri and params.
+
+        Returns:
+            dict: the response of the handler, or an AACR error.
+        """
+        if not isinstance(message, dict) or message.get("method") not in self.methods:
+            return {"errorCode": "400", "error": "Method not found"}
+
+        route = self.resolve(message["method"], message.get("uri", "/"))
+        if route is None:
+            return {"errorCode": "404", "error": "Element not found"}
+
+        try:
+            if route.is_coroutine:
+                # Coroutine handlers are written for the AsyncServer, run them to completion here
+                return asyncio.run(route.call_async(message.get("params", {})))
+            return route.call(message.get("params", {}))
+        except TypeError as e:
+            # This means the method called had errors in the parameters passed
+            return {"errorCode": "400", "error": str(e)}
+        except Exception as e:
+            return {"errorCode": "500", "error": str(e)}
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: the stats of every route, keyed by "METHOD uri".
+        """
+        return {f"{method} {uri}": route.stats() for (method, uri), route in self.routes.items()}
+
+
+def is_error(response) -> bool:
+    """
+    Whether a handler answered with an error.
+    """
+    return isinstance(response, dict) and "error" in response
+
+
+def type_name(param_type) -> str:
+    "The name of a type, or of a tuple of types, in error messages."
+    if isinstance(param_type, tuple):
+        return " or ".join(t.__name__ for t in param_type)
+    return param_type.__name__
@@ -1,193 +1,400 @@
+import heapq
+import itertools
+import logging
+import selectors
 import socket
 import threading
-import json
-import signal
-import os
+import time
+import queue
 
 from flask import Flask
 
-from comms.methods import get_functions, post_functions, delete_functions, update_functions, VALID_METHODS
+from comms.batch import BATCH_METHOD, execute_batch
+from comms.codecs import CODEC_JSON, CODECS, UNSUPPORTED_RESPONSE, decode, encode
+from comms.framing import CHUNK_SIZE, FRAME_MARKER, MESSAGE_LIMIT, V1, V2, FrameError, read_message, write_message
+from comms.methods import routes
+from comms.metrics import SERVER_APP_KEY, metrics, request_key
+from comms.routes import is_error
 
 PORT = 5000
 HOST = '127.0.0.1'
-MESSAGE_LIMIT = 30_000_000  # 10 MB
+REQUEST_TIMEOUT = 3  # Seconds allowed to receive a whole request, however slowly it trickles in
+KEEPALIVE_TIMEOUT = 60  # Seconds a v2 connection may stay idle between requests
+WORKERS = 16  # Threads serving requests
+QUEUE_SIZE = 64  # Requests waiting for a free worker
+BACKLOG = 128  # Connections waiting to be accepted by the OS
+REJECT_READ = 1 << 20  # Bytes of a request turned away read at most, only those already received
+BUSY_RESPONSE = {"errorCode": "503", "error": "Server busy, try again later"}
+
+logger = logging.getLogger(__name__)
 
 
 class Server:
     """
     Hanldes a server using the protocol AACR (Adapted Application Communication and Routing)
+
+    One thread accepts connections and watches them on a selector, a pool of worker
+    threads serves their requests. A connection is queued for the workers only once
+    its next request starts arriving, and a v2 connection goes back to the selector
+    after every response, so idle keep-alive connections do not hold a worker.
     """
 
-    def __init__(self, host: str = HOST, port: int = PORT, buffer_size: int = MESSAGE_LIMIT) -> None:
+    def __init__(self, host: str = HOST, port: int = PORT, buffer_size: int = MESSAGE_LIMIT,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT, workers: int = WORKERS,
+                 queue_size: int = QUEUE_SIZE, backlog: int = BACKLOG) -> None:
         """
         Create the server using the given host and port
 
         Args:
             host (str, optional): The host address, probably localhost. Defaults to HOST.
             port (int, optional): The port to make communications. Defaults to PORT.
-            buffer_size (int, optional): The port to make communications. Defaults to PORT.
+            buffer_size (int, optional): The largest request accepted, in bytes. Defaults to MESSAGE_LIMIT.
+            keepalive_timeout (float, optional): Seconds a v2 connection may stay idle. Defaults to KEEPALIVE_TIMEOUT.
+            workers (int, optional): Threads serving requests. Defaults to WORKERS.
+            queue_size (int, optional): Requests that may wait for a worker before new ones
+                are turned away as busy. Defaults to QUEUE_SIZE.
+            backlog (int, optional): Listen backlog of the server socket. Defaults to BACKLOG.
         """
         self.host = host
         self.port = port
         self.buffer_size = buffer_size
+        self.keepalive_timeout = keepalive_timeout
+        self.workers = workers
+
+        # Connections with a request waiting for a worker
+        self.connections = queue.Queue(maxsize=queue_size)
+        # Connections waiting for their next request, with their deadline
+        self.selector = selectors.DefaultSelector()
+        self.idle = {}
+        self.deadlines = []  # (deadline, sequence, socket) heap, stale once the socket is no longer idle
+        self.sequence = itertools.count()
+        # v2 connections answered by a worker, to watch again for their next request
+        self.returned = queue.SimpleQueue()
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.stats_lock = threading.Lock()
+        self.active_workers = 0
+        self.accepted = 0
+        self.rejected = 0
 
         # Creates a socket to allow connections
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(backlog)
         self.app = None
-        print("[INFO] Server started on {}:{}".format(self.host, self.port))
+        logger.info("Server started on %s:%s", self.host, self.port)
 
     def start_server(self, app) -> None:
         """
-        Listens for connections and if one is acquired accepts it and handles it
+        Starts the worker threads, then accepts connections and queues every one
+        with a request arriving for the workers. When the queue is full the request
+        is answered with a busy error instead of waiting. Connections staying idle
+        past their deadline are closed.
         """
         self.app = app
+        # Reported by the metrics of the app
+        app.extensions[SERVER_APP_KEY] = self
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, args=(app,), daemon=True).start()
+
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
         while True:
-            # Accept any connection incoming
+            for key, _ in self.selector.select(self.select_timeout()):
+                if key.fileobj is self.server_socket:
+                    self.accept()
+                elif key.fileobj is self.wakeup_receiver:
+                    self.watch_returned()
+                else:
+                    self.queue_request(key.fileobj)
+            self.close_idle()
+
+    def accept(self) -> None:
+        """
+        Accepts an incoming connection and watches it for its first request.
+        """
+        try:
             client_socket, client_address = self.server_socket.accept()
-            print("[INFO] Connected to {}:{}".format(client_address[0], client_address[1]))
-            # Create a new thread to handle the client request
-            with self.app.app_context():
-                client_thread = threading.Thread(target=self.handle_client, args=(client_socket, app))
-                client_thread.start()
+        except BlockingIOError:
+            # Another wakeup took it, or the client already gave up
+            return
+        logger.debug("Connected to %s:%s", client_address[0], client_address[1], extra={"sample": True})
+        with self.stats_lock:
+            self.accepted += 1
+        # The first request must arrive promptly
+        self.watch(client_socket, REQUEST_TIMEOUT)
 
-    def start(self) -> None:
+    def watch(self, client_socket: socket.socket, timeout: float) -> None:
         """
-            Intended way to start the server.
+        Waits on the selector for the next request of a connection, for up to timeout seconds.
         """
-        signal.signal(signal.SIGINT, self.exit_handler)
-        # Create a thread for the server to run onto
-        server_thread = threading.Thread(target=self.start_server)
-        server_thread.start()
-        while True:
-            try:
+        deadline = time.monotonic() + timeout
+        self.idle[client_socket] = deadline
+        heapq.heappush(self.deadlines, (deadline, next(self.sequence), client_socket))
+        self.selector.register(client_socket, selectors.EVENT_READ)
 
-                pass
-            except KeyboardInterrupt:
-                break
+    def unwatch(self, client_socket: socket.socket) -> None:
+        self.selector.unregister(client_socket)
+        del self.idle[client_socket]
 
-        print("[INFO] Stopping the server...")
-        server_thread.join()
-        print("[INFO] Server stopped.")
+    def queue_request(self, client_socket: socket.socket) -> None:
+        """
+        Queues a connection whose request is arriving for the workers, or turns it
+        away as busy if the queue is full.
+        """
+        self.unwatch(client_socket)
+        try:
+            self.connections.put_nowait(client_socket)
+        except queue.Full:
+            self.reject(client_socket)
 
-    def handle_client(self, client_socket: socket.socket, app: Flask) -> None:
+    def watch_returned(self) -> None:
+        """
+        Watches the v2 connections the workers are done with for their next request.
+        """
+        try:
+            self.wakeup_receiver.recv(4096)
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                client_socket = self.returned.get_nowait()
+            except queue.Empty:
+                return
+            self.watch(client_socket, self.keepalive_timeout)
+
+    def select_timeout(self):
+        "Seconds until the earliest idle deadline, None when no connection is idle."
+        if not self.deadlines:
+            return None
+        return max(self.deadlines[0][0] - time.monotonic(), 0)
+
+    def close_idle(self) -> None:
+        """
+        Closes the connections idle past their deadline.
+        """
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, client_socket = heapq.heappop(self.deadlines)
+            # Stale if the connection was queued since, and maybe watched again
+            if self.idle.get(client_socket) == deadline:
+                self.unwatch(client_socket)
+                client_socket.close()
+
+    def worker(self, app: Flask) -> None:
+        """
+        Serves queued requests one at a time, for as long as the server runs. A v2
+        connection is handed back to the selector once its request is answered.
+        """
+        while True:
+            client_socket = self.connections.get()
+            with self.stats_lock:
+                self.active_workers += 1
+            try:
+                keep_alive = self.handle_client(client_socket, app)
+            finally:
+                with self.stats_lock:
+                    self.active_workers -= 1
+            if keep_alive:
+                self.returned.put(client_socket)
+                try:
+                    self.wakeup_sender.send(b"\0")
+                except BlockingIOError:
+                    # The selector has wakeups pending already
+                    pass
+
+    def reject(self, client_socket: socket.socket) -> None:
+        """
+        Answers a connection whose request could not be queued with a busy error, in
+        the AACR version of its request, and closes it.
+
+        Runs on the accept thread, so it never waits for the client: the request is
+        only read as far as it has been received, enough to tell its version from the
+        first byte. Reading it also keeps the close from resetting the connection
+        before the client reads the error. A client that already closed the
+        connection is not counted as turned away.
+        """
+        try:
+            client_socket.setblocking(False)
+            first, read = b"", 0
+            try:
+                while read < REJECT_READ:
+                    chunk = client_socket.recv(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    first = first or chunk[:1]
+                    read += len(chunk)
+            except BlockingIOError:
+                pass
+            if first:
+                with self.stats_lock:
+                    self.rejected += 1
+                logger.info("Server busy, connection turned away", extra={"sample": True})
+                self.send_response(client_socket, BUSY_RESPONSE, V2 if first[0] == FRAME_MARKER else V1)
+                client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: the load of the server: requests waiting for a worker, busy workers,
+            connections waiting for their next request, and connections accepted or
+            turned away since start.
+        """
+        with self.stats_lock:
+            return {
+                "queue_depth": self.connections.qsize(),
+                "active_workers": self.active_workers,
+                "workers": self.workers,
+                "idle_connections": len(self.idle),
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+            }
+
+    def handle_client(self, client_socket: socket.socket, app: Flask) -> bool:
         """
-        Handles a client request
+        Handles the next request of a client connection. A v1 client gets a single
+        response before the connection is closed, a v2 connection stays open for the
+        next request until the client closes it or stays idle for longer than the
+        keep-alive timeout.
 
         Args:
             app: Flask application instance
             client_socket (socket.socket): client socket where connection is made
+
+        Returns:
+            bool: whether the connection stays open for another request, it is closed otherwise.
         """
-        while True:
+        keep_alive = False
+        try:
             # Gets client's request
-            data = self.get_data(client_socket)
             try:
-                # Parses the data into JSON
-                data_json = json.loads(data.decode())
-
-                # If no data passed or an invalid method passed, return an error
-                if not data_json or "method" not in data_json or data_json["method"] not in VALID_METHODS:
-                    self.send_response(client_socket, {"errorCode": "400", "error": "Method not found"})
-                    break
-
-                # Get the method and the endpoint to be hit, default to /
-                requested_method = data_json["method"]
-                requested_uri = data_json.get("uri", "/")
-
-                print(requested_uri)
-
-                # Python switch xd
-                method_functions = {
-                    "GET": get_functions,
-                    "POST": post_functions,
-                    "UPDATE": update_functions,
-                    "DELETE": delete_functions
-                }
-
-                # Execute the request in the correct method
-                if requested_method in method_functions:
-                    with app.app_context():
-                        self.execute_request(client_socket, method_functions[requested_method], data_json,
-                                             requested_uri)
-
-                break
-            except TypeError as e:
-                # This means the method called had errors in the parameters passed
-                self.send_response(client_socket, {"errorCode": "400", "error": str(e)})
-                break
-            except Exception as e:
-                # Error parsing JSON or any other
-                self.send_response(client_socket, {"errorCode": "500", "error": str(e)})
-                break
-
-        client_socket.close()
-        print("[INFO] Disconnected from client, request succeeded")
-
-    def get_data(self, client_socket: socket.socket) -> bytes:
-        """
-        Gets the data received from a socket.
+                version, codec, data = self.get_data(client_socket)
+            except FrameError as e:
+                logger.info("Invalid request: %s", e, extra={"sample": True})
+                self.send_response(client_socket, {"errorCode": "400", "error": str(e)}, e.version)
+                return False
+            except EOFError:
+                return False
+
+            if version is None:
+                return False
+
+            if codec not in CODECS:
+                self.send_response(client_socket, UNSUPPORTED_RESPONSE, version)
+            else:
+                self.serve_request(client_socket, data, app, version, codec)
+            keep_alive = version != V1
+        except OSError:
+            # The client went away while we were answering
+            pass
+        finally:
+            if not keep_alive:
+                client_socket.close()
+        return keep_alive
+
+    def serve_request(self, client_socket: socket.socket, data: bytes, app: Flask, version: int,
+                      codec: int = CODEC_JSON) -> None:
+        """
+        Runs a request, sends its response and records it in the metrics.
 
         Args:
-            client_socket (socket.socket): socket connection to the client
+            client_socket (socket.socket): a socket where the client is connected
+            data (bytes): the raw request.
+            app (Flask): Flask application instance the handlers run in.
+            version (int): the AACR version the client speaks.
+            codec (int, optional): the codec the request is encoded with. Defaults to CODEC_JSON.
+        """
+        start = time.perf_counter()
+        try:
+            # Parses the data with the codec of the request
+            data_json = decode(data, codec)
+        except ValueError as e:
+            data_json, response = None, {"errorCode": "500", "error": str(e)}
+        else:
+            response = self.dispatch(data_json, app)
+        sent = self.send_response(client_socket, response, version, codec)
+        elapsed = time.perf_counter() - start
+        metrics.record(data_json, elapsed, response, len(data), sent)
+        log_request(data_json, elapsed, response)
 
-        Returns:
-            (bytes): the recovered data from the connection
+    def dispatch(self, data_json: dict, app: Flask) -> dict:
         """
-        client_socket.settimeout(3)
+        Runs the function registered for a request.
 
+        Args:
+            data_json (dict): the decoded request.
+            app (Flask): Flask application instance the handlers run in.
+
+        Returns:
+            dict: the response to send to the client.
+        """
         try:
-            # Retrieve request send by the client
-            data = client_socket.recv(self.buffer_size)  # Adjust the buffer size as needed
-        except socket.timeout:
-            data = b''
+            # Several requests sent in one message, see comms.batch
+            if isinstance(data_json, dict) and data_json.get("method") == BATCH_METHOD:
+                with app.app_context():
+                    return execute_batch(data_json)
+
+            # Execute the request on its route
+            with app.app_context():
+                return routes.run(data_json)
+        except TypeError as e:
+            # This means the method called had errors in the parameters passed
+            return {"errorCode": "400", "error": str(e)}
+        except Exception as e:
+            # Any other error
+            return {"errorCode": "500", "error": str(e)}
+
+    def get_data(self, client_socket: socket.socket):
+        """
+        Gets the next request received from a socket. The whole request must arrive
+        within REQUEST_TIMEOUT, a client sending it a byte at a time cannot hold the
+        worker any longer.
 
-        return data
+        Args:
+            client_socket (socket.socket): socket connection to the client
 
-    def exit_handler(self, signal, frame) -> None:
-        """
-        Gracefully closes the program
+        Returns:
+            (int, int, bytes): the AACR version, codec and payload of the request,
+            or (None, None, b'') once the client is gone.
         """
-        print("[INFO] Closing server...")
-        os._exit(0)
+        message = read_message(client_socket, self.buffer_size, deadline=time.monotonic() + REQUEST_TIMEOUT)
+        # The response gets a timeout of its own, not what is left of the deadline
+        client_socket.settimeout(REQUEST_TIMEOUT)
+        return message
 
-    def send_response(self, client_socket: socket.socket, response: dict) -> None:
+    def send_response(self, client_socket: socket.socket, response: dict, version: int = V1,
+                      codec: int = CODEC_JSON) -> int:
         """
-        Sends a JSON response to the client.
+        Sends a response to the client.
 
         Args:
             client_socket (socket.socket): a socket where the client is connected
             response (dict): a response object.
-        """
-        response_json = json.dumps(response)
-        client_socket.send(response_json.encode())
-
-    def execute_request(self, client_socket: socket.socket, method_functions: dict, data: dict,
-                        requested_uri: str) -> None:
-        """
-        Executes the request asked by the client, using the know methods functions.
+            version (int, optional): the AACR version the client speaks. Defaults to V1.
+            codec (int, optional): the codec of the client's request. Defaults to CODEC_JSON.
 
-        Args:
-            client_socket (socket.socket): socket to client connection.
-            method_functions (dict): the valid functions declared.
-            data (dict): the "body" of the request.
-            requested_uri (str): the endpoint being hit.
+        Returns:
+            int: the size of the response payload.
         """
+        payload = encode(response, codec)
+        write_message(client_socket, version, payload, codec)
+        return len(payload)
 
-        # If the endpoint does not exist return an error
-        if requested_uri not in method_functions:
-            print(f"{data['method']} {requested_uri}  404 Element not found")
-            self.send_response(client_socket, {"errorCode": "404", "error": "Element not found"})
-            return
-
-        # Execute the function with or without params according to the case
-        if "params" not in data:
-            self.send_response(client_socket, method_functions[requested_uri]())
-        else:
-            self.send_response(client_socket, method_functions[requested_uri](**data["params"]))
-        print(f"{data['method']} {requested_uri}  Success")
 
+def log_request(message, seconds: float, response) -> None:
+    """
+    Logs a sampled line for a request served.
+    """
+    if logger.isEnabledFor(logging.INFO):
+        method, uri = request_key(message)
+        logger.info("%s %s", method, uri, extra={
+            "sample": True, "method": method, "uri": uri,
+            "duration_ms": round(seconds * 1000, 3), "error": is_error(response)
+        })
 
-if __name__ == '__main__':
-    scooter = Server(host='192.168.1.108', port=12345)
-    scooter.start_server()
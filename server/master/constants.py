@@ -1,6 +1,13 @@
+import os
+
 PUBLIC_HOST = '0.0.0.0'
 PRIVATE_HOST= '127.0.0.1'
 MASTER_PORT = 5000
 AGENT_PORT = 5001
 SOCKET_PORT = 63000
 API_BASE_URL = "http://localhost:5000"
+AACR_HOST = os.getenv("AACR_HOST", "127.0.0.1")
+AACR_PORT = int(os.getenv("AACR_PORT", 54321))
+AACR_WORKERS = int(os.getenv("AACR_WORKERS", 16))
+AACR_QUEUE_SIZE = int(os.getenv("AACR_QUEUE_SIZE", 64))
+AACR_BACKLOG = int(os.getenv("AACR_BACKLOG", 128))
@@ -12,3 +12,20 @@ HOST = os.getenv("DB_HOST")
 USER = os.getenv("DB_USER")
 PASSWORD = os.getenv("DB_PASSWORD")
 NAME = os.getenv("DB_NAME")
+
+# Check the schema version at startup, see database.migrations.check_schema
+SCHEMA_CHECK = os.getenv("DB_SCHEMA_CHECK", "1") != "0"
+
+# Connection pool of the MySQL engine, shared by the Flask threads and the AACR workers
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # seconds waiting for a free connection
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") != "0"
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # seconds, below the wait_timeout of the server
+CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 5))  # seconds
+STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))  # milliseconds for SELECTs, 0 for none
+
+# Read replicas, comma separated hosts sharing the credentials and name of the primary
+REPLICA_HOSTS = [host.strip() for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host.strip()]
+# Seconds after a user writes during which their reads stay on the primary
+REPLICA_LAG = float(os.getenv("DB_REPLICA_LAG", 5))
@@ -0,0 +1,135 @@
+"""
+Customer Dashboard Projection
+
+The customer dashboard shows the available scooters, the bookings of the customer and
+their details. The bookings and details come from one joined query. The available
+scooters are the same for every customer, so they are read once and shared from
+memory until a scooter changes.
+
+Every commit that inserts or deletes a scooter through the ORM, or changes the status,
+position or details of one, empties the shared list. Commits that only write the
+street address, see web.addresses, keep it. DASHBOARD_CACHE_TTL bounds how long the
+list is kept anyway, for the changes made by other processes and to the address.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import event, inspect
+
+from database import queries
+from database.database_manager import RoutingSession, db, in_unit_of_work, use_replica
+from database.models import Booking, Scooter, ScooterStatus, User
+
+CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", 30))  # seconds
+# Columns of a scooter whose change empties the shared list
+CACHED_COLUMNS = ("status", "latitude", "longitude", "make", "colour", "cost_per_time", "remaining_power")
+
+
+class AvailableScooterCache:
+    """
+    The JSON of the available scooters, shared by every dashboard of this process.
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL) -> None:
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.scooters = None
+        self.expires = 0.0
+        # Bumped by every invalidation, so a load that raced one is not kept
+        self.generation = 0
+
+    def get(self) -> list:
+        """
+        Returns:
+            list: the available scooters as JSON. Shared, callers must not change it.
+        """
+        with self.lock:
+            if self.scooters is not None and time.monotonic() < self.expires:
+                return self.scooters
+            generation = self.generation
+
+        # Read from the primary, a lagging replica would be cached for the whole TTL
+        token = use_replica.set(False)
+        try:
+            scooters = [scooter.as_json()
+                        for scooter in Scooter.query.filter_by(status=ScooterStatus.AVAILABLE.value)]
+        finally:
+            use_replica.reset(token)
+
+        with self.lock:
+            if generation == self.generation:
+                self.scooters = scooters
+                self.expires = time.monotonic() + self.ttl
+        return scooters
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.scooters = None
+
+
+available_scooters = AvailableScooterCache()
+
+
+def changes_listing(scooter) -> bool:
+    "Whether a flushed change of the scooter shows in the list of available scooters."
+    attributes = inspect(scooter).attrs
+    return any(attributes[column].history.has_changes() for column in CACHED_COLUMNS)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def track_scooter_changes(session, flush_context):
+    # The history of the attributes still holds the changes flushed
+    if any(isinstance(instance, Scooter) for instance in (*session.new, *session.deleted)) or \
+            any(isinstance(instance, Scooter) and changes_listing(instance) for instance in session.dirty):
+        session.info["scooters_changed"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def invalidate_available_scooters(session):
+    if in_unit_of_work(session):
+        return
+    # After the commit, so a reload cannot read the rows from before it
+    if session.info.pop("scooters_changed", False):
+        available_scooters.invalidate()
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def forget_scooter_changes(session):
+    if in_unit_of_work(session):
+        return
+    session.info.pop("scooters_changed", None)
+
+
+def customer_dashboard(customer_id, latitude=None, longitude=None, radius=None):
+    """
+    Everything the dashboard of a customer shows.
+
+    Args:
+        customer_id (int): The ID of the customer.
+        latitude (float, optional): position of the customer. Defaults to None.
+        longitude (float, optional): position of the customer. Defaults to None.
+        radius (float, optional): meters around the position to show scooters in. Defaults to None.
+
+    Returns:
+        dict: the available scooters, only those near the customer when their position
+        is given, the bookings and the details of the customer, or None if there is no
+        such customer.
+    """
+    # The customer and their bookings in one round trip
+    rows = db.session.query(User, Booking).outerjoin(Booking, Booking.user_id == User.id) \
+        .filter(User.id == customer_id).order_by(Booking.id).all()
+    if not rows:
+        return None
+
+    if latitude is not None and longitude is not None:
+        scooters = queries.scooters_near(latitude, longitude, radius)
+    else:
+        scooters = available_scooters.get()
+
+    return {
+        "scooters": scooters,
+        "bookings": [booking.as_json() for _, booking in rows if booking is not None],
+        "user_details": rows[0][0].as_json()
+    }
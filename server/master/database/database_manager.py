@@ -2,13 +2,156 @@
 Database Configuration and Initialization
 
 This module contains code for configuring and initializing the Flask-SQLAlchemy extension.
-It establishes a connection to the MySQL database and creates the necessary database tables.
+It configures the connection to the MySQL database; the tables are created and upgraded
+by the migrations in database.migrations.
 
+Read-only code can send its SELECTs to read replicas (DB_REPLICA_HOSTS) with
+read_replica() or the replica_reads decorator. Writes, SELECT ... FOR UPDATE and every
+query of a session that has written stay on the primary, and so do the reads of a user
+who wrote in the last DB_REPLICA_LAG seconds, so users always see their own bookings
+and top-ups.
 """
+import functools
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from flask_sqlalchemy import SQLAlchemy
-from database.config import HOST, USER, PASSWORD, NAME
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import Select
+from database.config import HOST, USER, PASSWORD, NAME, REPLICA_HOSTS, REPLICA_LAG
+from database.pool import engine_options
 
-db = SQLAlchemy()
+# Bind keys of the replica engines, empty when there are none
+replica_binds = []
+# Whether the SELECTs of the current context may go to a replica
+use_replica = ContextVar("use_replica", default=False)
+
+
+class RoutingSession(Session):
+    """
+    A session that sends the SELECTs of read_replica() blocks to a replica.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and isinstance(self.bind, Connection):
+            # Joined to the transaction of a connection, see single_transaction
+            return self.bind
+        if (bind is None and replica_binds and use_replica.get() and not self._flushing
+                and not self.info.get("wrote") and isinstance(clause, Select) and clause._for_update_arg is None):
+            # Stay on one replica for the whole session, so its reads are consistent
+            if "replica" not in self.info:
+                self.info["replica"] = random.choice(replica_binds)
+            return self._db.engines[self.info["replica"]]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+class RecentWriters:
+    """
+    The users who wrote recently, whose reads must not go to a lagging replica.
+    """
+
+    def __init__(self, lag: float = REPLICA_LAG) -> None:
+        self.lag = lag
+        self.lock = threading.Lock()
+        self.writes = {}
+
+    def add(self, user_ids) -> None:
+        now = time.monotonic()
+        with self.lock:
+            for user_id in user_ids:
+                self.writes[user_id] = now
+            # Forget the writes the replicas have caught up with
+            if len(self.writes) > 10_000:
+                self.writes = {user: at for user, at in self.writes.items() if now - at < self.lag}
+
+    def __contains__(self, user_id) -> bool:
+        with self.lock:
+            at = self.writes.get(user_id)
+        return at is not None and time.monotonic() - at < self.lag
+
+
+recent_writers = RecentWriters()
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def track_writes(session, flush_context):
+    "Keep the session on the primary from its first write, and note the users written for."
+    session.info["wrote"] = True
+    users = session.info.setdefault("users", set())
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        user_id = instance.id if instance.__tablename__ == "users" else getattr(instance, "user_id", None)
+        if user_id is not None:
+            users.add(user_id)
+
+
+def in_unit_of_work(session) -> bool:
+    """
+    Whether the commits and rollbacks of a session only end savepoints of a larger
+    transaction, see single_transaction. The after_commit and after_rollback hooks
+    leave such a session alone, they run once the whole transaction commits.
+    """
+    return session.info.get("unit_of_work", False)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def record_writers(session):
+    if in_unit_of_work(session):
+        return
+    recent_writers.add(session.info.pop("users", ()))
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def forget_writes(session):
+    if in_unit_of_work(session):
+        return
+    session.info.pop("users", None)
+    session.info.pop("wrote", None)
+
+
+@contextmanager
+def read_replica(user_id=None):
+    """
+    Send the SELECTs of a block to a read replica, when there is one.
+
+    Args:
+        user_id (int, optional): the user the data is read for. Their reads stay on the
+            primary for DB_REPLICA_LAG seconds after they write. Defaults to None.
+    """
+    if not replica_binds or (user_id is not None and user_id in recent_writers):
+        yield
+        return
+    token = use_replica.set(True)
+    try:
+        yield
+    finally:
+        use_replica.reset(token)
+
+
+def replica_engine():
+    """
+    The engine of a read replica, or the primary's when there is none. For code that
+    binds its queries up front instead of running them in a read_replica() block, such
+    as a generator, which gives up its context between rows.
+    """
+    if not replica_binds:
+        return db.engine
+    return db.engines[random.choice(replica_binds)]
+
+def replica_reads(func):
+    "Runs a read-only view or handler with its SELECTs sent to a read replica."
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with read_replica():
+            return func(*args, **kwargs)
+    return wrapper
 
 def init_db(app, testing):
     """
@@ -16,19 +159,82 @@ def init_db(app, testing):
 
     Args:
         app (Flask): The Flask application instance to which SQLAlchemy should be initialized.
-        
+        testing (bool): use an empty in-memory database.
+
     Returns:
         None
     """
     # Load configuration
-    if HOST is None or testing:
+    if is_in_memory(testing):
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
     else:
         app.config["SQLALCHEMY_DATABASE_URI"] = f"mysql://{USER}:{PASSWORD}@{HOST}/{NAME}"
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+        app.config["SQLALCHEMY_BINDS"] = {
+            f"replica{index}": {"url": f"mysql://{USER}:{PASSWORD}@{host}/{NAME}", **engine_options()}
+            for index, host in enumerate(REPLICA_HOSTS)
+        }
+        replica_binds[:] = list(app.config["SQLALCHEMY_BINDS"])
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False  # Disable modification tracking
 
     # Initialize SQLAlchemy extension
     db.init_app(app)
-     # Create all database tables
-    with app.app_context():
-        db.create_all()
+    if testing:
+        # A new in-memory database has nothing to migrate
+        with app.app_context():
+            db.create_all()
+
+
+def is_in_memory(testing):
+    "Whether the database is a throwaway in-memory one, for tests or when no DB_HOST is set."
+    return HOST is None or testing
+
+
+@event.listens_for(Engine, "connect")
+def sqlite_connect(dbapi_connection, connection_record):
+    # pysqlite begins transactions on its own, too late for SAVEPOINTs to nest in them.
+    # Let SQLAlchemy emit BEGIN instead, see sqlite_begin.
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, "begin")
+def sqlite_begin(connection):
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("BEGIN")
+
+
+@contextmanager
+def single_transaction():
+    """
+    Run a block of code in one database transaction on the current app context.
+
+    The block runs on a session joined to a transaction of its own connection. Code
+    inside may call db.session.commit() and db.session.rollback() as usual: they
+    release or roll back a SAVEPOINT, so a handler that undoes its own changes
+    leaves the changes made before it in place. Everything is committed when the
+    block exits, or rolled back if it raises. The after_commit hooks of the session
+    run once, after that commit.
+
+    Yields:
+        Session: the session the block runs on, also available as db.session.
+    """
+    db.session.remove()
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        session = db.session.session_factory(bind=connection, join_transaction_mode="create_savepoint")
+        session.info["unit_of_work"] = True
+        db.session.registry.set(session)
+        try:
+            yield session
+            session.commit()
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            raise
+        else:
+            session.info["unit_of_work"] = False
+            session.dispatch.after_commit(session)
+        finally:
+            session.close()
+            db.session.remove()
@@ -0,0 +1,117 @@
+"""
+Geohash Encoding
+
+A geohash names a rectangular cell of the earth with a short string. Every extra
+character splits the cell into 32 smaller ones, so points close to each other share
+a long common prefix. Stored in an indexed column, geohashes let the database find
+the rows in a few cells with prefix range scans instead of reading every row.
+
+A circle of radius r lies inside the 3x3 block of cells around its centre as long
+as the cells are at least r tall and r wide, which is how covering_cells chooses
+the cells to search.
+"""
+import math
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+PRECISION = 12  # Characters stored per scooter, about 4 cm
+EARTH_RADIUS = 6_371_000  # meters
+METERS_PER_DEGREE = 111_320
+
+
+def encode(latitude: float, longitude: float, precision: int = PRECISION) -> str:
+    """
+    Encodes a point as a geohash.
+
+    Args:
+        latitude (float): between -90 and 90.
+        longitude (float): between -180 and 180.
+        precision (int, optional): number of characters. Defaults to PRECISION.
+
+    Returns:
+        str: the geohash of the cell containing the point.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    value = 0
+    even = True
+    while len(geohash) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        current, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (current[0] + current[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            current[0] = middle
+        else:
+            current[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            geohash.append(BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(geohash)
+
+
+def cell_size(precision: int):
+    """
+    Returns:
+        (float, float): the height and width in degrees of the cells of a precision.
+    """
+    total_bits = 5 * precision
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def cell_meters(precision: int, latitude: float):
+    """
+    Returns:
+        (float, float): the height and width in meters of the cells of a precision at a latitude.
+    """
+    height, width = cell_size(precision)
+    return height * METERS_PER_DEGREE, width * METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6)
+
+
+def precision_for_radius(radius: float, latitude: float) -> int:
+    """
+    Returns:
+        int: the longest precision whose cells are at least radius meters tall and wide at latitude.
+    """
+    for precision in range(PRECISION, 0, -1):
+        if min(cell_meters(precision, latitude)) >= radius:
+            return precision
+    return 1
+
+
+def covering_cells(latitude: float, longitude: float, radius: float):
+    """
+    Finds the geohash cells to search for the points within radius meters of a point.
+
+    Returns:
+        list: the geohash prefixes of the cell containing the point and its neighbours.
+    """
+    precision = precision_for_radius(radius, latitude)
+    height, width = cell_size(precision)
+    cells = set()
+    for d_lat in (-height, 0, height):
+        for d_lon in (-width, 0, width):
+            cell_lat = min(max(latitude + d_lat, -90.0), 90.0)
+            # Wrap around the antimeridian
+            cell_lon = (longitude + d_lon + 180.0) % 360.0 - 180.0
+            cells.add(encode(cell_lat, cell_lon, precision))
+    return sorted(cells)
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Returns:
+        float: the great-circle distance between two points, in meters.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
@@ -0,0 +1,232 @@
+"""
+Schema Migrations
+
+The schema of the master database is versioned. Every change to it is a numbered
+migration below, and the schema_version table records the migrations a database
+has been through. They are applied by an explicit command:
+
+    python main.py migrate [--seed]
+
+Starting the master does not create tables, reflect the schema or seed data: it
+reads the version from schema_version once and refuses to start when the database
+is behind the code (see check_schema).
+
+The baseline migration creates the missing tables straight from the models, so a
+new database already has every later column and index. Later migrations therefore
+check the live schema before they change it, which also makes rerunning them harmless.
+"""
+import datetime
+import logging
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+from sqlalchemy.exc import DBAPIError
+
+from database import geohash
+from database.config import SCHEMA_CHECK
+from database.database_manager import db
+from database.models import Booking, Repairs, Scooter, Transaction, User
+
+logger = logging.getLogger(__name__)
+
+# Kept out of db.metadata so db.create_all() and db.drop_all() leave it alone
+schema_metadata = MetaData()
+schema_version = Table(
+    "schema_version", schema_metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# (version, description, function) of every migration, in order
+MIGRATIONS = []
+
+
+class SchemaOutOfDate(RuntimeError):
+    "Raised at startup when the database has not been migrated to the version of the code."
+
+
+def migration(version: int, description: str):
+    """
+    Registers a function that takes a connection as the migration to a schema version.
+    """
+    def decorator(func):
+        if MIGRATIONS and version != MIGRATIONS[-1][0] + 1:
+            raise ValueError(f"Migration {version} does not follow migration {MIGRATIONS[-1][0]}")
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0]
+
+
+def current_version(connection) -> int:
+    """
+    Returns:
+        int: the latest migration applied to the database, 0 for a database never migrated.
+    """
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+    return connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def migrate(target: int = None) -> list:
+    """
+    Applies the pending migrations to the database of the current app context,
+    each in its own transaction.
+
+    Args:
+        target (int, optional): the version to stop at. Defaults to the latest.
+
+    Returns:
+        list: the versions applied.
+    """
+    target = latest_version() if target is None else target
+    with db.engine.begin() as connection:
+        schema_metadata.create_all(connection)
+        version = current_version(connection)
+
+    applied = []
+    for number, description, func in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        logger.info("Applying migration", extra={"version": number, "description": description})
+        with db.engine.begin() as connection:
+            func(connection)
+            connection.execute(schema_version.insert().values(
+                version=number, description=description, applied_at=datetime.datetime.now()))
+        applied.append(number)
+    return applied
+
+
+def check_schema() -> None:
+    """
+    The boot path of the master: one query for the schema version, no reflection.
+
+    Raises:
+        SchemaOutOfDate: If the database is not at the latest version.
+    """
+    if not SCHEMA_CHECK:
+        return
+    try:
+        with db.engine.connect() as connection:
+            version = connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+    except DBAPIError as error:
+        raise SchemaOutOfDate("Could not read the schema version, run 'python main.py migrate'") from error
+    if version != latest_version():
+        raise SchemaOutOfDate(
+            f"The database is at schema version {version}, the code needs {latest_version()}. "
+            "Run 'python main.py migrate'")
+
+
+def add_column(connection, column) -> bool:
+    """
+    Adds a column of a model to its table, unless the table already has it. A NOT NULL
+    column needs a server default, which fills it in on the existing rows.
+
+    Returns:
+        bool: whether the column was added.
+    """
+    table = column.table
+    if column.name in {existing["name"] for existing in inspect(connection).get_columns(table.name)}:
+        return False
+    if not column.nullable and column.server_default is None:
+        raise ValueError(f"Cannot add the NOT NULL column {table.name}.{column.name} without a server default")
+    # Name, type, DEFAULT and NOT NULL as CREATE TABLE would write them
+    specification = connection.dialect.ddl_compiler(connection.dialect, None).get_column_specification(column)
+    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {specification}"))
+    return True
+
+
+def create_indexes(connection, table, names) -> list:
+    """
+    Creates indexes declared on a model, unless the table already has them.
+    On MySQL InnoDB builds them online, the table stays readable and writable.
+
+    Args:
+        table (Table): the table of the model.
+        names (list): the names of the indexes.
+
+    Returns:
+        list: the names of the indexes created.
+    """
+    existing = {index["name"] for index in inspect(connection).get_indexes(table.name)}
+    declared = {index.name: index for index in table.indexes}
+    created = []
+    for name in names:
+        if name not in existing:
+            declared[name].create(connection)
+            created.append(name)
+    return created
+
+
+def drop_indexes(connection, table, names) -> list:
+    """
+    Drops indexes no longer declared on a model, when the table still has them.
+
+    Args:
+        table (Table): the table of the model.
+        names (list): the names of the indexes.
+
+    Returns:
+        list: the names of the indexes dropped.
+    """
+    # Reflected, since the model no longer declares them
+    live = Table(table.name, MetaData(), autoload_with=connection)
+    existing = {index.name: index for index in live.indexes}
+    dropped = []
+    for name in names:
+        if name in existing:
+            existing[name].drop(connection)
+            dropped.append(name)
+    return dropped
+
+
+@migration(1, "Baseline tables")
+def create_tables(connection):
+    # Databases created by the former create_all() at startup already have them
+    db.metadata.create_all(connection)
+
+
+@migration(2, "Hot filter indexes and scooters.geohash")
+def add_indexes_and_geohash(connection):
+    table = Scooter.__table__
+    add_column(connection, table.c.geohash)
+    create_indexes(connection, table, ["ix_scooters_status_geohash"])
+    create_indexes(connection, User.__table__, ["ix_users_role"])
+    create_indexes(connection, Booking.__table__,
+                   ["ix_bookings_user_scooter_status", "ix_bookings_scooter_id", "ix_bookings_status"])
+    create_indexes(connection, Repairs.__table__, ["ix_repairs_status_scooter", "ix_repairs_scooter_id"])
+
+    rows = connection.execute(select(table.c.id, table.c.latitude, table.c.longitude)
+                              .where(table.c.geohash.is_(None))).all()
+    for scooter_id, latitude, longitude in rows:
+        connection.execute(table.update().where(table.c.id == scooter_id)
+                           .values(geohash=geohash.encode(float(latitude), float(longitude))))
+
+
+@migration(3, "transactions.created_at and the export date range indexes")
+def add_export_indexes(connection):
+    add_column(connection, Transaction.__table__.c.created_at)
+    create_indexes(connection, Transaction.__table__, ["ix_transactions_created_at"])
+    create_indexes(connection, Booking.__table__, ["ix_bookings_start_time"])
+
+
+@migration(4, "transactions.idempotency_key")
+def add_idempotency_keys(connection):
+    add_column(connection, Transaction.__table__.c.idempotency_key)
+    create_indexes(connection, Transaction.__table__, ["ux_transactions_user_idempotency_key"])
+
+
+@migration(5, "scooters.address")
+def add_scooter_addresses(connection):
+    # Filled by the address worker of the master once it starts
+    for column in ("address", "address_latitude", "address_longitude"):
+        add_column(connection, Scooter.__table__.c[column])
+
+
+@migration(6, "Drop ix_transactions_user_id")
+def drop_transaction_user_index(connection):
+    # ux_transactions_user_idempotency_key leads with user_id and serves the same lookups
+    drop_indexes(connection, Transaction.__table__, ["ix_transactions_user_id"])
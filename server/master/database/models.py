@@ -5,10 +5,13 @@ This module defines SQLAlchemy models representing various entities in the syste
 such as users, scooters, bookings, repairs, and user balances.
 
 """
+import datetime
 from enum import Enum
+from sqlalchemy import event
 from sqlalchemy.orm import relationship
 from passlib.hash import sha256_crypt
 from database.database_manager import db
+from database import geohash
 
 
 class UserType(Enum):
@@ -42,6 +45,9 @@ class User(db.Model):
     Represents a user in the system.
     """
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_users_role', 'role'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(255), nullable=False, unique=True)
@@ -86,6 +92,10 @@ class Scooter(db.Model):
     Represents a scooter in the system.
     """
     __tablename__ = 'scooters'
+    __table_args__ = (
+        # Serves both the status filter and the geohash range scans of the nearby queries
+        db.Index('ix_scooters_status_geohash', 'status', 'geohash'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     make = db.Column(db.String(100), nullable=False)
@@ -100,6 +110,12 @@ class Scooter(db.Model):
                                ScooterStatus.UNAVAILABLE.value),
                        nullable=False)
     colour = db.Column(db.String(100), nullable=False)
+    # Kept in sync with latitude and longitude on every write, see update_geohash
+    geohash = db.Column(db.String(geohash.PRECISION))
+    # Street address and the position it was resolved at, filled in the background by web.addresses
+    address = db.Column(db.String(255))
+    address_latitude = db.Column(db.Float(precision=6))
+    address_longitude = db.Column(db.Float(precision=6))
 
     def as_json(self):
         "A dictionary with all the values of this scooter."
@@ -111,15 +127,31 @@ class Scooter(db.Model):
             "remaining_power": self.remaining_power,
             "cost_per_time": self.cost_per_time,
             "status": self.status,
-            "colour": self.colour
+            "colour": self.colour,
+            "address": self.address
         }
 
 
+@event.listens_for(Scooter, "before_insert")
+@event.listens_for(Scooter, "before_update")
+def update_geohash(mapper, connection, scooter):
+    "Index the scooter under the geohash of its current position."
+    if scooter.latitude is not None and scooter.longitude is not None:
+        scooter.geohash = geohash.encode(float(scooter.latitude), float(scooter.longitude))
+
+
 class Booking(db.Model):
     """
     Represents a booking in the system.
     """
     __tablename__ = 'bookings'
+    __table_args__ = (
+        # The user_id prefix also serves the lookups of all the bookings of a user
+        db.Index('ix_bookings_user_scooter_status', 'user_id', 'scooter_id', 'status'),
+        db.Index('ix_bookings_scooter_id', 'scooter_id'),
+        db.Index('ix_bookings_status', 'status'),
+        db.Index('ix_bookings_start_time', 'start_time'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -152,6 +184,10 @@ class Repairs(db.Model):
     Represents a repair record in the system.
     """
     __tablename__ = 'repairs'
+    __table_args__ = (
+        db.Index('ix_repairs_status_scooter', 'status', 'scooter_id'),
+        db.Index('ix_repairs_scooter_id', 'scooter_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     scooter_id = db.Column(db.Integer, db.ForeignKey('scooters.id'), nullable=False)
@@ -175,10 +211,19 @@ class Transaction(db.Model):
     Represents the transactions of a user in the system.
     """
     __tablename__ = 'transactions'
+    __table_args__ = (
+        db.Index('ix_transactions_created_at', 'created_at'),
+        # A retried top-up carries the key of its first attempt, see queries.top_up.
+        # Leads with user_id, so it also serves the lookups of a user's transactions
+        db.Index('ux_transactions_user_idempotency_key', 'user_id', 'idempotency_key', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     amount = db.Column(db.Float(precision=2), nullable=False)
+    # Unknown for the transactions made before the column existed
+    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    idempotency_key = db.Column(db.String(64))
 
     user = relationship('User')
 
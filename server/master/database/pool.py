@@ -0,0 +1,171 @@
+"""
+Database Connection Pool
+
+Builds the engine options of the MySQL connection pool from database.config and
+records how the pool is used: how long requests wait to check out a connection,
+how many new connections are opened and how long opening them takes, and how many
+checkouts time out. The numbers are served with the AACR request metrics.
+"""
+import math
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from database.config import (CONNECT_TIMEOUT, MAX_OVERFLOW, POOL_PRE_PING, POOL_RECYCLE, POOL_SIZE, POOL_TIMEOUT,
+                             STATEMENT_TIMEOUT)
+
+# Upper bounds in seconds of the checkout wait histogram
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class PoolMetrics:
+    """
+    Thread-safe counters of the connection pools of this process.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.wait_histogram = [0] * (len(WAIT_BUCKETS) + 1)
+        self.connects = 0
+        self.connect_time = 0.0
+
+    def record_checkout(self, seconds: float, timed_out: bool = False) -> None:
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_time += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            self.wait_histogram[bucket(seconds)] += 1
+
+    def record_connect(self, seconds: float) -> None:
+        with self.lock:
+            self.connects += 1
+            self.connect_time += seconds
+
+    def snapshot(self, pool=None) -> dict:
+        """
+        Args:
+            pool (Pool, optional): the pool whose current size and use are added.
+
+        Returns:
+            dict: the counters, and the state of the pool if one is given.
+        """
+        with self.lock:
+            data = {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_time,
+                "wait_seconds_max": self.max_wait,
+                "wait_histogram": dict(zip([str(b) for b in WAIT_BUCKETS] + ["+Inf"], self.wait_histogram)),
+                "connects": self.connects,
+                "connect_seconds_total": self.connect_time,
+            }
+        if isinstance(pool, QueuePool):
+            data.update(size=pool.size(), checked_out=pool.checkedout(), idle=pool.checkedin(),
+                        overflow=max(pool.overflow(), 0))
+        return data
+
+    def prometheus(self, pool=None) -> str:
+        """
+        Returns:
+            str: the metrics in the Prometheus text exposition format.
+        """
+        data = self.snapshot(pool)
+        lines = [
+            "# HELP db_pool_checkouts_total Connections checked out of the database pool.",
+            "# TYPE db_pool_checkouts_total counter",
+            f"db_pool_checkouts_total {data['checkouts']}",
+            "# HELP db_pool_checkout_timeouts_total Checkouts that gave up waiting for a free connection.",
+            "# TYPE db_pool_checkout_timeouts_total counter",
+            f"db_pool_checkout_timeouts_total {data['timeouts']}",
+            "# HELP db_pool_checkout_wait_seconds Time to check out a connection, opening or pinging it included.",
+            "# TYPE db_pool_checkout_wait_seconds histogram",
+        ]
+        cumulative = 0
+        for le, count in data["wait_histogram"].items():
+            cumulative += count
+            lines.append(f'db_pool_checkout_wait_seconds_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"db_pool_checkout_wait_seconds_sum {data['wait_seconds_total']}")
+        lines.append(f"db_pool_checkout_wait_seconds_count {cumulative}")
+        lines += [
+            "# HELP db_pool_connects_total Database connections opened.",
+            "# TYPE db_pool_connects_total counter",
+            f"db_pool_connects_total {data['connects']}",
+            "# HELP db_pool_connect_seconds_total Time spent opening database connections.",
+            "# TYPE db_pool_connect_seconds_total counter",
+            f"db_pool_connect_seconds_total {data['connect_seconds_total']}",
+        ]
+        for gauge, help_text in (("size", "Connections the pool keeps open."),
+                                 ("checked_out", "Connections in use."),
+                                 ("idle", "Open connections waiting in the pool."),
+                                 ("overflow", "Connections open beyond the pool size.")):
+            if gauge in data:
+                lines += [f"# HELP db_pool_{gauge} {help_text}", f"# TYPE db_pool_{gauge} gauge",
+                          f"db_pool_{gauge} {data[gauge]}"]
+        return "\n".join(lines) + "\n"
+
+
+def bucket(seconds: float) -> int:
+    "Index of the histogram bucket of a wait."
+    for index, bound in enumerate(WAIT_BUCKETS):
+        if seconds <= bound:
+            return index
+    return len(WAIT_BUCKETS)
+
+
+# The metrics of the connection pools of this process
+pool_metrics = PoolMetrics()
+
+
+class MeasuredQueuePool(QueuePool):
+    """
+    A QueuePool that records its checkout waits and new connections in pool_metrics.
+    """
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            pool_metrics.record_checkout(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - start)
+        return connection
+
+    def _create_connection(self):
+        start = time.perf_counter()
+        record = super()._create_connection()
+        pool_metrics.record_connect(time.perf_counter() - start)
+        return record
+
+
+def engine_options() -> dict:
+    """
+    Returns:
+        dict: the SQLALCHEMY_ENGINE_OPTIONS of the MySQL engine.
+    """
+    connect_args = {"connect_timeout": CONNECT_TIMEOUT}
+    if STATEMENT_TIMEOUT > 0:
+        # MySQL aborts SELECTs running longer than this, writes are bounded by the lock wait
+        lock_wait = max(1, math.ceil(STATEMENT_TIMEOUT / 1000))
+        connect_args["init_command"] = (f"SET SESSION max_execution_time = {STATEMENT_TIMEOUT}, "
+                                        f"SESSION innodb_lock_wait_timeout = {lock_wait}")
+    return {
+        "poolclass": MeasuredQueuePool,
+        "pool_size": POOL_SIZE,
+        "max_overflow": MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_pre_ping": POOL_PRE_PING,
+        "pool_recycle": POOL_RECYCLE,
+        # Reuse the most recently returned connections so idle ones can expire
+        "pool_use_lifo": True,
+        "connect_args": connect_args,
+    }
@@ -1,5 +1,15 @@
+import datetime
+from sqlalchemy.exc import IntegrityError
 from database.database_manager import db
-from database.models import Repairs, RepairStatus, Scooter, ScooterStatus
+from database.models import (Booking, BookingState, Repairs, RepairStatus, Scooter, ScooterStatus, Transaction,
+                             User)
+from database import geohash
+
+NEAR_RADIUS = 250  # meters, first radius tried by a k-nearest search
+NEAR_MAX_RADIUS = 50_000  # meters, furthest a search looks
+NEAR_LIMIT = 20  # scooters returned by default
+NEAR_MAX_LIMIT = 100
+
 
 def scooters_awaiting_repairs():
     # Use a subquery to find the first repair request with status "active" for each scooter with status "awaiting repair."
@@ -46,6 +56,47 @@ def scooters_awaiting_repairs():
             result_list.append(scooter_data)
     return result_list
 
+def pending_repairs_with_scooters():
+    """
+    The pending repair reports with the scooter of each, in one joined query.
+
+    Returns:
+        dict: "repairs", the pending repairs with the longitude and latitude of their scooter,
+        and "scooters", the scooter of each repair in the same order.
+    """
+    rows = db.session.query(Repairs, Scooter).join(Scooter, Scooter.id == Repairs.scooter_id) \
+        .filter(Repairs.status == RepairStatus.PENDING.value).order_by(Repairs.id).all()
+
+    repairs = []
+    scooters = []
+    for repair, scooter in rows:
+        repair_data = repair.as_json()
+        repair_data["longitude"] = scooter.longitude
+        repair_data["latitude"] = scooter.latitude
+        repairs.append(repair_data)
+        scooters.append(scooter.as_json())
+    return {"repairs": repairs, "scooters": scooters}
+
+def report_repair(repair_id):
+    """
+    Confirm a repair report: the repair becomes active and its scooter awaits repair, in one commit.
+
+    Args:
+        repair_id (int): The ID of the repair reported.
+
+    Returns:
+        dict: the repair, or None if there is no such repair.
+    """
+    repair = db.session.get(Repairs, repair_id)
+    if repair is None:
+        return None
+    repair.status = RepairStatus.ACTIVE.value
+    scooter = db.session.get(Scooter, repair.scooter_id)
+    if scooter is not None:
+        scooter.status = ScooterStatus.AWAITING_REPAIR.value
+    db.session.commit()
+    return repair.as_json()
+
 def fix_scooter(scooter_id, repair_id):
     """
     Mark a scooter as fixed and complete the corresponding repair.
@@ -69,3 +120,183 @@ def fix_scooter(scooter_id, repair_id):
         repair.status = RepairStatus.COMPLETED.value
         db.session.commit()
         return {'message': 'Scooter successfully repaired'}, 200
+
+
+def settle_ride(user_id, scooter_id, latitude, longitude):
+    """
+    End the active booking of a user on a scooter and charge them for the ride, in one
+    transaction with the user, scooter and booking rows locked.
+
+    The balance is decremented by the database, so concurrent charges and top-ups of
+    the same user cannot overwrite each other.
+
+    Args:
+        user_id (int): The ID of the user riding.
+        scooter_id (int): The ID of the scooter returned.
+        latitude (float): where the scooter was returned.
+        longitude (float): where the scooter was returned.
+
+    Raises:
+        ValueError: If the user, the scooter or the active booking does not exist.
+
+    Returns:
+        dict: the cost of the ride and the new balance of the user.
+    """
+    try:
+        # Always lock users, then scooters, then bookings, so settlements cannot deadlock
+        user = User.query.filter_by(id=user_id).with_for_update().one_or_none()
+        scooter = Scooter.query.filter_by(id=scooter_id).with_for_update().one_or_none()
+        booking = Booking.query.filter_by(
+            user_id=user_id,
+            scooter_id=scooter_id,
+            status=BookingState.ACTIVE.value
+        ).with_for_update().first()
+        if user is None or scooter is None:
+            raise ValueError("User or scooter not found")
+        if booking is None:
+            raise ValueError("No active booking for this scooter")
+
+        booking.end_time = datetime.datetime.now()
+        booking.status = BookingState.COMPLETED.value
+        scooter.status = ScooterStatus.AVAILABLE.value
+        scooter.latitude = latitude
+        scooter.longitude = longitude
+
+        minutes = (booking.end_time - booking.start_time).total_seconds() / 60
+        cost = round(minutes * (scooter.cost_per_time / 60), 2)
+        db.session.add(Transaction(user_id=user_id, amount=cost))
+        db.session.execute(db.update(User).where(User.id == user_id).values(balance=User.balance - cost))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {"cost": cost, "balance": user.balance}
+
+
+def scooters_within(latitude, longitude, radius, status):
+    """
+    Find the scooters with a status within radius meters of a point, closest first.
+
+    Only the rows in the geohash cells around the point are read, through range
+    scans on the geohash index.
+
+    Returns:
+        list: (distance in meters, scooter) pairs sorted by distance.
+    """
+    cells = geohash.covering_cells(latitude, longitude, radius)
+    # MySQL reads a prefix LIKE as a range scan of the index, whatever the collation of the column.
+    # An upper bound such as cell + "~" would not do: utf8mb4_0900_ai_ci, the MySQL 8 default, sorts
+    # punctuation before digits and letters. Geohashes never contain the wildcards "%" and "_".
+    in_cells = db.or_(*[Scooter.geohash.like(cell + "%") for cell in cells])
+    found = []
+    for scooter in Scooter.query.filter(Scooter.status == status, in_cells):
+        distance = geohash.distance(latitude, longitude, scooter.latitude, scooter.longitude)
+        if distance <= radius:
+            found.append((distance, scooter))
+    found.sort(key=lambda pair: pair[0])
+    return found
+
+
+def scooters_near(latitude, longitude, radius=None, k=NEAR_LIMIT, status=ScooterStatus.AVAILABLE.value):
+    """
+    Find the scooters closest to a point.
+
+    Without a radius this is a k-nearest search: the search radius grows until k
+    scooters are found or NEAR_MAX_RADIUS is reached.
+
+    Args:
+        latitude (float): latitude of the point.
+        longitude (float): longitude of the point.
+        radius (float, optional): only scooters within this many meters. Defaults to None.
+        k (int, optional): the most scooters returned. Defaults to NEAR_LIMIT.
+        status (str, optional): status of the scooters. Defaults to available.
+
+    Raises:
+        ValueError: If the point, radius or k is out of range.
+
+    Returns:
+        list: the scooters as JSON with their "distance" in meters, closest first.
+    """
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError("Latitude must be between -90 and 90 and longitude between -180 and 180")
+    if radius is not None and not 0 < radius <= NEAR_MAX_RADIUS:
+        raise ValueError(f"Radius must be between 0 and {NEAR_MAX_RADIUS} meters")
+    if not 0 < k <= NEAR_MAX_LIMIT:
+        raise ValueError(f"k must be between 1 and {NEAR_MAX_LIMIT}")
+
+    search_radius = radius if radius is not None else NEAR_RADIUS
+    while True:
+        found = scooters_within(latitude, longitude, search_radius, status)
+        # Every scooter within the search radius was found, so the k closest are among them
+        if radius is not None or len(found) >= k or search_radius >= NEAR_MAX_RADIUS:
+            break
+        search_radius = min(search_radius * 4, NEAR_MAX_RADIUS)
+
+    return [dict(scooter.as_json(), distance=round(distance, 1)) for distance, scooter in found[:k]]
+
+
+def top_up(user_id, amount, idempotency_key=None):
+    """
+    Add money to the balance of a user and record the transaction, in one transaction.
+
+    The balance is incremented by the database, so concurrent top-ups and charges of
+    the same user cannot overwrite each other. A retry carrying the idempotency key of
+    an earlier top-up returns the result of that top-up instead of charging again.
+
+    Args:
+        user_id (int): The ID of the user.
+        amount (float): The amount added, positive.
+        idempotency_key (str, optional): chosen by the client, the same for every attempt
+            of one top-up. Defaults to None.
+
+    Raises:
+        ValueError: If the amount is not positive, the user does not exist, the key was
+            used for a top-up of another amount or the transaction breaks a constraint
+            other than the idempotency key.
+
+    Returns:
+        dict: the new balance, the ID of the transaction and whether it was a replay.
+    """
+    if amount <= 0:
+        raise ValueError("Amount must be positive")
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= 64:
+        raise ValueError("Idempotency key must be 1 to 64 characters")
+
+    if idempotency_key is not None:
+        replay = replayed_top_up(user_id, amount, idempotency_key)
+        if replay:
+            return replay
+
+    try:
+        result = db.session.execute(db.update(User).where(User.id == user_id).values(balance=User.balance + amount))
+        if result.rowcount == 0:
+            raise ValueError("User not found")
+        transaction = Transaction(user_id=user_id, amount=amount, idempotency_key=idempotency_key)
+        db.session.add(transaction)
+        db.session.flush()
+        balance = db.session.scalar(db.select(User.balance).where(User.id == user_id))
+        db.session.commit()
+    except IntegrityError as error:
+        db.session.rollback()
+        # A concurrent attempt with the same key committed first
+        replay = replayed_top_up(user_id, amount, idempotency_key) if idempotency_key is not None else None
+        if replay is None:
+            # Another constraint failed, there is no earlier top-up to return
+            raise ValueError("Top-up could not be recorded") from error
+        return replay
+    except Exception:
+        db.session.rollback()
+        raise
+    return {"new_balance": balance, "transaction_id": transaction.id, "replayed": False}
+
+
+def replayed_top_up(user_id, amount, idempotency_key):
+    "The result of the top-up made earlier with an idempotency key, None if there was none."
+    transaction = Transaction.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first()
+    if transaction is None:
+        return None
+    # Amounts are stored as FLOAT, compare them to the cent
+    if round(transaction.amount, 2) != round(amount, 2):
+        raise ValueError("Idempotency key already used for a different amount")
+    balance = db.session.scalar(db.select(User.balance).where(User.id == user_id))
+    return {"new_balance": balance, "transaction_id": transaction.id, "replayed": True}
@@ -1,10 +1,22 @@
 """
 Main Module for Running Flask Master and Agent Applications in Separate Threads.
+
+Usage:
+    python main.py [--server {threaded,async}]
+    python main.py migrate [--seed]
 """
+import argparse
+import logging
 import threading
+from flask import Flask
+from database.database_manager import init_db
+from database.migrations import migrate
+from database.seed import seed_data
 from web.app import create_master_app
+from comms.async_server import AsyncServer
 from comms.server import Server
-from constants import PUBLIC_HOST, MASTER_PORT
+from log_config import setup_logging
+from constants import PUBLIC_HOST, MASTER_PORT, AACR_HOST, AACR_PORT, AACR_WORKERS, AACR_QUEUE_SIZE, AACR_BACKLOG
 
 
 def run_master(master):
@@ -12,8 +24,42 @@ def run_master(master):
     master.run(host=PUBLIC_HOST, port=MASTER_PORT, debug=False, threaded=True)
 
 
+def run_migrations(seed):
+    "Upgrade the database schema to the latest version, then optionally seed the demo data."
+    # A bare app, the master app refuses to start on a database that is not migrated
+    app = Flask(__name__)
+    init_db(app, testing=False)
+    with app.app_context():
+        applied = migrate()
+        logging.getLogger(__name__).info("Database migrated", extra={"applied": applied})
+        if seed:
+            seed_data()
+
+
+def create_server(kind):
+    "Create the AACR server, either thread based or asyncio based."
+    if kind == "async":
+        return AsyncServer(AACR_HOST, AACR_PORT, workers=AACR_WORKERS)
+    return Server(AACR_HOST, AACR_PORT, workers=AACR_WORKERS, queue_size=AACR_QUEUE_SIZE, backlog=AACR_BACKLOG)
+
+
 if __name__ == '__main__':
-    server = Server("127.0.0.1", 54321)
+    parser = argparse.ArgumentParser(description="Run the master Flask application and AACR server.")
+    parser.add_argument("command", nargs="?", choices=["serve", "migrate"], default="serve",
+                        help="serve the master (default) or migrate the database schema")
+    parser.add_argument("--server", choices=["threaded", "async"], default="threaded",
+                        help="AACR server implementation (default: threaded)")
+    parser.add_argument("--seed", action="store_true", help="with migrate, add the demo data to empty tables")
+    args = parser.parse_args()
+
+    # Log from a background thread, before anything else starts logging
+    setup_logging()
+
+    if args.command == "migrate":
+        run_migrations(args.seed)
+        raise SystemExit(0)
+
+    server = create_server(args.server)
 
     app = create_master_app()
     master_thread = threading.Thread(target=run_master, args=(app,))
@@ -0,0 +1,154 @@
+"""
+Scooter Address Enrichment
+
+Keeps the street address of every scooter in its address column, so the admin pages
+read addresses from the database instead of geocoding on the request path.
+
+Every commit that adds a scooter or moves one further than ADDRESS_REFRESH_DISTANCE
+meters from where its address was resolved queues the scooter for a background
+thread, which geocodes it and stores the address. Scooters moving less keep their
+address, a scooter parked in the same street is not geocoded again. At startup the
+thread also goes through the scooters left without an up to date address, such as
+those moved by another process or written before the address column existed.
+"""
+import logging
+import os
+import queue
+import threading
+
+from sqlalchemy import event, or_
+
+from comms import helpers
+from database import geohash
+from database.database_manager import RoutingSession, db, in_unit_of_work
+from database.models import Scooter
+
+ADDRESS_REFRESH_DISTANCE = float(os.getenv("ADDRESS_REFRESH_DISTANCE", 50))  # meters
+ADDRESS_BATCH = 100  # Scooters geocoded together
+
+logger = logging.getLogger(__name__)
+
+
+def needs_address(scooter) -> bool:
+    "Whether the scooter has no address or has moved too far from where its address was resolved."
+    if scooter.latitude is None or scooter.longitude is None:
+        return False
+    if scooter.address is None or scooter.address_latitude is None or scooter.address_longitude is None:
+        return True
+    return geohash.distance(float(scooter.latitude), float(scooter.longitude),
+                            scooter.address_latitude, scooter.address_longitude) > ADDRESS_REFRESH_DISTANCE
+
+
+def enrich(scooter_ids) -> int:
+    """
+    Resolves and stores the street address of the scooters that need one, in one commit.
+
+    Args:
+        scooter_ids (iterable): the IDs of the scooters.
+
+    Returns:
+        int: the number of addresses stored.
+    """
+    scooters = [scooter for scooter in Scooter.query.filter(Scooter.id.in_(list(scooter_ids)))
+                if needs_address(scooter)]
+    if not scooters:
+        return 0
+
+    positions = [(float(scooter.latitude), float(scooter.longitude)) for scooter in scooters]
+    # No deadline, nobody waits on the worker
+    addresses = helpers.get_street_addresses(positions, deadline=None)
+    stored = 0
+    for scooter, (latitude, longitude), address in zip(scooters, positions, addresses):
+        if address is not None:
+            # Only the address columns are written, a move committed meanwhile is kept and queued again
+            scooter.address = address[:255]
+            scooter.address_latitude = latitude
+            scooter.address_longitude = longitude
+            stored += 1
+    db.session.commit()
+    return stored
+
+
+def unaddressed_scooters() -> list:
+    """
+    Returns:
+        list: the IDs of the scooters without an address or not at the position it was resolved at.
+    """
+    rows = db.session.query(Scooter.id).filter(or_(
+        Scooter.address.is_(None),
+        Scooter.address_latitude.is_(None),
+        Scooter.address_latitude != Scooter.latitude,
+        Scooter.address_longitude != Scooter.longitude,
+    ))
+    return [scooter_id for scooter_id, in rows]
+
+
+class AddressEnricher:
+    """
+    The background thread filling in the addresses of the scooters queued by commits.
+    """
+
+    def __init__(self) -> None:
+        self.queue = queue.Queue()
+        self.thread = None
+        self.app = None
+
+    def start(self, app) -> None:
+        "Starts the thread with the app context of app, then queues the scooters without an address."
+        if self.thread is not None:
+            return
+        self.app = app
+        self.thread = threading.Thread(target=self.run, name="address-enricher", daemon=True)
+        self.thread.start()
+        self.queue.put(None)  # Start with the sweep
+
+    def enqueue(self, scooter_ids) -> None:
+        # Without a running thread, e.g. in tests, addresses are only filled by calling enrich
+        if self.thread is not None:
+            for scooter_id in scooter_ids:
+                self.queue.put(scooter_id)
+
+    def run(self) -> None:
+        while True:
+            batch = {self.queue.get()}
+            while len(batch) < ADDRESS_BATCH and not self.queue.empty():
+                batch.add(self.queue.get_nowait())
+            with self.app.app_context():
+                try:
+                    if None in batch:
+                        batch.discard(None)
+                        batch.update(unaddressed_scooters())
+                    scooter_ids = sorted(batch)
+                    for start in range(0, len(scooter_ids), ADDRESS_BATCH):
+                        enrich(scooter_ids[start:start + ADDRESS_BATCH])
+                except Exception as error:
+                    db.session.rollback()
+                    logger.error("Error while resolving scooter addresses: %s", error)
+                finally:
+                    db.session.remove()
+
+
+address_enricher = AddressEnricher()
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def track_moved_scooters(session, flush_context):
+    moved = {scooter.id for scooter in (*session.new, *session.dirty)
+             if isinstance(scooter, Scooter) and needs_address(scooter)}
+    if moved:
+        session.info.setdefault("moved_scooters", set()).update(moved)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def queue_moved_scooters(session):
+    if in_unit_of_work(session):
+        return
+    # After the commit, so the worker reads the new position
+    address_enricher.enqueue(session.info.pop("moved_scooters", ()))
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def forget_moved_scooters(session):
+    if in_unit_of_work(session):
+        return
+    session.info.pop("moved_scooters", None)
@@ -1,13 +1,20 @@
 """
 Blueprint for Admin Routes
 
+The routes read and write through the in-process APIs of web.database, each admin
+action in one database transaction, instead of calling the HTTP API of this same
+process.
 """
-import requests
-from requests.exceptions import RequestException
+import logging
 from flask import Blueprint, request, jsonify
 from comms import helpers
-from database.models import RepairStatus, UserType, BookingState, ScooterStatus
+from database.database_manager import replica_reads
+from database.models import UserType, BookingState
 from comms.utils import message_scooter
+from web.database.bookings import BookingAPI
+from web.database.repairs import RepairAPI
+from web.database.scooters import ScooterAPI
+from web.database.users import UserAPI
 
 import os
 from dotenv import load_dotenv
@@ -15,11 +22,12 @@ from dotenv import load_dotenv
 # Load environment variables from the .env file
 load_dotenv()
 
-API_BASE_URL = "http://localhost:5000"
-
 admin = Blueprint("admin", __name__)
 
+logger = logging.getLogger(__name__)
+
 @admin.route("/data")
+@replica_reads
 def home():
     """
     Display the admin home page.
@@ -27,11 +35,13 @@ def home():
     Returns:
         Flask response: The admin home page.
     """
-    scooters = requests.get(f"{API_BASE_URL}/scooters/all", timeout=5).json()
-    customers = requests.get(f"{API_BASE_URL}/user/role/{UserType.CUSTOMER.value}", timeout=5).json()
+    scooters = ScooterAPI.get_all()
+    customers = UserAPI.get_by_role(UserType.CUSTOMER.value)
 
+    # Resolved in the background by web.addresses, no geocoding on the request path
     for scooter in scooters:
-        scooter['location'] = helpers.get_street_address(scooter["latitude"], scooter["longitude"])
+        scooter['location'] = scooter["address"] or \
+            f"Unable to Locate Street Address for ({scooter['latitude']},{scooter['longitude']})"
 
     data = {
         'scooters': scooters,
@@ -50,8 +60,7 @@ def bookings():
         Flask response: The scooter bookings page.
     """
 
-    completed_bookings = requests.get(f"{API_BASE_URL}/bookings/status/{BookingState.COMPLETED.value}",
-                                      timeout=5).json()
+    completed_bookings = BookingAPI.get_by_status(BookingState.COMPLETED.value)
 
     for booking in completed_bookings:
         booking["start_time"] = helpers.convert_time_format(booking["start_time"])
@@ -60,6 +69,7 @@ def bookings():
 
 
 @admin.route("/scooters/usage")
+@replica_reads
 def scooter_usage():
     """
     Display the admin page for scooter usage statistics.
@@ -67,8 +77,7 @@ def scooter_usage():
     Returns:
         Flask response: The scooter usage statistics page.
     """
-    completed_bookings = requests.get(f"{API_BASE_URL}/bookings/status/{BookingState.COMPLETED.value}",
-                                      timeout=5).json()
+    completed_bookings = BookingAPI.get_by_status(BookingState.COMPLETED.value)
     for booking in completed_bookings:
         booking["duration"] = helpers.calculate_duration(booking["start_time"], booking["end_time"])
         booking["start_time"] = helpers.convert_time_format(booking["start_time"])
@@ -87,8 +96,9 @@ def get_customer(user_id):
     Returns:
         str: Rendered template for editing user information.
     """
-    response = requests.get(f"{API_BASE_URL}/user/id/{user_id}", timeout=5)
-    customer = response.json()
+    customer = UserAPI.get_by_id(user_id)
+    if customer is None:
+        return jsonify({"error": "User Not Found"}), 404
 
     return jsonify(customer), 200
 
@@ -101,31 +111,14 @@ def update_customer():
     Returns:
         response: Redirect to the admin home page if successful, or error message with status code 500 if there is an error.
     """
-    try:
-        req = request.get_json()
-        print(req);
-        user_id = req.get('id')
-
-        response = requests.get(f"{API_BASE_URL}/user/id/{user_id}", timeout=5)
-
-        print(response.json())
-
-        if response.status_code == 400:
-            return jsonify({"error": "User Not Found"}), 404
-
-        user = response.json()
-
-        user["first_name"] = req.get('first_name')
-        user["last_name"] = req.get('last_name')
-        user["phone_number"] = req.get('phone_number')
-
-        updated_user = requests.put(f"{API_BASE_URL}/user/{user_id}", json=user, timeout=5).json()
+    req = request.get_json()
 
-        return jsonify(updated_user), 200
+    updated_user = UserAPI.update_details(req.get('id'), req.get('first_name'), req.get('last_name'),
+                                          req.get('phone_number'))
+    if updated_user is None:
+        return jsonify({"error": "User Not Found"}), 404
 
-    except RequestException as error:
-        print(f"Error during API request: {error}")
-        return jsonify({"error": "Internal Server Error"}), 500
+    return jsonify(updated_user), 200
 
 
 @admin.route("/customer/delete/<int:user_id>")
@@ -139,15 +132,10 @@ def delete_customer(user_id):
     Returns:
         response: Redirect to the admin home page if successful, or error message with status code 500 if there is an error.
     """
-    try:
-        # todo: Delete all entries of user in other tables aswell.
+    # todo: Delete all entries of user in other tables aswell.
 
-        requests.delete(f"{API_BASE_URL}/user/{user_id}", timeout=5).json()
-        return jsonify({"message": "Account Deleted!"})
-
-    except RequestException as error:
-        print(f"Error during API request: {error}")
-        return jsonify({"error": "Internal Server Error"}), 500
+    UserAPI.delete(user_id)
+    return jsonify({"message": "Account Deleted!"})
 
 
 @admin.route("/scooter/get/<int:scooter_id>")
@@ -162,17 +150,10 @@ def get_scooter(scooter_id):
         response: Redirect to the admin home page if the deletion is successful.
                  If there is an error, returns a dictionary with an error message and status code 500.
     """
-    try:
-
-        # todo: Delete all upcoming bookings with this scooter
-
-        response = requests.get(f"{API_BASE_URL}/scooter/id/{scooter_id}", timeout=5)
-        scooter = response.json()
-        return jsonify(scooter), 200
-
-    except RequestException as error:
-        print(f"Error during API request: {error}")
-        return jsonify({"error": "Internal Server Error"}), 500
+    scooter = ScooterAPI.get(scooter_id)
+    if scooter is None:
+        return jsonify({"error": "Scooter Not Found"}), 404
+    return jsonify(scooter), 200
 
 
 @admin.route("/scooter/update", methods=['PUT'])
@@ -184,27 +165,21 @@ def scooter_update():
         response: Redirect to the admin home page if the update is successful.
                  If there is an error, returns a dictionary with an error message and status code 500.
     """
-    try:
-        req = request.get_json()
-        scooter_id = req.get('scooter_id')
-        response = requests.get(f"{API_BASE_URL}/scooter/id/{scooter_id}", timeout=5)
-        if response.status_code == 404:
-            return {"error": "Scooter Not Found"}
-
-        scooter = response.json()
-        scooter["colour"] = req.get("colour")
-        scooter["make"] = req.get('make')
-        scooter["cost_per_time"] = float(req.get('cost_per_time'))
-        scooter["remaining_power"] = float(req.get('remaining_power'))
-        scooter["longitude"] = float(req.get('longitude'))
-        scooter["latitude"] = float(req.get('latitude'))
+    req = request.get_json()
+    details = {
+        "colour": req.get("colour"),
+        "make": req.get('make'),
+        "cost_per_time": float(req.get('cost_per_time')),
+        "remaining_power": float(req.get('remaining_power')),
+        "longitude": float(req.get('longitude')),
+        "latitude": float(req.get('latitude')),
+    }
 
-        updated_scooter = requests.put(f"{API_BASE_URL}/scooter/id/{scooter_id}", json=scooter, timeout=5).json()
+    updated_scooter = ScooterAPI.update_details(req.get('scooter_id'), details)
+    if updated_scooter is None:
+        return {"error": "Scooter Not Found"}
 
-        return jsonify(updated_scooter), 200
-    except RequestException as error:
-        print(f"Error during API request: {error}")
-        return jsonify({"error": "Internal Server Error"}), 500
+    return jsonify(updated_scooter), 200
 
 
 @admin.route("/scooter/delete/<int:scooter_id>")
@@ -219,16 +194,10 @@ def delete_scooter(scooter_id):
         response: Redirect to the admin home page if the deletion is successful.
                  If there is an error, returns a dictionary with an error message and status code 500.
     """
-    try:
+    # todo: Delete all upcoming bookings with this scooter
 
-        # todo: Delete all upcoming bookings with this scooter
-
-        requests.delete(f"{API_BASE_URL}/scooter/{scooter_id}", timeout=5).json()
-        return jsonify({"message": "Scooter Deleted!"}), 200
-
-    except RequestException as error:
-        print(f"Error during API request: {error}")
-        return jsonify({"error": "Internal Server Error"}), 500
+    ScooterAPI.delete(scooter_id)
+    return jsonify({"message": "Scooter Deleted!"}), 200
 
 
 @admin.route("/scooter/submit", methods=['POST'])
@@ -249,7 +218,7 @@ def submit_scooter():
         "longitude": req.get('longitude')
     }
 
-    scooter = requests.post(f"{API_BASE_URL}/scooter", json=data, timeout=5).json()
+    scooter = ScooterAPI.create(data)
     return jsonify(scooter), 200
 
 
@@ -261,22 +230,9 @@ def confirm_reports():
     Returns:
         str: Rendered HTML template containing pending repair reports.
     """
-    try:
-        scooters = []
-        repairs = requests.get(f"{API_BASE_URL}/repairs/pending", timeout=5).json()
-        for repair in repairs:
-            response = requests.get(f"{API_BASE_URL}/scooter/id/{repair['scooter_id']}", timeout=5)
-
-            scooter = response.json()
-
-            repair['longitude'] = scooter['longitude']
-            repair['latitude'] = scooter['latitude']
-
-            scooters.append(response.json())
-        return jsonify({'repairs': repairs, 'scooters': scooters}), 200
-    except RequestException as error:
-        print(f"Error during repairs API request: {error}")
-        return jsonify({"error": "Internal Server Error"}), 500
+    # The repairs and their scooters in one query, whatever the size of the backlog
+    pending = RepairAPI.pending_with_scooters()
+    return jsonify({'repairs': pending['repairs'], 'scooters': pending['scooters']}), 200
 
 
 @admin.route("/scooter/report", methods=['POST'])
@@ -287,25 +243,17 @@ def report_scooter():
     Returns:
         Response: Redirects admin to the confirm_reports endpoint after processing the report.
     """
-    try:
-        req = request.get_json()
-        repair_id = req.get('repair_id')
-        data = {"status": RepairStatus.ACTIVE.value}
-        updated_repair = requests.put(f"{API_BASE_URL}/repair/status/{repair_id}", json=data, timeout=5).json()
-
-        data = {"status": ScooterStatus.AWAITING_REPAIR.value}
-
-        scooter = requests.put(f"{API_BASE_URL}/scooter/status/{updated_repair['scooter_id']}", json=data,
-                               timeout=5).json()
+    req = request.get_json()
 
-        # Send notifications to engineers
-        notify_engineers(updated_repair["scooter_id"], updated_repair["report"])
+    # The repair becomes active and its scooter awaits repair in one transaction
+    updated_repair = RepairAPI.report(req.get('repair_id'))
+    if updated_repair is None:
+        return jsonify({"error": "Repair Not Found"}), 404
 
-        return jsonify({'message': 'maintence request sent to engineers.'})
+    # Send notifications to engineers
+    notify_engineers(updated_repair["scooter_id"], updated_repair["report"])
 
-    except RequestException as error:
-        print(f"Error during API request: {error}")
-        return {"error": "Internal Server Error"}, 500
+    return jsonify({'message': 'maintence request sent to engineers.'})
 
 
 @admin.route("/admin/notify/<int:scooter_id>/<string:report>", methods=["GET"])
@@ -313,28 +261,25 @@ def notify_engineers(scooter_id, report):
     """
     Notifies engineers about a reported scooter repair request via email.
     """
-    try:
-
-        scooter = requests.get(f"{API_BASE_URL}/scooter/id/{scooter_id}", timeout=5).json()
-
-        steet_address = helpers.get_street_address(scooter["latitude"], scooter["longitude"])
+    scooter = ScooterAPI.get(scooter_id)
+    if scooter is None:
+        return jsonify({'error': "Scooter Not Found"}), 404
 
-        engineer_emails = requests.get(f"{API_BASE_URL}/users/engineers/emails", timeout=5).json()
+    steet_address = scooter["address"] or \
+        f"Unable to Locate Street Address for ({scooter['latitude']},{scooter['longitude']})"
 
-        email_subject = 'URGENT: Scooter Repair Request'
+    engineer_emails = UserAPI.engineer_emails()
 
-        email_body = helpers.get_email_body(scooter_id, report, steet_address, email_subject)
+    email_subject = 'URGENT: Scooter Repair Request'
 
-        # Send the email
-        # send_email(email_subject, engineer_emails, email_body)
+    email_body = helpers.get_email_body(scooter_id, report, steet_address, email_subject)
 
-        print("Sending Email");
+    # Send the email
+    # send_email(email_subject, engineer_emails, email_body)
 
-        return jsonify({'message': "email sent successfully!"}), 200
+    logger.info("Notifying engineers about scooter %s", scooter_id)
 
-    except RequestException as error:
-        print(str(error))
-        return jsonify({'error': "Email sending failed"}), 500
+    return jsonify({'message': "email sent successfully!"}), 200
 
 
 @admin.route("/scooter/location/<int:scooter_id>", methods=["GET"])
@@ -7,8 +7,11 @@ It initializes the database and registers blueprints for the admin site and data
 """
 from flask import Flask
 from flask_cors import CORS
-from database.database_manager import init_db
+from comms.geocoding import FakeGeocoder, geocode_cache
+from database.database_manager import init_db, is_in_memory
+from database.migrations import check_schema, migrate
 from database.seed import seed_data
+from web.addresses import address_enricher
 from web.admin_site import admin
 from web.database.faces import face_api
 from web.database.users import users_api
@@ -17,6 +20,7 @@ from web.database.bookings import booking_api
 from web.database.repairs import repairs_api
 from web.database.transactions import transaction_api
 from web.mail import init_mail
+from web.metrics import metrics_api
 
 def create_master_app(testing=False):
     """
@@ -33,10 +37,20 @@ def create_master_app(testing=False):
     
     init_db(app, testing)
     init_mail(app)
+    if testing:
+        # Tests never reach Google, and start without the addresses of the previous one
+        geocode_cache.reset(FakeGeocoder())
    
     with app.app_context():
-        if not testing:
+        if is_in_memory(testing) and not testing:
+            # Nothing persists between runs, build and fill the database on every start
+            migrate()
             seed_data()
+        elif not testing:
+            # One query, the schema is upgraded and seeded by "python main.py migrate"
+            check_schema()
+    if not testing:
+        address_enricher.start(app)
    
     blueprints = [
         users_api,
@@ -45,6 +59,7 @@ def create_master_app(testing=False):
         booking_api,
         repairs_api,
         transaction_api,
+        metrics_api,
     ]
   
     for blueprint in blueprints:
@@ -1,10 +1,18 @@
 import datetime
 from flask import Blueprint, request, jsonify
 from database.models import Booking, BookingState
-from database.database_manager import db
+from database.database_manager import db, replica_reads
+from web.database.exports import export_response
+from web.database.pagination import list_response
 
 booking_api = Blueprint("booking_api", __name__)
 
+# Orders bookings can be paged in, see web.database.pagination
+BOOKING_ORDERS = {
+    "id": (Booking.id,),
+    "start_time": (Booking.start_time, Booking.id),
+}
+
 
 def parse_datetime(date: str):
     return datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
@@ -15,15 +23,30 @@ def parse_date(date: str):
 
 
 @booking_api.route("/bookings", methods=["GET"])
+@replica_reads
 def get_all():
     """
-    Retrieve all bookings from the database.
+    Retrieve all bookings from the database, or one page of them ordered by
+    id or, with order=start_time, by start time.
+
+    Returns:
+        list: A list of booking objects in JSON format, or a page of them.
+    """
+    return list_response(Booking.query, BOOKING_ORDERS)
+
+
+@booking_api.route("/bookings/export", methods=["GET"])
+def export():
+    """
+    Stream bookings as NDJSON or CSV, optionally only those starting in a date range.
+    See web.database.exports for the query args.
 
     Returns:
-        list: A list of booking objects in JSON format.
+        Response: the bookings, ordered by start time.
     """
-    bookings = Booking.query.all()
-    return [booking.as_json() for booking in bookings]
+    columns = [Booking.id, Booking.user_id, Booking.scooter_id, Booking.date, Booking.start_time,
+               Booking.end_time, Booking.status, Booking.event_id]
+    return export_response("bookings", columns, Booking.start_time)
 
 
 @booking_api.route("/booking/<int:booking_id>", methods=["GET"])
@@ -55,21 +78,7 @@ def post():
     Returns:
         dict: A dictionary representing the newly created booking object in JSON format.
     """
-    data = request.json
-    new_booking = Booking(
-        user_id=data["user_id"],
-        scooter_id=data["scooter_id"],
-        date=parse_date(data["date"]),
-        start_time=parse_datetime(data["start_time"]),
-        end_time=parse_datetime(data["end_time"]),
-        status=data["status"],
-        event_id=data["event_id"]
-    )
-
-    db.session.add(new_booking)
-    db.session.commit()
-
-    return new_booking.as_json()
+    return BookingAPI.create(request.json)
 
 
 @booking_api.route("/booking/id/<int:booking_id>", methods=["PUT"])
@@ -111,14 +120,9 @@ def update_status(booking_id):
     Returns:
         dict: A dictionary representing the updated booking object in JSON format, or None if not found.
     """
-    data = request.json
-    status = data["status"]
-    booking = Booking.query.get(booking_id)
-
+    booking = BookingAPI.update_status(booking_id, request.json["status"])
     if booking:
-        booking.status = status
-        db.session.commit()
-        return booking.as_json()
+        return booking
     else:
         return jsonify({"message": "Booking not found"}), 404
 
@@ -154,17 +158,49 @@ def get_by_user(user_id):
     Returns:
         list: A list of booking objects in JSON format associated with the specified user.
     """
-    bookings = Booking.query.filter_by(user_id=user_id)
-    return [booking.as_json() for booking in bookings]
+    return BookingAPI.get_by_user(user_id)
 
 
 @booking_api.route("/bookings/status/<string:status>", methods=["GET"])
+@replica_reads
 def get_by_status(status):
-    bookings = Booking.query.filter_by(status=status)
-    return [booking.as_json() for booking in bookings]
+    return BookingAPI.get_by_status(status)
 
 
 class BookingAPI:
+    """
+    In-process access to bookings, shared by the blueprint routes and the AACR handlers.
+    """
+
+    def create(data: dict):
+        new_booking = Booking(
+            user_id=data["user_id"],
+            scooter_id=data["scooter_id"],
+            date=parse_date(data["date"]),
+            start_time=parse_datetime(data["start_time"]),
+            end_time=parse_datetime(data["end_time"]),
+            status=data["status"],
+            event_id=data["event_id"]
+        )
+
+        db.session.add(new_booking)
+        db.session.commit()
+
+        return new_booking.as_json()
+
+    def get_by_user(user_id: int):
+        return [booking.as_json() for booking in Booking.query.filter_by(user_id=user_id)]
+
+    def get_by_status(status: str):
+        return [booking.as_json() for booking in Booking.query.filter_by(status=status)]
+
+    def update_status(booking_id: int, status: str):
+        booking = db.session.get(Booking, booking_id)
+        if booking:
+            booking.status = status
+            db.session.commit()
+            return booking.as_json()
+        return None
 
     def get_by_user_and_scooter(user_id: int, scooter_id: int):
         booking = Booking.query.filter_by(
@@ -2,6 +2,7 @@ from flask import Blueprint, jsonify, request
 from database.database_manager import db
 from database.models import Face
 import database.queries as queries
+from web.database.pagination import list_response
 
 
 face_api = Blueprint("face_api", __name__)
@@ -35,13 +36,12 @@ def post():
 @face_api.route("/face/all", methods=["GET"])
 def get_all():
     """
-    Get a list of all faces.
+    Get a list of all faces, or one page of them ordered by id.
 
     Returns:
-        JSON response with a list of all face objects.
+        JSON response with a list of all face objects, or a page of them.
     """
-    faces = Face.query.all()
-    return [face.as_json() for face in faces]
+    return list_response(Face.query, {"id": (Face.id,)})
 
 @face_api.route("/face/del", methods=["DELETE"])
 def del_all():
@@ -0,0 +1,106 @@
+"""
+Keyset Pagination
+
+The list endpoints return their whole table when called without parameters. With a
+"limit" and/or a "cursor" query arg they return one page instead:
+
+    {"items": [...], "next_cursor": "eyJvIjoiaWQiLCJrIjpbNTBdfQ", "limit": 50}
+
+A page is the rows after the last row of the previous page in a fixed order, found
+with a WHERE on the ordering columns, so every page costs one index range scan no
+matter how deep it is. The cursor is opaque to clients: pass the next_cursor of a
+page to get the following one, next_cursor is null on the last page.
+"""
+import base64
+import binascii
+import datetime
+import json
+
+from flask import jsonify, request
+from sqlalchemy import DateTime, and_, or_
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+def list_response(query, orders: dict):
+    """
+    Serves a list endpoint, whole or one page at a time.
+
+    Args:
+        query (Query): the rows of the list.
+        orders (dict): the orders a client may page in ("order" query arg), by name, as
+            the columns rows are sorted by, ending with a unique one. The first is the default.
+
+    Returns:
+        The JSON of every row without pagination args, otherwise a page envelope, or an
+        error message with a 400 status.
+    """
+    if "limit" not in request.args and "cursor" not in request.args:
+        return [row.as_json() for row in query.all()]
+
+    order = request.args.get("order", next(iter(orders)))
+    limit = request.args.get("limit", DEFAULT_LIMIT, type=int)
+    if order not in orders:
+        return jsonify({"message": f"Invalid order, expected one of {sorted(orders)}"}), 400
+    if limit is None or not 0 < limit <= MAX_LIMIT:
+        return jsonify({"message": f"Limit must be between 1 and {MAX_LIMIT}"}), 400
+
+    try:
+        rows, next_cursor = keyset_page(query, order, orders[order], limit, request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return {"items": [row.as_json() for row in rows], "next_cursor": next_cursor, "limit": limit}
+
+
+def keyset_page(query, order: str, columns, limit: int, cursor: str = None):
+    """
+    Fetches the page of a query that follows a cursor.
+
+    Args:
+        query (Query): the rows to page through.
+        order (str): the name of the order, recorded in the cursors.
+        columns (tuple): the columns rows are sorted by, the last one unique.
+        limit (int): rows per page.
+        cursor (str, optional): the next_cursor of the previous page. Defaults to the first page.
+
+    Raises:
+        ValueError: If the cursor is malformed or from another order.
+
+    Returns:
+        (list, str): the rows of the page and the cursor of the next one, None on the last page.
+    """
+    if cursor:
+        query = query.filter(after(columns, decode_cursor(cursor, order, columns)))
+    # One row more than the page tells whether there is a next page
+    rows = query.order_by(*columns).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(order, [getattr(rows[-1], column.key) for column in columns])
+
+
+def after(columns, values):
+    "The condition of the rows sorted after values, (a, b) > (x, y) as a > x OR (a = x AND b > y)."
+    conditions = []
+    for index, column in enumerate(columns):
+        equal = [columns[i] == values[i] for i in range(index)]
+        conditions.append(and_(*equal, column > values[index]))
+    return or_(*conditions)
+
+
+def encode_cursor(order: str, values: list) -> str:
+    values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+    data = json.dumps({"o": order, "k": values}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, order: str, columns) -> list:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if data["o"] != order or len(data["k"]) != len(columns):
+            raise ValueError("Cursor of another order")
+        return [datetime.datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+                for column, value in zip(columns, data["k"])]
+    except (binascii.Error, UnicodeDecodeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
@@ -1,18 +1,21 @@
 from flask import Blueprint, jsonify, request
 from database.models import Repairs, RepairStatus
-from database.database_manager import db
+from database.database_manager import db, replica_reads
+import database.queries as queries
+from web.database.pagination import list_response
 
 repairs_api = Blueprint("repairs_api", __name__)
 
 @repairs_api.route("/repairs/all", methods=["GET"])
+@replica_reads
 def get_all():
     """
-    Get a list of all repair records.
+    Get a list of all repair records, or one page of them ordered by id.
 
     Returns:
-        JSON response with a list of repair records or an error message if no records are found.
+        JSON response with a list of repair records, or a page of them.
     """
-    return [repair.as_json() for repair in Repairs.query.all()]
+    return list_response(Repairs.query, {"id": (Repairs.id,)})
 
 @repairs_api.route("/repair/<int:repair_id>", methods=["GET"])
 def get(repair_id):
@@ -66,15 +69,7 @@ def post():
     if not all(key in data for key in ("scooter_id", "report", "status")):
         return jsonify({"error": "Invalid data format"}), 400
     
-    new_repair = Repairs(
-        scooter_id=data["scooter_id"],
-        report=data["report"],
-        status=data["status"]
-    )
-
-    db.session.add(new_repair)
-    db.session.commit()
-    return new_repair.as_json()
+    return RepairAPI.create(data)
 
 @repairs_api.route("/repair/id/<int:repair_id>", methods=["PUT"])
 def update(repair_id):
@@ -143,6 +138,17 @@ def get_pending_repairs():
 
     return result
 
+@repairs_api.route("/repairs/pending/scooters", methods=["GET"])
+def get_pending_repairs_with_scooters():
+    """
+    Get the pending repair records together with their scooters, in one query.
+
+    Returns:
+        JSON response with the pending repairs, including the longitude and latitude of their
+        scooter, and the scooter of each repair.
+    """
+    return RepairAPI.pending_with_scooters()
+
 @repairs_api.route("/repair/status/<int:repair_id>", methods=["PUT"])
 def update_status(repair_id):
     """
@@ -154,12 +160,39 @@ def update_status(repair_id):
     Returns:
         JSON response with the updated repair record or an error message if the record could not be updated.
     """
-    data = request.json
-    repair = Repairs.query.get(repair_id)
+    repair = RepairAPI.update_status(repair_id, request.json["status"])
     if repair:
-        repair.status = data["status"]
+        return repair
+    else:
+        return jsonify({"message": "Repair not found"}), 404
 
+
+class RepairAPI:
+    """
+    In-process access to repairs, shared by the blueprint routes and the AACR handlers.
+    """
+
+    def create(data: dict):
+        new_repair = Repairs(
+            scooter_id=data["scooter_id"],
+            report=data["report"],
+            status=data["status"]
+        )
+
+        db.session.add(new_repair)
         db.session.commit()
-        return repair.as_json()
-    else:
-        return jsonify({"message": "Repair not found"}), 404
\ No newline at end of file
+        return new_repair.as_json()
+
+    def update_status(repair_id: int, status: str):
+        repair = db.session.get(Repairs, repair_id)
+        if repair:
+            repair.status = status
+            db.session.commit()
+            return repair.as_json()
+        return None
+
+    def pending_with_scooters():
+        return queries.pending_repairs_with_scooters()
+
+    def report(repair_id: int):
+        return queries.report_repair(repair_id)
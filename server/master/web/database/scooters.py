@@ -1,7 +1,8 @@
 from flask import Blueprint, jsonify, request
-from database.database_manager import db
+from database.database_manager import db, replica_reads
 from database.models import Scooter, ScooterStatus, Repairs, Booking
 import database.queries as queries
+from web.database.pagination import list_response
 
 scooter_api = Blueprint("scooter_api", __name__)
 
@@ -21,41 +22,18 @@ def post():
     
 
     
-    make = data['make']
-    longitude = data['longitude']
-    latitude = data['latitude']
-    remaining_power = 100.0
-    cost_per_time = data['cost_per_time']
-    colour = data['colour']
-    status = ScooterStatus.AVAILABLE.value
-
-    # Create a new scooter object
-    new_scooter = Scooter(
-        make=make,
-        longitude=longitude,
-        latitude=latitude,
-        remaining_power=remaining_power,
-        cost_per_time=cost_per_time,
-        status=status,
-        colour=colour
-    )
-
-    # Add the new scooter to the database
-    db.session.add(new_scooter)
-    db.session.commit()
-
-    return new_scooter.as_json(), 201
+    return ScooterAPI.create(data), 201
 
 @scooter_api.route("/scooters/all", methods=["GET"])
+@replica_reads
 def get_all():
     """
-    Get a list of all scooters.
+    Get a list of all scooters, or one page of them ordered by id.
 
     Returns:
-        JSON response with a list of all scooter objects.
+        JSON response with a list of all scooter objects, or a page of them.
     """
-    scooters = Scooter.query.all()
-    return [scooter.as_json() for scooter in scooters]
+    return list_response(Scooter.query, {"id": (Scooter.id,)})
 
 @scooter_api.route("/scooter/id/<int:scooter_id>", methods=["GET"])
 def get(scooter_id):
@@ -68,13 +46,14 @@ def get(scooter_id):
     Returns:
         JSON response with the scooter object or a "Scooter not found" message.
     """
-    scooter = Scooter.query.get(scooter_id)
+    scooter = ScooterAPI.get(scooter_id)
     if scooter:
-        return scooter.as_json()
+        return scooter
     else:
         return jsonify({'message': 'Scooter not found'}), 404
 
 @scooter_api.route("/scooters/status/<string:status>", methods=["GET"])
+@replica_reads
 def get_by_status(status):
     """
     Get a list of scooters by their status.
@@ -89,12 +68,37 @@ def get_by_status(status):
         
         return jsonify({'message': 'Invalid status provided'}), 400
 
-    scooters = Scooter.query.filter_by(status=status).all()
-    if scooters:
-        
-        return [scooter.as_json() for scooter in scooters]
-    else:
-        return []
+    return ScooterAPI.get_by_status(status)
+
+@scooter_api.route("/scooters/near", methods=["GET"])
+def get_near():
+    """
+    Get the scooters closest to a point, closest first.
+
+    Query args:
+        latitude (float): latitude of the point.
+        longitude (float): longitude of the point.
+        radius (float, optional): only scooters within this many meters.
+        k (int, optional): the most scooters returned.
+        status (str, optional): status of the scooters, available by default.
+
+    Returns:
+        JSON response with a list of scooters and their distance in meters or an error message.
+    """
+    latitude = request.args.get("latitude", type=float)
+    longitude = request.args.get("longitude", type=float)
+    radius = request.args.get("radius", type=float)
+    k = request.args.get("k", queries.NEAR_LIMIT, type=int)
+    status = request.args.get("status", ScooterStatus.AVAILABLE.value)
+    if latitude is None or longitude is None:
+        return jsonify({'message': 'Latitude and longitude are required'}), 400
+    if status not in [status.value for status in ScooterStatus]:
+        return jsonify({'message': 'Invalid status provided'}), 400
+
+    try:
+        return ScooterAPI.near(latitude, longitude, radius, k, status)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
 
 @scooter_api.route("/scooter/id/<int:scooter_id>", methods=["PUT"])
 def update(scooter_id):
@@ -134,17 +138,15 @@ def update_status(scooter_id):
     Returns:
         JSON response with the updated scooter object or a "Scooter not found" message.
     """
-    scooter = Scooter.query.get(scooter_id)
     data = request.json
     
     # Validate the 'status' field against ScooterStatus enum
     if 'status' in data and data['status'] not in [status.value for status in ScooterStatus]:
         return jsonify({'message': 'Invalid status provided'}), 400
+
+    scooter = ScooterAPI.update_status(scooter_id, data["status"])
     if scooter:
-        scooter.status = data["status"]
-        db.session.commit()
-        return scooter.as_json()
-     
+        return scooter
     else:
         return jsonify({"message": "Scooter not found"}), 404
 
@@ -159,12 +161,7 @@ def delete(scooter_id):
     Returns:
         JSON response with the deleted scooter object or a "Scooter not found" message.
     """
-    scooter = Scooter.query.get(scooter_id)
-    if scooter:
-        Booking.query.filter_by(scooter_id=scooter_id).delete()
-        Repairs.query.filter_by(scooter_id=scooter_id).delete()
-        db.session.delete(scooter)
-        db.session.commit()
+    if ScooterAPI.delete(scooter_id):
         return jsonify({'message': 'Scooter deleted successfully'})
     else:
         return jsonify({'message': 'Scooter not found'}), 404
@@ -196,14 +193,60 @@ def scooter_fixed(scooter_id, repair_id):
 
 
 class ScooterAPI:
+    """
+    In-process access to scooters, shared by the blueprint routes and the AACR handlers.
+    Every method returns plain JSON-ready dictionaries, or None when the scooter does not exist.
+    """
+
     def get(scooter_id: int):
-        scooter = Scooter.query.get(scooter_id)
+        scooter = db.session.get(Scooter, scooter_id)
+        return scooter.as_json() if scooter else None
+
+    def get_all():
+        return [scooter.as_json() for scooter in Scooter.query.all()]
+
+    def create(data: dict):
+        new_scooter = Scooter(
+            make=data["make"],
+            longitude=data["longitude"],
+            latitude=data["latitude"],
+            remaining_power=100.0,
+            cost_per_time=data["cost_per_time"],
+            status=ScooterStatus.AVAILABLE.value,
+            colour=data["colour"]
+        )
+
+        db.session.add(new_scooter)
+        db.session.commit()
+        return new_scooter.as_json()
+
+    def delete(scooter_id: int) -> bool:
+        scooter = db.session.get(Scooter, scooter_id)
+        if scooter:
+            Booking.query.filter_by(scooter_id=scooter_id).delete()
+            Repairs.query.filter_by(scooter_id=scooter_id).delete()
+            db.session.delete(scooter)
+            db.session.commit()
+            return True
+        return False
+
+    def get_by_status(status: str):
+        return [scooter.as_json() for scooter in Scooter.query.filter_by(status=status).all()]
+
+    def near(latitude: float, longitude: float, radius: float = None, k: int = queries.NEAR_LIMIT,
+             status: str = ScooterStatus.AVAILABLE.value):
+        return queries.scooters_near(latitude, longitude, radius, k, status)
+
+    def update_status(scooter_id: int, status: str):
+        scooter = db.session.get(Scooter, scooter_id)
         if scooter:
+            scooter.status = status
+            db.session.commit()
             return scooter.as_json()
-        else:
-            return jsonify({'message': 'Scooter not found'}), 404
+        return None
+
     def update(scooter_id: int, updated_scooter: dict):
-        scooter = Scooter.query.get(scooter_id)
+        scooter = db.session.get(Scooter, scooter_id)
         if scooter:
             scooter.make = updated_scooter["make"]
             scooter.longitude = updated_scooter["longitude"]
@@ -215,3 +258,16 @@ class ScooterAPI:
             db.session.commit()
             return scooter.as_json()
 
+    def update_details(scooter_id: int, details: dict):
+        "Updates the details an admin edits, leaving the status to the rides and repairs."
+        scooter = db.session.get(Scooter, scooter_id)
+        if scooter:
+            scooter.make = details["make"]
+            scooter.colour = details["colour"]
+            scooter.cost_per_time = details["cost_per_time"]
+            scooter.remaining_power = details["remaining_power"]
+            scooter.longitude = details["longitude"]
+            scooter.latitude = details["latitude"]
+            db.session.commit()
+            return scooter.as_json()
+        return None
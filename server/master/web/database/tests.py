@@ -1,9 +1,21 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
 import unittest
 from datetime import datetime
+from comms.codecs import CODEC_CBOR, CODEC_MSGPACK, CODEC_NAMES, CODECS, encode
+from comms.framing import encode_frame, read_message, write_message
 from database.database_manager import db
 from web.app import create_master_app
 from database.models import Booking, User, UserType, Scooter, ScooterStatus, Repairs, RepairStatus, Transaction
 
+# The AACR client of the public gateway, to talk to the servers over sockets
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "public"))
+from common.client import Client, ClientPool  # noqa: E402
+
 class APITestCase(unittest.TestCase):
     """
     Test case for the booking API endpoints.
@@ -65,10 +77,33 @@ class APITestCase(unittest.TestCase):
         Test the endpoint for retrieving all bookings from the database.
         """  
         response = self.client.get('/bookings')
-        
+
         expected_data = []
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json, expected_data)
+
+    def test_get_bookings_paginated_by_start_time(self):
+        # Two bookings share a start time, the id breaks the tie
+        start_times = [datetime(2023, 9, 29, 14), datetime(2023, 9, 29, 12), datetime(2023, 9, 29, 13),
+                       datetime(2023, 9, 29, 12)]
+        db.session.add_all([Booking(user_id=1, scooter_id=1, date=datetime(2023, 9, 29), start_time=start,
+                                    end_time=start, status="active", event_id=1) for start in start_times])
+        db.session.commit()
+
+        ids = []
+        cursor = None
+        while True:
+            url = '/bookings?order=start_time&limit=3' + (f'&cursor={cursor}' if cursor else '')
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [booking['id'] for booking in response.json['items']]
+            cursor = response.json['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(ids, [2, 4, 3, 1])
+
+        self.assertEqual(self.client.get('/bookings?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/bookings?cursor=not-a-cursor').status_code, 400)
      
     def test_get_booking_by_id_successful(self):
         """
@@ -566,6 +601,33 @@ class APITestCase(unittest.TestCase):
         response = self.client.get('/scooters/status/INVALID_STATUS')
         self.assertEqual(response.status_code, 400)
 
+    def test_get_scooters_near(self):
+        # About 100 m, 1 km and 20 km from the point searched, and one close but occupied
+        scooters = [
+            Scooter(make='Near', longitude=144.9631, latitude=-37.8127, remaining_power=100.0,
+                    cost_per_time=5.0, status=ScooterStatus.AVAILABLE.value, colour='Red'),
+            Scooter(make='Middle', longitude=144.9631, latitude=-37.8046, remaining_power=100.0,
+                    cost_per_time=5.0, status=ScooterStatus.AVAILABLE.value, colour='Red'),
+            Scooter(make='Far', longitude=144.9631, latitude=-37.6336, remaining_power=100.0,
+                    cost_per_time=5.0, status=ScooterStatus.AVAILABLE.value, colour='Red'),
+            Scooter(make='Occupied', longitude=144.9631, latitude=-37.8135, remaining_power=100.0,
+                    cost_per_time=5.0, status=ScooterStatus.OCCUPYING.value, colour='Red'),
+        ]
+        db.session.add_all(scooters)
+        db.session.commit()
+
+        response = self.client.get('/scooters/near?latitude=-37.8136&longitude=144.9631&radius=2000')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([scooter['make'] for scooter in response.json], ['Near', 'Middle'])
+        self.assertLess(response.json[0]['distance'], response.json[1]['distance'])
+
+        # Without a radius the search widens until k scooters are found
+        response = self.client.get('/scooters/near?latitude=-37.8136&longitude=144.9631&k=3')
+        self.assertEqual([scooter['make'] for scooter in response.json], ['Near', 'Middle', 'Far'])
+
+        response = self.client.get('/scooters/near?latitude=-37.8136')
+        self.assertEqual(response.status_code, 400)
+
     def test_update_scooter_successful(self):
         original_scooter_data = {
             'make': 'ScooterX',
@@ -914,4 +976,904 @@ class APITestCase(unittest.TestCase):
         response = self.client.get('/transactions/user/1')
         expected_data = []
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json, expected_data)
\ No newline at end of file
+        self.assertEqual(response.json, expected_data)
+
+    def test_export_transactions_in_date_range(self):
+        db.session.add_all([
+            Transaction(user_id=1, amount=100, created_at=datetime(2023, 8, 31, 23, 59)),
+            Transaction(user_id=1, amount=200, created_at=datetime(2023, 9, 1)),
+            Transaction(user_id=2, amount=300, created_at=datetime(2023, 9, 30, 12)),
+            Transaction(user_id=2, amount=400, created_at=datetime(2023, 10, 1)),
+        ])
+        db.session.commit()
+
+        response = self.client.get('/transactions/export?format=csv&from=2023-09-01&to=2023-10-01')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode().splitlines(), [
+            'id,user_id,amount,created_at',
+            '2,1,200.0,2023-09-01T00:00:00',
+            '3,2,300.0,2023-09-30T12:00:00',
+        ])
+
+        response = self.client.get('/transactions/export?to=2023-09-01')
+        self.assertEqual(response.data.decode().splitlines(),
+                         ['{"id": 1, "user_id": 1, "amount": 100.0, "created_at": "2023-08-31T23:59:00"}'])
+
+    def test_export_reads_from_a_replica(self):
+        """
+        Test that an export streams its rows from a replica without leaving the reads of the
+        code iterating it routed to one.
+        """
+        import tempfile
+        from unittest import mock
+        from sqlalchemy import create_engine, select
+        import database.database_manager as database_manager
+        from web.database.exports import stream_rows, write_csv
+
+        replica = create_engine(f"sqlite:///{tempfile.mkdtemp()}/replica.db")
+        self.addCleanup(replica.dispose)
+        db.metadata.create_all(replica)
+        for engine, amount in ((db.engine, 100), (replica, 50)):
+            with engine.begin() as connection:
+                connection.execute(Transaction.__table__.insert(),
+                                   [{"user_id": 1, "amount": amount, "created_at": datetime(2023, 9, 1)}])
+        db.engines["replica0"] = replica
+        self.addCleanup(db.engines.pop, "replica0")
+
+        with mock.patch.object(database_manager, "replica_binds", ["replica0"]):
+            rows = stream_rows(select(Transaction.id, Transaction.amount), ["id", "amount"], write_csv, header=True)
+            self.assertEqual(next(rows), "id,amount\n")
+            # Nothing routes the reads of whoever iterates the export to a replica between yields
+            self.assertFalse(database_manager.use_replica.get())
+            self.assertEqual(list(rows), ["1,50.0\n"])
+
+    # AACR Batch Unit Tests
+    def test_transactional_batch_rolls_back(self):
+        """
+        Test that a transactional batch undoes every change when one of its requests fails.
+        """
+        from comms.batch import execute_batch
+
+        booking = Booking(user_id=1, scooter_id=1, date=datetime(2023, 9, 29), start_time=datetime(2023, 9, 29, 12, 0), end_time=datetime(2023, 9, 29, 12, 30), status="active", event_id=1)
+        scooter = Scooter(make="Xiaomi", longitude=0.0, latitude=0.0, remaining_power=100.0, cost_per_time=10.0, status=ScooterStatus.OCCUPYING.value, colour="black")
+        db.session.add_all([booking, scooter])
+        db.session.commit()
+
+        response = execute_batch({
+            "method": "BATCH",
+            "transaction": True,
+            "requests": [
+                {"method": "UPDATE", "uri": "/booking/cancel", "params": {"booking_id": 1}},
+                {"method": "POST", "uri": "/scooter/damaged", "params": {"scooter_id": 2, "report": "Flat tyre"}}
+            ]
+        })
+
+        self.assertIn("error", response)
+        self.assertEqual(len(response["results"]), 2)
+        self.assertEqual(db.session.get(Booking, 1).status, "active")
+        self.assertEqual(db.session.get(Scooter, 1).status, ScooterStatus.OCCUPYING.value)
+        self.assertEqual(Repairs.query.count(), 0)
+
+    def test_settle_ride_charges_in_one_transaction(self):
+        """
+        Test that ending a ride completes the booking, frees the scooter and charges the user together.
+        """
+        from datetime import timedelta
+        import database.queries as queries
+
+        user = User(username="rider", password="password", email="rider@example.com", first_name="Ride",
+                    last_name="R", balance=50.0)
+        scooter = Scooter(make="Xiaomi", longitude=0.0, latitude=0.0, remaining_power=100.0, cost_per_time=60.0,
+                          status=ScooterStatus.OCCUPYING.value, colour="black")
+        start = datetime.now() - timedelta(minutes=30)
+        booking = Booking(user_id=1, scooter_id=1, date=start, start_time=start, end_time=start, status="active",
+                          event_id=1)
+        db.session.add_all([user, scooter, booking])
+        db.session.commit()
+
+        ride = queries.settle_ride(1, 1, -37.81, 144.96)
+
+        self.assertAlmostEqual(ride["cost"], 30.0, places=1)
+        self.assertAlmostEqual(ride["balance"], 50.0 - ride["cost"])
+        self.assertEqual(db.session.get(Booking, 1).status, "completed")
+        self.assertEqual(db.session.get(Scooter, 1).status, ScooterStatus.AVAILABLE.value)
+        self.assertEqual(db.session.get(Scooter, 1).latitude, -37.81)
+        self.assertEqual(Transaction.query.one().amount, ride["cost"])
+        with self.assertRaises(ValueError):
+            queries.settle_ride(1, 1, -37.81, 144.96)
+
+    def test_top_up_is_idempotent(self):
+        """
+        Test that retrying a top-up with its idempotency key does not add the money twice.
+        """
+        user = User(username="payer", password="password", email="payer@example.com", first_name="Pay",
+                    last_name="P", balance=5.0)
+        db.session.add(user)
+        db.session.commit()
+
+        first = self.client.post('/user/1/top-up', json={'amount': 10.0, 'idempotency_key': 'abc'})
+        retry = self.client.post('/user/1/top-up', json={'amount': 10.0, 'idempotency_key': 'abc'})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json['new_balance'], 15.0)
+        self.assertEqual(retry.json['transaction_id'], first.json['transaction_id'])
+        self.assertTrue(retry.json['replayed'])
+        self.assertEqual(db.session.get(User, 1).balance, 15.0)
+        self.assertEqual(Transaction.query.count(), 1)
+
+        response = self.client.post('/user/1/top-up', json={'amount': 20.0, 'idempotency_key': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/user/2/top-up', json={'amount': 20.0})
+        self.assertEqual(response.status_code, 404)
+
+    def test_top_up_failing_another_constraint_is_an_error(self):
+        """
+        Test that a top-up failing on a constraint other than its idempotency key is answered
+        with an error and leaves the balance alone.
+        """
+        from unittest import mock
+        from comms.methods import routes
+        import database.queries as queries
+
+        user = User(username="payer", password="password", email="payer@example.com", first_name="Pay",
+                    last_name="P", balance=5.0)
+        db.session.add(user)
+        db.session.commit()
+        queries.top_up(1, 1.0)
+
+        # Every new transaction takes the ID of the first one
+        with mock.patch.object(queries, "Transaction", side_effect=lambda **values: Transaction(id=1, **values)):
+            response = routes.run({"method": "UPDATE", "uri": "/top-up", "params": {"user_id": 1, "amount": 10.0}})
+
+        self.assertEqual(response, {"error": "Top-up could not be recorded"})
+        self.assertEqual(db.session.get(User, 1).balance, 6.0)
+
+    def test_google_geocoder_needs_an_api_key(self):
+        """
+        Test that Google is not asked for addresses without an API key.
+        """
+        from unittest import mock
+        import comms.geocoding as geocoding
+
+        with mock.patch.object(geocoding, "GOOGLE_API_KEY", None), \
+                mock.patch.object(geocoding.requests, "get") as get:
+            with self.assertRaises(RuntimeError):
+                geocoding.google_geocoder(51.5, -0.12)
+        get.assert_not_called()
+
+    def test_street_address_is_geocoded_once_per_spot(self):
+        """
+        Test that scooters parked at the same spot are geocoded once, also after a restart.
+        """
+        import os
+        import tempfile
+        from comms import helpers
+        from comms.geocoding import FakeGeocoder, GeocodeCache, geocode_cache
+
+        helpers.get_street_address(-37.81, 144.96)
+        helpers.get_street_address(-37.810001, 144.960001)
+        self.assertEqual(geocode_cache.geocoder.calls, 1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "geocodes.db")
+            geocoder = FakeGeocoder({(-37.81, 144.96): "1 Swanston St"})
+            first = GeocodeCache(geocoder, path=path)
+            self.assertEqual(first.address(-37.81, 144.96), "1 Swanston St")
+            first.connection.close()
+            restarted = GeocodeCache(geocoder, path=path)
+            self.assertEqual(restarted.address(-37.81, 144.96), "1 Swanston St")
+            self.assertEqual(geocoder.calls, 1)
+            restarted.connection.close()
+
+        lru = GeocodeCache(FakeGeocoder(), size=1)
+        lru.address(1, 1)
+        lru.address(2, 2)
+        lru.address(1, 1)
+        self.assertEqual(lru.geocoder.calls, 3)
+
+    def test_street_addresses_are_located_concurrently(self):
+        """
+        Test that a batch geocodes each spot once and returns what is located by the deadline.
+        """
+        import threading
+        from comms import helpers
+        from comms.geocoding import FakeGeocoder, geocode_cache
+
+        release = threading.Event()
+
+        class StuckGeocoder(FakeGeocoder):
+            def __call__(self, latitude, longitude):
+                if latitude == 0:
+                    release.wait(5)
+                return super().__call__(latitude, longitude)
+
+        geocode_cache.reset(StuckGeocoder())
+        addresses = helpers.get_street_addresses([(1, 1), (2, 2), (1, 1), (0, 0)], deadline=0.5)
+        calls = geocode_cache.geocoder.calls
+        release.set()
+
+        self.assertEqual(addresses[:3], ["1.0, 1.0 Fake Street", "2.0, 2.0 Fake Street", "1.0, 1.0 Fake Street"])
+        self.assertIsNone(addresses[3])
+        self.assertEqual(calls, 2)
+
+    def test_scooter_addresses_are_resolved_in_the_background(self):
+        """
+        Test that scooters get an address, refreshed only when they move far enough.
+        """
+        from web import addresses
+
+        scooter = Scooter(make="Xiaomi", longitude=144.96, latitude=-37.81, remaining_power=100.0, cost_per_time=1.0,
+                          status=ScooterStatus.AVAILABLE.value, colour="black")
+        db.session.add(scooter)
+        db.session.commit()
+        self.assertEqual(addresses.unaddressed_scooters(), [1])
+
+        self.assertEqual(addresses.enrich(addresses.unaddressed_scooters()), 1)
+        self.assertEqual(self.client.get('/scooter/id/1').json['address'], "-37.81, 144.96 Fake Street")
+
+        scooter.latitude = -37.8101  # About 11 m
+        db.session.commit()
+        self.assertEqual(addresses.enrich([1]), 0)
+        scooter.latitude = -37.82
+        db.session.commit()
+        self.assertEqual(addresses.enrich([1]), 1)
+        self.assertEqual(db.session.get(Scooter, 1).address, "-37.82, 144.96 Fake Street")
+
+    def test_get_pending_repairs_with_scooters(self):
+        """
+        Test that the pending repairs come with the position and details of their scooter.
+        """
+        scooter = Scooter(make="Xiaomi", longitude=144.96, latitude=-37.81, remaining_power=100.0, cost_per_time=1.0,
+                          status=ScooterStatus.AVAILABLE.value, colour="black")
+        db.session.add(scooter)
+        db.session.commit()
+        db.session.add_all([Repairs(scooter_id=1, report="Flat tyre", status=RepairStatus.PENDING.value),
+                            Repairs(scooter_id=1, report="Brakes", status=RepairStatus.COMPLETED.value)])
+        db.session.commit()
+
+        response = self.client.get('/repairs/pending/scooters')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['repairs']), 1)
+        self.assertEqual(response.json['repairs'][0]['report'], "Flat tyre")
+        self.assertEqual(response.json['repairs'][0]['latitude'], -37.81)
+        self.assertEqual(response.json['scooters'][0]['scooter_id'], 1)
+
+    def test_admin_report_scooter_in_one_transaction(self):
+        """
+        Test that confirming a repair report activates the repair and takes the scooter out of service.
+        """
+        scooter = Scooter(make="Xiaomi", longitude=144.96, latitude=-37.81, remaining_power=100.0, cost_per_time=1.0,
+                          status=ScooterStatus.AVAILABLE.value, colour="black")
+        db.session.add(scooter)
+        db.session.commit()
+        db.session.add(Repairs(scooter_id=1, report="Flat tyre", status=RepairStatus.PENDING.value))
+        db.session.commit()
+
+        self.assertEqual(len(self.client.get('/admin/repairs').json['repairs']), 1)
+        response = self.client.post('/admin/scooter/report', json={'repair_id': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(db.session.get(Repairs, 1).status, RepairStatus.ACTIVE.value)
+        self.assertEqual(db.session.get(Scooter, 1).status, ScooterStatus.AWAITING_REPAIR.value)
+        self.assertEqual(self.client.get('/admin/repairs').json['repairs'], [])
+        self.assertEqual(self.client.post('/admin/scooter/report', json={'repair_id': 2}).status_code, 404)
+
+    def test_check_booking_needs_an_active_booking(self):
+        """
+        Test that AACR /customer/bookings only unlocks for a customer with an active booking.
+        """
+        from comms.methods import routes
+
+        request = {"method": "GET", "uri": "/customer/bookings", "params": {"user_id": 1}}
+        booking = Booking(user_id=1, scooter_id=1, date=datetime(2023, 9, 29), start_time=datetime(2023, 9, 29, 12, 0),
+                          end_time=datetime(2023, 9, 29, 12, 30), status="completed", event_id=1)
+        db.session.add(booking)
+        db.session.commit()
+        self.assertEqual(routes.run(request), {'message': 'You don\'t have any bookings'})
+
+        booking.status = "active"
+        db.session.commit()
+        self.assertEqual(routes.run(request), {'message': 'Unlocking Scooter'})
+
+    def test_dashboard_scooters_reloaded_after_a_change(self):
+        """
+        Test that the shared list of available scooters is read again after a scooter changes,
+        but not after only its address is written.
+        """
+        from database.dashboard import available_scooters
+        from web import addresses
+
+        scooter = Scooter(make="Xiaomi", longitude=144.96, latitude=-37.81, remaining_power=100.0, cost_per_time=1.0,
+                          status=ScooterStatus.AVAILABLE.value, colour="black")
+        db.session.add(scooter)
+        db.session.commit()
+        available_scooters.invalidate()
+
+        scooters = available_scooters.get()
+        self.assertEqual(len(scooters), 1)
+        addresses.enrich([1])
+        self.assertIs(available_scooters.get(), scooters)
+
+        scooter.status = ScooterStatus.BOOKED.value
+        db.session.commit()
+        self.assertIsNot(available_scooters.get(), scooters)
+        self.assertEqual(available_scooters.get(), [])
+
+    def test_transactional_batch_keeps_work_before_a_handler_rollback(self):
+        """
+        Test that a handler rolling back its own changes inside a transactional batch does not
+        undo the requests before it.
+        """
+        from unittest import mock
+        from comms.batch import execute_batch
+        import database.queries as queries
+
+        user = User(username="payer", password="password", email="payer@example.com", first_name="Pay",
+                    last_name="P", balance=5.0)
+        db.session.add(user)
+        db.session.commit()
+        queries.top_up(1, 1.0, "k")
+
+        # The second top-up misses the replay of key "k" once, as if a concurrent attempt
+        # committed it meanwhile, so its insert fails and the handler rolls back
+        replayed_top_up = queries.replayed_top_up
+        misses = [None]
+        with mock.patch.object(queries, "replayed_top_up",
+                               side_effect=lambda *args: misses.pop() if misses else replayed_top_up(*args)):
+            response = execute_batch({
+                "method": "BATCH",
+                "transaction": True,
+                "requests": [
+                    {"method": "UPDATE", "uri": "/top-up", "params": {"user_id": 1, "amount": 10.0}},
+                    {"method": "UPDATE", "uri": "/top-up", "params": {"user_id": 1, "amount": 1.0,
+                                                                      "idempotency_key": "k"}}
+                ]
+            })
+
+        self.assertNotIn("error", response)
+        self.assertEqual(response["results"][0]["new_balance"], 16.0)
+        self.assertEqual(response["results"][1]["new_balance"], 16.0)
+        self.assertEqual(db.session.get(User, 1).balance, 16.0)
+        self.assertEqual(Transaction.query.count(), 2)
+
+    def test_single_transaction_reads_fresh_values(self):
+        """
+        Test that a commit in a single transaction expires the loaded rows, so a ride settled
+        after another write to the user returns the new balance.
+        """
+        from datetime import timedelta
+        from database.database_manager import single_transaction
+        import database.queries as queries
+
+        user = User(username="rider", password="password", email="rider@example.com", first_name="Ri",
+                    last_name="D", balance=50.0)
+        scooter = Scooter(make="Xiaomi", longitude=144.96, latitude=-37.81, remaining_power=100.0, cost_per_time=60.0,
+                          status=ScooterStatus.OCCUPYING.value, colour="black")
+        start = datetime.now() - timedelta(minutes=30)
+        booking = Booking(user_id=1, scooter_id=1, date=start, start_time=start, end_time=start, status="active",
+                          event_id=1)
+        db.session.add_all([user, scooter, booking])
+        db.session.commit()
+
+        with single_transaction() as session:
+            user = session.get(User, 1)
+            # Written past the loaded user, like another writer would
+            session.execute(db.text("UPDATE users SET balance = balance + 10"))
+            session.commit()
+            self.assertEqual(user.balance, 60.0)
+            ride = queries.settle_ride(1, 1, -37.81, 144.96)
+
+        self.assertAlmostEqual(ride["balance"], 60.0 - ride["cost"])
+        self.assertAlmostEqual(db.session.get(User, 1).balance, 60.0 - ride["cost"])
+
+    def test_metrics_report_the_server_load(self):
+        """
+        Test that the AACR and Prometheus metrics report the load of the AACR server of the app.
+        """
+        from comms.methods import routes
+        from comms.metrics import SERVER_APP_KEY
+        from comms.server import Server
+
+        server = Server(port=0, workers=3)
+        self.app.extensions[SERVER_APP_KEY] = server
+        try:
+            stats = routes.run({"method": "GET", "uri": "/metrics"})["server"]
+            self.assertEqual(stats["workers"], 3)
+            self.assertEqual(stats["queue_depth"], 0)
+            self.assertEqual(stats["active_workers"], 0)
+            self.assertEqual(stats["rejected"], 0)
+
+            text = self.client.get("/metrics").get_data(as_text=True)
+            self.assertIn("aacr_queue_depth 0", text)
+            self.assertIn("aacr_active_workers 0", text)
+            self.assertIn("aacr_connections_rejected_total 0", text)
+        finally:
+            server.server_socket.close()
+
+
+    def test_recent_writers_read_their_dashboard_from_the_primary(self):
+        """
+        Test that a customer who just wrote reads their dashboard from the primary, while the
+        other customers read theirs from a replica.
+        """
+        import tempfile
+        from unittest import mock
+        from sqlalchemy import create_engine
+        import database.database_manager as database_manager
+        import database.queries as queries
+
+        # A replica lagging behind: it has both customers, without any balance yet
+        replica = create_engine(f"sqlite:///{tempfile.mkdtemp()}/replica.db")
+        self.addCleanup(replica.dispose)
+        db.metadata.create_all(replica)
+        for engine in (db.engine, replica):
+            with engine.begin() as connection:
+                connection.execute(User.__table__.insert(), [
+                    {"id": user_id, "username": f"user{user_id}", "password": "password", "role": "customer",
+                     "email": f"user{user_id}@example.com", "first_name": "Test", "last_name": "User",
+                     "balance": 10.0 if engine is db.engine else 0.0}
+                    for user_id in (1, 2)
+                ])
+        db.engines["replica0"] = replica
+        self.addCleanup(db.engines.pop, "replica0")
+
+        with mock.patch.object(database_manager, "replica_binds", ["replica0"]), \
+                mock.patch.object(database_manager, "recent_writers", database_manager.RecentWriters()):
+            queries.top_up(1, 5.0)
+            db.session.remove()
+
+            self.assertEqual(self.client.get("/user/1/dashboard").json["user_details"]["balance"], 15.0)
+            self.assertEqual(self.client.get("/user/2/dashboard").json["user_details"]["balance"], 0.0)
+
+    def test_migrate_an_empty_database(self):
+        """
+        Test that migrating an empty database brings it to the latest version, that the boot
+        check then passes, and that it fails once a version is missing.
+        """
+        import tempfile
+        from flask import Flask
+        from database.migrations import SchemaOutOfDate, check_schema, latest_version, migrate, schema_version
+
+        app = Flask(__name__)
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tempfile.mkdtemp()}/master.db"
+        db.init_app(app)
+        with app.app_context():
+            self.addCleanup(db.engine.dispose)
+            self.assertEqual(migrate(), list(range(1, latest_version() + 1)))
+            self.assertEqual(migrate(), [])
+            check_schema()
+
+            with db.engine.begin() as connection:
+                connection.execute(schema_version.delete().where(schema_version.c.version == latest_version()))
+            with self.assertRaises(SchemaOutOfDate):
+                check_schema()
+
+    def test_drop_the_redundant_transaction_user_index(self):
+        """
+        Test that the migration dropping ix_transactions_user_id removes it from a database
+        that still has it, and leaves one without it alone.
+        """
+        from sqlalchemy import inspect
+        from database.migrations import drop_transaction_user_index
+
+        with db.engine.begin() as connection:
+            connection.execute(db.text("CREATE INDEX ix_transactions_user_id ON transactions (user_id)"))
+            drop_transaction_user_index(connection)
+            drop_transaction_user_index(connection)
+            names = {index["name"] for index in inspect(connection).get_indexes("transactions")}
+        self.assertNotIn("ix_transactions_user_id", names)
+        self.assertIn("ux_transactions_user_idempotency_key", names)
+
+    def test_add_not_null_column_with_a_server_default(self):
+        """
+        Test that a NOT NULL column added to a table with rows gets its server default.
+        """
+        from sqlalchemy import Column, Integer, MetaData, Table
+        from database.migrations import add_column
+
+        table = Table("wheels", MetaData(), Column("id", Integer, primary_key=True),
+                      Column("spokes", Integer, nullable=False, server_default="32"))
+        with db.engine.begin() as connection:
+            connection.execute(db.text("CREATE TABLE wheels (id INTEGER PRIMARY KEY)"))
+            connection.execute(db.text("INSERT INTO wheels (id) VALUES (1)"))
+            self.assertTrue(add_column(connection, table.c.spokes))
+            self.assertFalse(add_column(connection, table.c.spokes))
+            self.assertEqual(connection.execute(db.text("SELECT spokes FROM wheels")).scalar(), 32)
+
+
+class AACRClientTestCase(unittest.TestCase):
+    """
+    Test case for the AACR client of the public gateway.
+    """
+
+    def serve_then_drop(self):
+        """
+        Starts a server answering the first request of every connection, then dropping the
+        connection once the next request is read.
+
+        Returns:
+            (int, list): the port of the server and the requests it read.
+        """
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listener.close)
+        received = []
+
+        def serve():
+            while True:
+                connection, _ = listener.accept()
+                with connection:
+                    version, codec, data = read_message(connection)
+                    received.append(data)
+                    write_message(connection, version, encode({"ok": True}, codec), codec)
+                    received.append(read_message(connection)[2])
+
+        threading.Thread(target=serve, daemon=True).start()
+        return listener.getsockname()[1], received
+
+    def test_update_is_not_sent_again_after_the_connection_drops(self):
+        """
+        Test that a request the server may have run is not sent again on a new connection.
+        """
+        port, received = self.serve_then_drop()
+        client = Client(port=port, timeout=2)
+        client.send_message({"method": "UPDATE", "uri": "/top-up", "params": {}})
+
+        with self.assertRaises(ConnectionError):
+            client.send_message({"method": "UPDATE", "uri": "/top-up", "params": {}})
+        self.assertEqual(len(received), 2)
+
+    def test_get_is_sent_again_after_the_connection_drops(self):
+        """
+        Test that a GET lost with a reused connection is sent again on a new connection.
+        """
+        port, received = self.serve_then_drop()
+        client = Client(port=port, timeout=2)
+        client.send_message({"method": "GET", "uri": "/metrics"})
+
+        self.assertEqual(client.send_message({"method": "GET", "uri": "/metrics"}), {"ok": True})
+        self.assertEqual(len(received), 3)
+
+
+class AACRServerTestCase(unittest.TestCase):
+    """
+    Test case for the AACR servers, spoken to over sockets with the client of the public gateway.
+    """
+
+    def setUp(self):
+        """
+        Set up the app the servers run the requests in.
+        """
+        self.app = create_master_app(True)
+        self.app.config['TESTING'] = True
+        self.app.app_context().push()
+        db.create_all()
+
+    def start_server(self, **options):
+        """
+        Starts a threaded AACR server on a free port.
+
+        Returns:
+            (Server, int): the server and its port.
+        """
+        from comms.server import Server
+
+        # Runs until the tests exit, like the server of main.py
+        server = Server(port=0, **options)
+        threading.Thread(target=server.start_server, args=(self.app,), daemon=True).start()
+        return server, server.server_socket.getsockname()[1]
+
+    def test_v2_requests_share_one_connection(self):
+        """
+        Test that a v2 client sends its requests one frame after the other on the same connection.
+        """
+        server, port = self.start_server()
+        client = Client(port=port, timeout=2)
+        self.addCleanup(client.close)
+
+        self.assertIn("requests", client.send_message({"method": "GET", "uri": "/metrics"}))
+        connection = client.connection
+        self.assertEqual(client.send_message({"method": "GET", "uri": "/missing"})["errorCode"], "404")
+        self.assertIs(client.connection, connection)
+        self.assertEqual(server.stats()["accepted"], 1)
+
+    def test_v1_clients_are_still_served(self):
+        """
+        Test that a v1 client gets its JSON response and the connection closed, next to v2 clients.
+        """
+        server, port = self.start_server()
+        v2_client = Client(port=port, timeout=2)
+        self.addCleanup(v2_client.close)
+        v2_client.send_message({"method": "GET", "uri": "/metrics"})
+
+        v1_client = Client(port=port, version=1, timeout=2)
+        self.assertIn("requests", v1_client.send_message({"method": "GET", "uri": "/metrics"}))
+        self.assertEqual(v1_client.send_message({"method": "GET", "uri": "/missing"})["errorCode"], "404")
+        self.assertEqual(server.stats()["accepted"], 3)
+
+    def test_v1_request_arriving_in_pieces(self):
+        """
+        Test that a v1 request is answered once its JSON document is complete, not before, when
+        it arrives in pieces split inside strings and escapes.
+        """
+        _, port = self.start_server()
+        request = json.dumps({"method": "GET", "uri": "/metrics", "params": {"note": 'a "}" \\'}}).encode()
+        split = request.index(b'\\"}')
+        with socket.create_connection(("127.0.0.1", port), timeout=2) as connection:
+            for piece in (request[:split + 1], request[split + 1:split + 2], request[split + 2:]):
+                connection.sendall(piece)
+                time.sleep(0.05)
+            response = b"".join(iter(lambda: connection.recv(65536), b""))
+        self.assertEqual(json.loads(response)["errorCode"], "400")
+
+    def test_request_trickling_in_is_cut_off_at_the_deadline(self):
+        """
+        Test that a client sending its request a byte at a time gets a timeout error once
+        the request deadline passes, however often a byte arrives.
+        """
+        from unittest import mock
+
+        with mock.patch("comms.server.REQUEST_TIMEOUT", 0.5):
+            server, port = self.start_server(workers=1)
+            payload = json.dumps({"method": "GET", "uri": "/metrics"}).encode()
+            with socket.create_connection(("127.0.0.1", port), timeout=3) as connection:
+                frame = encode_frame(payload)
+
+                def trickle():
+                    try:
+                        for index in range(len(frame)):
+                            connection.sendall(frame[index:index + 1])
+                            time.sleep(0.1)
+                    except OSError:
+                        pass
+
+                threading.Thread(target=trickle, daemon=True).start()
+                start = time.monotonic()
+                version, _, response = read_message(connection)
+            self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(version, 2)
+        self.assertEqual(json.loads(response)["errorCode"], "400")
+        self.wait_for(lambda: server.stats()["active_workers"] == 0)
+
+    def test_frame_over_the_limit_is_answered_with_an_error(self):
+        """
+        Test that a v2 frame larger than the server accepts is answered with a framed 400 error.
+        """
+        _, port = self.start_server(buffer_size=16)
+        with socket.create_connection(("127.0.0.1", port), timeout=2) as connection:
+            connection.sendall(encode_frame(b"{" + b" " * 32 + b"}"))
+            version, _, payload = read_message(connection)
+        self.assertEqual(version, 2)
+        self.assertEqual(json.loads(payload)["errorCode"], "400")
+
+    def block_workers(self, server):
+        """
+        Holds every request served by a server until the returned event is set.
+        """
+        from unittest import mock
+
+        release = threading.Event()
+        self.addCleanup(release.set)
+        dispatch = server.dispatch
+        patcher = mock.patch.object(server, "dispatch",
+                                    side_effect=lambda *args: release.wait(5) and dispatch(*args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return release
+
+    def wait_for(self, condition, timeout=2):
+        "Waits until condition() is true, failing the test after timeout seconds."
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out waiting for the server")
+            time.sleep(0.01)
+
+    def test_idle_keepalive_connections_do_not_hold_workers(self):
+        """
+        Test that clients keeping idle connections open leave the workers to the other clients.
+        """
+        server, port = self.start_server(workers=2, queue_size=2)
+        pool = ClientPool(port=port, max_size=2, timeout=2)
+        self.addCleanup(pool.close)
+        first, second = pool.acquire(), pool.acquire()
+        first.send_message({"method": "GET", "uri": "/metrics"})
+        second.send_message({"method": "GET", "uri": "/metrics"})
+        pool.release(first)
+        pool.release(second)
+
+        v1_client = Client(port=port, version=1, timeout=2)
+        self.assertIn("requests", v1_client.send_message({"method": "GET", "uri": "/metrics"}))
+        self.wait_for(lambda: server.stats()["idle_connections"] == 2)
+        self.assertEqual(server.stats()["rejected"], 0)
+
+    def test_idle_connections_are_closed_after_the_keepalive_timeout(self):
+        """
+        Test that the server closes a v2 connection idle for longer than the keep-alive timeout.
+        """
+        server, port = self.start_server(keepalive_timeout=0.2)
+        client = Client(port=port, timeout=2)
+        self.addCleanup(client.close)
+        client.send_message({"method": "GET", "uri": "/metrics"})
+
+        self.wait_for(lambda: not client.is_alive())
+        self.assertEqual(server.stats()["idle_connections"], 0)
+        # The client opens a new connection for its next request
+        self.assertIn("requests", client.send_message({"method": "GET", "uri": "/metrics"}))
+
+    def test_busy_server_answers_503(self):
+        """
+        Test that requests arriving while the workers and the queue are full are answered
+        with a busy error in their AACR version, without waiting for a worker.
+        """
+        server, port = self.start_server(workers=1, queue_size=1)
+        release = self.block_workers(server)
+        responses = []
+        # One request held by the worker, then one waiting in the queue
+        for stat in ("active_workers", "queue_depth"):
+            client = Client(port=port, timeout=5)
+            threading.Thread(target=lambda client=client: responses.append(
+                client.send_message({"method": "GET", "uri": "/metrics"})), daemon=True).start()
+            self.wait_for(lambda: server.stats()[stat] == 1)
+
+        for version in (1, 2):
+            response = Client(port=port, version=version, timeout=2).send_message({"method": "GET", "uri": "/metrics"})
+            self.assertEqual(response["errorCode"], "503")
+        self.assertEqual(server.stats()["rejected"], 2)
+
+        release.set()
+        self.wait_for(lambda: len(responses) == 2)
+        self.assertTrue(all("requests" in response for response in responses))
+
+    def start_async_server(self, **options):
+        """
+        Starts an asyncio AACR server on a free port.
+
+        Returns:
+            (AsyncServer, int): the server and its port.
+        """
+        from comms.async_server import AsyncServer
+
+        server = AsyncServer(port=0, **options)
+        threading.Thread(target=server.start_server, args=(self.app,), daemon=True).start()
+        self.wait_for(lambda: server.server is not None and server.server.sockets)
+        return server, server.server.sockets[0].getsockname()[1]
+
+    def test_async_server_speaks_v1_and_v2(self):
+        """
+        Test that the asyncio server answers v2 requests on one connection and v1 requests.
+        """
+        server, port = self.start_async_server()
+        client = Client(port=port, timeout=2)
+        self.addCleanup(client.close)
+
+        self.assertIn("requests", client.send_message({"method": "GET", "uri": "/metrics"}))
+        self.assertEqual(client.send_message({"method": "GET", "uri": "/missing"})["errorCode"], "404")
+        v1_client = Client(port=port, version=1, timeout=2)
+        self.assertIn("requests", v1_client.send_message({"method": "GET", "uri": "/metrics"}))
+
+        stats = server.stats()
+        self.assertEqual(stats["accepted"], 2)
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["rejected"], 0)
+
+    def test_async_server_serves_more_connections_than_workers(self):
+        """
+        Test that the asyncio server serves pooled connections beyond its executor threads.
+        """
+        server, port = self.start_async_server(workers=2)
+        pool = ClientPool(port=port, max_size=6, timeout=5)
+        self.addCleanup(pool.close)
+        clients = [pool.acquire() for _ in range(6)]
+        for client in clients:
+            pool.release(client)
+
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(
+            pool.send_message({"method": "GET", "uri": "/metrics"}))) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(responses), 12)
+        self.assertTrue(all("requests" in response for response in responses))
+        self.assertEqual(server.stats()["open_connections"], 6)
+
+    @unittest.skipUnless(CODEC_MSGPACK in CODECS and CODEC_CBOR in CODECS, "needs the msgpack and cbor2 packages")
+    def test_binary_codecs_are_answered_in_kind(self):
+        """
+        Test that MessagePack and CBOR requests are answered with the codec of the request,
+        by both servers.
+        """
+        from comms.framing import HEADER
+
+        ports = [self.start_server()[1], self.start_async_server()[1]]
+        for port in ports:
+            for codec in ("msgpack", "cbor"):
+                client = Client(port=port, timeout=2, codec=codec)
+                self.addCleanup(client.close)
+                self.assertIn("requests", client.send_message({"method": "GET", "uri": "/metrics"}))
+                self.assertEqual(client.codec, CODEC_NAMES[codec])
+
+                # The response frame carries the codec of the request
+                with socket.create_connection(("127.0.0.1", port), timeout=2) as connection:
+                    message = {"method": "GET", "uri": "/missing"}
+                    connection.sendall(encode_frame(encode(message, CODEC_NAMES[codec]), CODEC_NAMES[codec]))
+                    header = connection.recv(HEADER.size, socket.MSG_WAITALL)
+                self.assertEqual(HEADER.unpack(header)[1], CODEC_NAMES[codec])
+
+    @unittest.skipUnless(CODEC_MSGPACK in CODECS, "needs the msgpack package")
+    def test_unsupported_codec_falls_back_to_json(self):
+        """
+        Test that a client whose codec the server cannot decode gets a 415 and speaks JSON from then on.
+        """
+        from unittest import mock
+        from comms.codecs import CODEC_JSON
+
+        ports = [self.start_server()[1], self.start_async_server()[1]]
+        # A master without the msgpack and cbor2 packages
+        with mock.patch.dict(CODECS, {CODEC_JSON: CODECS[CODEC_JSON]}, clear=True):
+            for port in ports:
+                client = Client(port=port, timeout=2, codec="msgpack")
+                self.addCleanup(client.close)
+                self.assertIn("requests", client.send_message({"method": "GET", "uri": "/metrics"}))
+                self.assertEqual(client.codec, CODEC_JSON)
+                self.assertEqual(client.send_message({"method": "GET", "uri": "/missing"})["errorCode"], "404")
+
+
+class PoolTestCase(unittest.TestCase):
+    """
+    Test case for the options and metrics of the database connection pool.
+    """
+
+    def test_engine_options_follow_the_environment(self):
+        """
+        Test that the pool is sized and bounded by the DB_* environment variables.
+        """
+        import importlib
+        from unittest import mock
+        import database.config as config
+        import database.pool as pool
+
+        settings = ("POOL_SIZE", "MAX_OVERFLOW", "POOL_TIMEOUT", "POOL_PRE_PING", "POOL_RECYCLE",
+                    "CONNECT_TIMEOUT", "STATEMENT_TIMEOUT")
+        with mock.patch.dict(os.environ, {"DB_POOL_SIZE": "3", "DB_MAX_OVERFLOW": "2", "DB_POOL_TIMEOUT": "0.5",
+                                          "DB_POOL_PRE_PING": "0", "DB_STATEMENT_TIMEOUT_MS": "2500"}):
+            importlib.reload(config)
+        self.addCleanup(importlib.reload, config)
+
+        with mock.patch.multiple(pool, **{name: getattr(config, name) for name in settings}):
+            options = pool.engine_options()
+        self.assertIs(options["poolclass"], pool.MeasuredQueuePool)
+        self.assertEqual((options["pool_size"], options["max_overflow"], options["pool_timeout"]), (3, 2, 0.5))
+        self.assertFalse(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"]["init_command"],
+                         "SET SESSION max_execution_time = 2500, SESSION innodb_lock_wait_timeout = 3")
+
+    def test_pool_metrics_count_checkouts_and_timeouts(self):
+        """
+        Test that a pool of one connection counts its checkouts, the connection it opens and
+        the checkout that times out waiting for it.
+        """
+        import sqlite3
+        from unittest import mock
+        from sqlalchemy import exc
+        import database.pool as pool
+
+        metrics = pool.PoolMetrics()
+        with mock.patch.object(pool, "pool_metrics", metrics):
+            queue = pool.MeasuredQueuePool(lambda: sqlite3.connect(":memory:", check_same_thread=False),
+                                           pool_size=1, max_overflow=0, timeout=0.2)
+            self.addCleanup(queue.dispose)
+            connection = queue.connect()
+            with self.assertRaises(exc.TimeoutError):
+                queue.connect()
+            connection.close()
+            queue.connect().close()
+
+        data = metrics.snapshot(queue)
+        self.assertEqual((data["checkouts"], data["timeouts"], data["connects"]), (2, 1, 1))
+        self.assertGreaterEqual(data["wait_seconds_max"], 0.2)
+        self.assertEqual(data["wait_histogram"]["0.5"], 1)
+        self.assertEqual((data["size"], data["checked_out"], data["idle"], data["overflow"]), (1, 0, 1, 0))
+        self.assertIn("db_pool_checkout_timeouts_total 1\n", metrics.prometheus(queue))
@@ -1,18 +1,34 @@
 from flask import Blueprint, request, jsonify
 from database.models import Transaction
-from database.database_manager import db
+from database.database_manager import db, replica_reads
+from web.database.exports import export_response
+from web.database.pagination import list_response
 
 transaction_api = Blueprint("transaction_api", __name__)
 
 @transaction_api.route("/transactions/all", methods=["GET"])
+@replica_reads
 def get_all():
     """
-    Get a list of all transactions.
+    Get a list of all transactions, or one page of them ordered by id.
 
     Returns:
-        JSON response with a list of transaction objects.
+        JSON response with a list of transaction objects, or a page of them.
     """
-    return [transaction.as_json() for transaction in Transaction.query.all()]
+    return list_response(Transaction.query, {"id": (Transaction.id,)})
+
+@transaction_api.route("/transactions/export", methods=["GET"])
+def export():
+    """
+    Stream transactions as NDJSON or CSV, optionally only those made in a date range.
+    See web.database.exports for the query args.
+
+    Returns:
+        Response: the transactions, ordered by creation time.
+    """
+    columns = [Transaction.id, Transaction.user_id, Transaction.amount, Transaction.created_at]
+    return export_response("transactions", columns, Transaction.created_at)
+
 @transaction_api.route("/transaction/<int:transaction_id>", methods=["GET"])
 def get(transaction_id):
     """
@@ -38,16 +54,7 @@ def post():
     Returns:
         JSON response with the newly created transaction object and a status code of 201.
     """
-    data = request.json
-    
-    new_transaction = Transaction(
-        user_id=data["user_id"],
-        amount=data["amount"]
-    )
-
-    db.session.add(new_transaction)
-    db.session.commit()
-    return new_transaction.as_json()
+    return TransactionAPI.create(request.json)
 
 @transaction_api.route("/transactions/user/<int:user_id>", methods=["GET"])
 def get_by_user(user_id):
@@ -65,6 +72,10 @@ def get_by_user(user_id):
 
 
 class TransactionAPI:
+    """
+    In-process access to transactions, shared by the blueprint routes and the AACR handlers.
+    """
+
     def create(transaction: dict):
         new_transaction = Transaction(
             user_id=transaction["user_id"],
@@ -1,22 +1,27 @@
 from flask import Blueprint, jsonify, request
 from database.models import User, UserType, Booking, Transaction
-from database.database_manager import db
+from database.database_manager import db, read_replica, replica_reads
+import database.queries as queries
+from database import dashboard
+from web.database.pagination import list_response
 
 users_api = Blueprint("db_user", __name__)
 
 
 @users_api.route("/users", methods=["GET"])
+@replica_reads
 def get_all():
     """
-    Get a list of all users.
+    Get a list of all users, or one page of them ordered by id.
 
     Returns:
-        JSON response with a list of user objects.
+        JSON response with a list of user objects, or a page of them.
     """
-    return [user.as_json() for user in User.query.all()]
+    return list_response(User.query, {"id": (User.id,)})
 
 
 @users_api.route("/user/role/<string:role>", methods=["GET"])
+@replica_reads
 def get_all_by_role(role):
     """
     Get a list of all users.
@@ -24,8 +29,7 @@ def get_all_by_role(role):
     Returns:
         JSON response with a list of user objects.
     """
-    users = User.query.filter_by(role=role).all()
-    return [user.as_json() for user in users]
+    return UserAPI.get_by_role(role)
 
 
 @users_api.route("/user/id/<int:user_id>", methods=["GET"])
@@ -40,9 +44,9 @@ def get(user_id):
         JSON response with the user object or a "User not found" message.
     """
 
-    user = User.query.get(user_id)
+    user = UserAPI.get_by_id(user_id)
     if user:
-        return user.as_json()
+        return user
     else:
         return jsonify({"message": "User not found"}), 404
 
@@ -56,30 +60,11 @@ def post():
         JSON response with the newly created user object and a status code of 201.
     """
     data = request.json
-    password = data["password"]
 
-    if not password:
+    if not data["password"]:
         return {"message": "Password is required"}
 
-    if "balance" in data:
-        balance = data["balance"]
-    else:
-        balance = 0.0
-
-    new_user = User(
-        username=data["username"],
-        password=password,
-        email=data["email"],
-        first_name=data["first_name"],
-        last_name=data["last_name"],
-        role=data["role"],
-        phone_number=data["phone_number"],
-        balance=balance
-    )
-
-    db.session.add(new_user)
-    db.session.commit()
-    return new_user.as_json()
+    return UserAPI.create(data)
 
 
 @users_api.route("/user/<int:user_id>", methods=["PUT"])
@@ -93,23 +78,69 @@ def update(user_id):
     Returns:
         JSON response with the updated user object or a "User not found" message.
     """
-    data = request.json
-    user = User.query.get(user_id)
+    user = UserAPI.update(user_id, request.json)
     if user:
+        return user
+    else:
+        return jsonify({"message": "User not found"}), 404
 
-        user.username = data["username"]
-        user.email = data["email"]
-        user.first_name = data["first_name"]
-        user.last_name = data["last_name"]
-        user.role = data["role"]
-        user.phone_number = data["phone_number"]
-        user.balance = data["balance"]
 
-        db.session.commit()
+@users_api.route("/user/<int:user_id>/dashboard", methods=["GET"])
+def get_dashboard(user_id):
+    """
+    Get the dashboard of a customer: the available scooters, their bookings and details.
 
-        return user.as_json()
-    else:
+    Args:
+        user_id (int): The ID of the customer.
+
+    Query args:
+        latitude, longitude (float, optional): only show the scooters near this position.
+        radius (float, optional): meters around the position.
+
+    Returns:
+        JSON response with the dashboard or a "User not found" message.
+    """
+    latitude = request.args.get("latitude", type=float)
+    longitude = request.args.get("longitude", type=float)
+    radius = request.args.get("radius", type=float)
+    try:
+        # From a replica, unless the customer just booked or topped up
+        with read_replica(user_id):
+            data = UserAPI.dashboard(user_id, latitude, longitude, radius)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    if data is None:
         return jsonify({"message": "User not found"}), 404
+    return data
+
+
+@users_api.route("/user/<int:user_id>/top-up", methods=["POST"])
+def top_up(user_id):
+    """
+    Add money to the balance of a user and record the transaction atomically.
+
+    Args:
+        user_id (int): The ID of the user to top up.
+
+    JSON body:
+        amount (float): The amount added.
+        idempotency_key (str, optional): the same for every retry of one top-up, also
+            accepted as the Idempotency-Key header.
+
+    Returns:
+        JSON response with the new balance and the transaction ID or an error message.
+    """
+    data = request.json or {}
+    amount = data.get("amount")
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+        return jsonify({"message": "Invalid amount provided"}), 400
+    idempotency_key = data.get("idempotency_key", request.headers.get("Idempotency-Key"))
+
+    try:
+        return UserAPI.top_up(user_id, amount, idempotency_key)
+    except ValueError as e:
+        status = 404 if str(e) == "User not found" else 400
+        return jsonify({"message": str(e)}), status
 
 
 @users_api.route("/user/<int:user_id>", methods=["DELETE"])
@@ -123,13 +154,9 @@ def delete(user_id):
     Returns:
         JSON response with the deleted user object or a "User not found" message.
     """
-    user = User.query.get(user_id)
+    user = UserAPI.delete(user_id)
     if user:
-        Booking.query.filter_by(user_id=user_id).delete()
-        Transaction.query.filter_by(user_id=user_id).delete()
-        db.session.delete(user)
-        db.session.commit()
-        return jsonify(user.as_json())
+        return jsonify(user)
     else:
         return jsonify({"message": "User not found"}), 404
 
@@ -142,32 +169,82 @@ def get_engineer_emails():
     Returns:
         JSON response with a list of email addresses.
     """
-    engineer_users = get_all_by_role(UserType.ENGINEER.value)
-    engineer_emails = [user["email"] for user in engineer_users]
-
-    return engineer_emails
+    return UserAPI.engineer_emails()
 
 
 @users_api.route("/user/email/<string:email>", methods=["GET"])
 def get_by_email(email):
-    user = User.query.filter_by(email=email).first()
+    user = UserAPI.get_by_email(email)
     if user:
-        return user.as_json()
+        return user
     else:
         return jsonify({"message": "User not found"}), 404
 
 
 class UserAPI:
+    """
+    In-process access to users, shared by the blueprint routes and the AACR handlers.
+    Every method returns plain JSON-ready dictionaries, or None when the user does not exist.
+    """
+
     def get_by_id(user_id: int):
+        user = db.session.get(User, user_id)
+        return user.as_json() if user else None
+
+    def get_by_email(email: str):
+        user = User.query.filter_by(email=email).first()
+        return user.as_json() if user else None
+
+    def get_by_role(role: str):
+        return [user.as_json() for user in User.query.filter_by(role=role)]
+
+    def engineer_emails():
+        return [email for email, in db.session.query(User.email).filter_by(role=UserType.ENGINEER.value)]
+
+    def create(data: dict):
+        new_user = User(
+            username=data["username"],
+            password=data["password"],
+            email=data["email"],
+            first_name=data["first_name"],
+            last_name=data["last_name"],
+            role=data["role"],
+            phone_number=data["phone_number"],
+            balance=data.get("balance", 0.0)
+        )
+
+        db.session.add(new_user)
+        db.session.commit()
+        return new_user.as_json()
+
+    def dashboard(user_id: int, latitude: float = None, longitude: float = None, radius: float = None):
+        return dashboard.customer_dashboard(user_id, latitude, longitude, radius)
+
+    def top_up(user_id: int, amount: float, idempotency_key: str = None):
+        return queries.top_up(user_id, amount, idempotency_key)
+
+    def update_details(user_id: int, first_name: str, last_name: str, phone_number: str):
+        user = db.session.get(User, user_id)
+        if user:
+            user.first_name = first_name
+            user.last_name = last_name
+            user.phone_number = phone_number
+            db.session.commit()
+            return user.as_json()
+        return None
 
-        user = User.query.get(user_id)
+    def delete(user_id: int):
+        user = db.session.get(User, user_id)
         if user:
+            Booking.query.filter_by(user_id=user_id).delete()
+            Transaction.query.filter_by(user_id=user_id).delete()
+            db.session.delete(user)
+            db.session.commit()
             return user.as_json()
-        else:
-            return jsonify({"message": "User not found"}), 404
+        return None
 
     def update(user_id: int, data: dict):
-        user = User.query.get(user_id)
+        user = db.session.get(User, user_id)
         if user:
 
             user.username = data["username"]
@@ -182,4 +259,4 @@ class UserAPI:
 
             return user.as_json()
         else:
-            return jsonify({"message": "User not found"}), 404
+            return None
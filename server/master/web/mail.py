@@ -1,8 +1,11 @@
+import logging
 from flask_mail import Mail, Message
 from flask import current_app, flash
 
 mail = Mail()
 
+logger = logging.getLogger(__name__)
+
 
 def init_mail(app):
     """
@@ -37,4 +40,4 @@ def send_email(subject, receipients, body):
 
             flash("Email sent successfully!", "success")
     except Exception as error:
-        print("Email sending failed:", str(error))
+        logger.error("Email sending failed: %s", error)
@@ -0,0 +1,28 @@
+"""
+Metrics Endpoint
+
+Serves the metrics and the load of the AACR server and of the database connection
+pool of this process in the Prometheus text exposition format, for a Prometheus server to scrape.
+"""
+from flask import Blueprint, Response
+from comms.metrics import metrics, server_prometheus, server_stats
+from database.database_manager import db
+from database.pool import pool_metrics
+
+metrics_api = Blueprint("metrics_api", __name__)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@metrics_api.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """
+    Get the AACR request metrics (counts, errors, latency quantiles and bytes, by method
+    and uri), the load of the AACR server (queue depth, active workers, connections
+    turned away) and the database pool metrics (checkout waits, timeouts and connections).
+
+    Returns:
+        Response: the metrics in the Prometheus text format.
+    """
+    return Response(metrics.prometheus() + server_prometheus(server_stats()) + pool_metrics.prometheus(db.engine.pool),
+                    content_type=PROMETHEUS_CONTENT_TYPE)
@@ -4,6 +4,10 @@ from blueprints.auth import auth
 from blueprints.admin import admin
 from blueprints.engineer import engineer
 from blueprints.customer import customer
+from common.log_config import setup_logging
+
+# Log from a background thread instead of the request threads
+setup_logging()
 
 app = Flask(__name__)
 
@@ -1,8 +1,11 @@
+import logging
 from flask import Blueprint, request, jsonify
 from blueprints.customer import send_message
 
 auth = Blueprint("auth", __name__)
 
+logger = logging.getLogger(__name__)
+
 def check_role(role):
     return role == "customer" or role == 'engineer' or role == 'admin'
 
@@ -24,7 +27,8 @@ def login():
 
     response = send_message(data)
 
-    print(response)
+    # Never log the response itself, it holds the user record
+    logger.info("Login %s", "succeeded" if "user" in response else "failed", extra={"sample": True})
 
     if "user" in response:
         if not check_role(response["user"]["role"]):
@@ -70,7 +74,7 @@ def signup():
 
     response = send_message(message)
 
-    print(response)
+    logger.info("Signup %s", "succeeded" if "user" in response else "failed", extra={"sample": True})
 
     if "user" in response:
         if not check_role(response["user"]["role"]):
@@ -1,13 +1,38 @@
 from datetime import datetime, date, timedelta
 from flask import Blueprint, request, jsonify
-from common.client import Client
+from common.client import ClientPool
+from common.socket_utils import AACR_HOST, AACR_PORT, AACR_POOL_SIZE, AACR_POOL_IDLE_TIMEOUT, AACR_TIMEOUT, AACR_CODEC
 
 customer = Blueprint("customer", __name__)
 
+# Persistent connections to the master, shared by every request of this process
+pool = ClientPool(host=AACR_HOST, port=AACR_PORT, max_size=AACR_POOL_SIZE,
+                  idle_timeout=AACR_POOL_IDLE_TIMEOUT, timeout=AACR_TIMEOUT, codec=AACR_CODEC)
 
-def send_message(message: dict):
-    client = Client(host='127.0.0.1', port=54321)
-    return client.send_message(message)
+
+def send_message(message: dict, timeout=None):
+    return pool.send_message(message, timeout=timeout)
+
+
+def send_batch(messages: list, transaction: bool = False, timeout=None):
+    """
+    Sends several requests to the master in one round trip.
+
+    Args:
+        messages (list): the requests, each with its method, uri and params.
+        transaction (bool, optional): run the requests in one database transaction,
+            stopping and rolling back at the first one that fails. Defaults to False.
+
+    Returns:
+        dict: {"results": [...]} in the order of the requests, or an error.
+    """
+    message = {
+        'method': 'BATCH',
+        'transaction': transaction,
+        'requests': messages
+    }
+
+    return send_message(message, timeout=timeout)
 
 
 @customer.route('/data/<int:user_id>')
@@ -20,11 +45,40 @@ def customer_data(user_id):
         }
     }
 
+    # With the position of the customer only the scooters around them are sent
+    latitude = request.args.get('latitude', type=float)
+    longitude = request.args.get('longitude', type=float)
+    radius = request.args.get('radius', type=float)
+    if latitude is not None and longitude is not None:
+        message['params'].update(latitude=latitude, longitude=longitude)
+        if radius is not None:
+            message['params']['radius'] = radius
+
     response = send_message(message)
 
     return jsonify(response)
 
 
+@customer.route('/scooters/near')
+def scooters_near():
+    latitude = request.args.get('latitude', type=float)
+    longitude = request.args.get('longitude', type=float)
+    if latitude is None or longitude is None:
+        return jsonify({'error': 'latitude and longitude are required'}), 400
+
+    params = {'latitude': latitude, 'longitude': longitude}
+    radius = request.args.get('radius', type=float)
+    k = request.args.get('k', type=int)
+    if radius is not None:
+        params['radius'] = radius
+    if k is not None:
+        params['k'] = k
+
+    response = send_message({'method': 'GET', 'uri': '/scooters/near', 'params': params})
+
+    return jsonify(response)
+
+
 @customer.route('/scooter/<int:scooter_id>')
 def scooter_data(scooter_id):
     message = {
@@ -139,36 +193,30 @@ def report_issue():
 
     data = request.get_json()
 
-    message = {
-        'method': 'UPDATE',
-        'uri': '/booking/cancel',
-        'params': {
-            'booking_id': data.get("booking_id")
-        }
-    }
-
-    response = send_message(message)
-
-    if "error" in response:
-        return jsonify(response), 400
-
-    message = {
-        'method': 'POST',
-        'uri': '/scooter/damaged',
-        'params': {
-            'scooter_id': data.get("scooter_id"),
-            'report': data.get("report")
+    # Cancel the booking and file the repair together, or not at all
+    response = send_batch([
+        {
+            'method': 'UPDATE',
+            'uri': '/booking/cancel',
+            'params': {
+                'booking_id': data.get("booking_id")
+            }
+        },
+        {
+            'method': 'POST',
+            'uri': '/scooter/damaged',
+            'params': {
+                'scooter_id': data.get("scooter_id"),
+                'report': data.get("report")
+            }
         }
-
-    }
-
-    response = send_message(message)
+    ], transaction=True)
 
     if "error" in response:
         return jsonify(response), 400
     else:
         # cal.remove(data.get("event_id"))
-        return jsonify(response), 200
+        return jsonify(response["results"][-1]), 200
 
 
 @customer.route('/top-up-balance', methods=["POST"])
@@ -191,6 +239,11 @@ def top_up_balance():
         }
     }
 
+    # Lets the client retry a top-up without paying twice
+    idempotency_key = data.get('idempotency_key', request.headers.get('Idempotency-Key'))
+    if idempotency_key:
+        message['params']['idempotency_key'] = str(idempotency_key)
+
     response = send_message(message)
 
     if "error" in response:
@@ -1,7 +1,13 @@
+import select
 import socket
 import json
+import threading
+import time
 
-VALID_METHODS = ['GET', 'POST', 'UPDATE', 'DELETE']
+from common.codecs import CODEC_JSON, codec_by_name, decode, encode
+from common.framing import encode_frame, read_frame
+
+VALID_METHODS = ['GET', 'POST', 'UPDATE', 'DELETE', 'BATCH']
 
 
 class Client:
@@ -13,28 +19,83 @@ class Client:
     The way to make a request is passing an object using the following structure:
     {"method": "GET", "uri": "/", "params": {"id": 1}}
 
+    With AACR v2 (the default) the connection is kept open and reused by the next
+    calls to send_message until close() is called. With v1 every message opens a
+    new connection, for masters that do not understand framed messages. A request
+    lost with a reused connection is only sent again when the server cannot have
+    run it, or when it is a GET.
+
+    v2 messages may use a binary codec (see common.codecs) instead of JSON. If the
+    server does not support it the client switches to JSON and sends again.
+
     Raises:
         ConnectionError: If the value returned by the server is wrong assumes its compromised.
         ValueError: If the passed message is not a valid JSON
     """
 
-    def __init__(self, host='127.0.0.1', port=5000) -> None:
+    def __init__(self, host='127.0.0.1', port=5000, version=2, timeout=None, codec='json') -> None:
         """
         Initializes the parameters of the server to be used for the connection
 
         Args:
             host (str, optional): The address of the server. Defaults to '127.0.0.1'.
             port (int, optional): The port to connect to the server. Defaults to 5000.
+            version (int, optional): The AACR version spoken with the server. Defaults to 2.
+            timeout (float, optional): Socket timeout in seconds, None to block. Defaults to None.
+            codec (str, optional): "json", "msgpack" or "cbor", v2 only. Defaults to 'json'.
+
+        Raises:
+            ValueError: If the codec is unknown or its package is not installed.
         """
         self.host = host
         self.port = port
+        self.version = version
+        self.timeout = timeout
+        self.codec = codec_by_name(codec) if version != 1 else CODEC_JSON
+        self.connection = None
+
+    def connect(self) -> socket.socket:
+        """
+        Opens the connection to the server if it is not open already.
+
+        Returns:
+            socket.socket: the connected socket.
+        """
+        if self.connection is None:
+            self.connection = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        return self.connection
+
+    def close(self) -> None:
+        """
+        Closes the connection to the server, if any.
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
-    def send_message(self, message: dict) -> dict:
+    def is_alive(self) -> bool:
+        """
+        Checks that the persistent connection can still be used. An idle connection
+        has nothing to read, so a readable socket means the server closed it.
+
+        Returns:
+            bool: True if the connection is open and idle.
+        """
+        if self.connection is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def send_message(self, message: dict, timeout=None) -> dict:
         """
         Sends a valid JSON object containing a valid AACR message.
 
         Args:
             message (dict): The message to be sent as JSON
+            timeout (float, optional): Socket timeout for this call only. Defaults to the client timeout.
 
         Raises:
             ValueError: If the message is not a valid AACR message
@@ -43,36 +104,130 @@ class Client:
         Returns:
             dict: The response from the server
         """
-        # If no method or no valid method (GET, POST, UPDATE or DELETE)
+        # If no method or no valid method (GET, POST, UPDATE, DELETE or BATCH)
         # is passed give error
 
         if "method" not in message or message["method"] not in VALID_METHODS:
             raise ValueError(f"A valid method ({VALID_METHODS}) must be passed.")
-        # Creates a socket
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Connect to the server
-        client_socket.connect((self.host, self.port))
-        # Send the message to the server
-        client_socket.send(json.dumps(message).encode())
-
-        # Recives the response from the server
-        buffer = b''
-        while True:
-            response = client_socket.recv(1024)
-            if not response:
-                break
-            buffer += response
 
-        # Parses the response into a JSON
-        res: dict
+        timeout = self.timeout if timeout is None else timeout
+        if self.version == 1:
+            return self._decode(self._send_v1(json.dumps(message).encode(), timeout), CODEC_JSON)
+
+        idempotent = message["method"] == "GET"
+        codec, buffer = self._send_v2_retry(encode(message, self.codec), timeout, idempotent)
+        response = self._decode(buffer, codec)
+        if self.codec != CODEC_JSON and codec == CODEC_JSON and isinstance(response, dict) \
+                and response.get("errorCode") == "415":
+            # The server cannot read our codec, speak JSON from now on
+            self.codec = CODEC_JSON
+            codec, buffer = self._send_v2_retry(encode(message, self.codec), timeout, idempotent)
+            response = self._decode(buffer, codec)
+        return response
+
+    def _decode(self, buffer: bytes, codec: int):
+        """
+        Parses a response from the server.
+        """
+        try:
+            return decode(buffer, codec)
+        except ValueError:
+            raise ConnectionError(f"Invalid response recived from server at {self.host} on port {self.port}")
+
+    def _send_v2_retry(self, payload: bytes, timeout, idempotent: bool = False):
+        """
+        Sends a v2 request, once more on a new connection if the reused one was dropped
+        and sending it again is safe.
+
+        Args:
+            payload (bytes): the encoded request.
+            timeout (float): socket timeout, None to block.
+            idempotent (bool, optional): whether running the request twice does no harm,
+                like a GET. Defaults to False.
+        """
+        if self.connection is not None and not self.is_alive():
+            # Closed by the server while idle, replace it before sending anything
+            self.close()
+        reused = self.connection is not None
+        lost = ConnectionError(f"Connection to server at {self.host} on port {self.port} lost")
+        try:
+            connection = self._write_v2(payload, timeout)
+        except (ConnectionResetError, BrokenPipeError):
+            self.close()
+            if not reused:
+                raise lost
+            # The frame did not go out whole, so the server cannot have run the request
+            return self._send_v2(payload, timeout)
+        try:
+            return self._read_v2(connection)
+        except (EOFError, ConnectionResetError):
+            self.close()
+            # The server may have run the request before the connection dropped,
+            # only one that is safe to run twice is sent again
+            if not (reused and idempotent):
+                raise lost
+            return self._send_v2(payload, timeout)
+
+    def _send_v2(self, payload: bytes, timeout):
+        """
+        Sends a framed request over the persistent connection and reads the framed response.
+
+        Returns:
+            (int, bytes): the codec and the payload of the response.
+        """
+        return self._read_v2(self._write_v2(payload, timeout))
+
+    def _write_v2(self, payload: bytes, timeout) -> socket.socket:
+        """
+        Sends a framed request over the persistent connection.
+
+        Returns:
+            socket.socket: the connection the response arrives on.
+        """
+        connection = self.connect()
+        connection.settimeout(timeout)
+        try:
+            connection.sendall(encode_frame(payload, self.codec))
+        except socket.timeout:
+            # The connection is in an unknown state once a request is stuck
+            self.close()
+            raise
+        return connection
+
+    def _read_v2(self, connection: socket.socket):
+        """
+        Reads the framed response of the last request.
+
+        Returns:
+            (int, bytes): the codec and the payload of the response.
+        """
+        try:
+            return read_frame(connection)
+        except socket.timeout:
+            # The connection is in an unknown state once a response is late
+            self.close()
+            raise
+
+    def _send_v1(self, payload: bytes, timeout) -> bytes:
+        """
+        Sends a request on a new connection and reads the response until the server closes it.
+        """
+        client_socket = socket.create_connection((self.host, self.port), timeout=timeout)
         try:
-            res = json.loads(buffer.decode())
-        except:
-            raise ConnectionError(f"Invalid JSON recived from server at {self.host} on port {self.port}")
+            # Send the message to the server
+            client_socket.sendall(payload)
 
+            # Recives the response from the server
+            buffer = b''
+            while True:
+                response = client_socket.recv(1024)
+                if not response:
+                    break
+                buffer += response
+            return buffer
+        finally:
             # Closes the connection to the server
-        client_socket.close()
-        return res
+            client_socket.close()
 
     def start_cli(self):
         """
@@ -97,4 +252,147 @@ class Client:
             except KeyboardInterrupt:
                 break
             except Exception as e:
-                print(f"[ERROR] f{e}")
\ No newline at end of file
+                print(f"[ERROR] f{e}")
+
+
+class ClientPool:
+    """
+    A thread-safe pool of persistent AACR v2 connections to the same server.
+
+    Connections are created on demand up to max_size, handed out to one caller at
+    a time and returned afterwards. Idle connections older than idle_timeout are
+    closed, and every connection is checked before it is handed out again so one
+    that the server dropped is replaced instead of failing the request.
+    """
+
+    def __init__(self, host='127.0.0.1', port=5000, max_size=8, idle_timeout=30.0, timeout=10.0,
+                 acquire_timeout=5.0, codec='json') -> None:
+        """
+        Args:
+            host (str, optional): The address of the server. Defaults to '127.0.0.1'.
+            port (int, optional): The port to connect to the server. Defaults to 5000.
+            max_size (int, optional): The most connections open at once. Defaults to 8.
+            idle_timeout (float, optional): Seconds an unused connection is kept. Defaults to 30.
+            timeout (float, optional): Default socket timeout of each call. Defaults to 10.
+            acquire_timeout (float, optional): Seconds to wait for a free connection. Defaults to 5.
+            codec (str, optional): "json", "msgpack" or "cbor". Defaults to 'json'.
+        """
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.codec = codec
+        # Fail now rather than on the first request if the codec cannot be used
+        codec_by_name(codec)
+
+        self.idle = []  # (client, last used) pairs, most recently used last
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> Client:
+        """
+        Takes a healthy connection from the pool, opening a new one if there is room.
+
+        Raises:
+            TimeoutError: If every connection stays busy for longer than acquire_timeout.
+
+        Returns:
+            Client: a client owned by the caller until it is released.
+        """
+        deadline = time.monotonic() + self.acquire_timeout
+        with self.condition:
+            while True:
+                self._evict_idle()
+                while self.idle:
+                    client, _ = self.idle.pop()
+                    if client.is_alive():
+                        return client
+                    self._discard(client)
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No free connection to {self.host}:{self.port} "
+                                       f"after {self.acquire_timeout} seconds")
+                self.condition.wait(remaining)
+
+        # Connect outside the lock so a slow handshake does not block the other callers
+        client = Client(self.host, self.port, timeout=self.timeout, codec=self.codec)
+        try:
+            client.connect()
+        except OSError:
+            with self.condition:
+                self._discard(client)
+            raise
+        return client
+
+    def release(self, client: Client, reuse: bool = True) -> None:
+        """
+        Gives a connection back to the pool.
+
+        Args:
+            client (Client): a client obtained from acquire.
+            reuse (bool, optional): False if the connection is in an unknown state. Defaults to True.
+        """
+        with self.condition:
+            if reuse and client.connection is not None:
+                self.idle.append((client, time.monotonic()))
+            else:
+                self._discard(client)
+            self.condition.notify()
+
+    def send_message(self, message: dict, timeout=None) -> dict:
+        """
+        Sends an AACR message over a pooled connection.
+
+        Args:
+            message (dict): The message to be sent as JSON
+            timeout (float, optional): Socket timeout for this call only. Defaults to the pool timeout.
+
+        Returns:
+            dict: The response from the server
+        """
+        client = self.acquire()
+        try:
+            response = client.send_message(message, timeout=timeout)
+        except BaseException:
+            self.release(client, reuse=False)
+            raise
+        self.release(client)
+        return response
+
+    def close(self) -> None:
+        """
+        Closes every idle connection. Connections in use are closed when released.
+        """
+        with self.condition:
+            while self.idle:
+                client, _ = self.idle.pop()
+                self._discard(client)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: the number of open, idle and busy connections.
+        """
+        with self.condition:
+            return {"open": self.size, "idle": len(self.idle), "busy": self.size - len(self.idle)}
+
+    def _evict_idle(self) -> None:
+        "Closes the connections that have not been used for longer than idle_timeout. Needs the lock."
+        expiry = time.monotonic() - self.idle_timeout
+        fresh = []
+        for client, last_used in self.idle:
+            if last_used < expiry:
+                self._discard(client)
+            else:
+                fresh.append((client, last_used))
+        self.idle = fresh
+
+    def _discard(self, client: Client) -> None:
+        "Closes a connection and frees its slot. Needs the lock."
+        client.close()
+        self.size -= 1
@@ -0,0 +1,68 @@
+"""
+AACR v2 Framing
+
+Every v2 message is a frame made of a 6 byte header followed by the payload. The
+header holds a marker byte (0xA2), a codec byte (see common.codecs) and the payload length
+as a 4 byte big-endian unsigned integer. Frames let a client send many requests
+over a single connection to the master.
+"""
+import socket
+import struct
+
+from common.codecs import CODEC_JSON
+
+FRAME_MARKER = 0xA2
+HEADER = struct.Struct(">BBI")
+MESSAGE_LIMIT = 30_000_000  # 30 MB
+CHUNK_SIZE = 65536
+
+
+def encode_frame(payload: bytes, codec: int = CODEC_JSON) -> bytes:
+    """
+    Builds a frame around the given payload.
+
+    Args:
+        payload (bytes): the encoded message.
+        codec (int, optional): the codec the payload is encoded with. Defaults to CODEC_JSON.
+
+    Returns:
+        bytes: the header followed by the payload.
+    """
+    return HEADER.pack(FRAME_MARKER, codec, len(payload)) + payload
+
+
+def recv_exact(client_socket: socket.socket, size: int) -> bytes:
+    """
+    Reads exactly size bytes from the socket.
+
+    Raises:
+        EOFError: If the connection is closed before all the bytes arrive.
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = client_socket.recv(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("Connection closed by the server")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(client_socket: socket.socket, limit: int = MESSAGE_LIMIT):
+    """
+    Reads one frame from the socket.
+
+    Raises:
+        ConnectionError: If the header is invalid or the payload is larger than the limit.
+        EOFError: If the connection is closed before the frame arrives.
+
+    Returns:
+        (int, bytes): the codec and the payload of the frame.
+    """
+    marker, codec, length = HEADER.unpack(recv_exact(client_socket, HEADER.size))
+    if marker != FRAME_MARKER:
+        raise ConnectionError("Invalid AACR frame received from the server")
+    if length > limit:
+        raise ConnectionError(f"AACR frame of {length} bytes exceeds the limit of {limit} bytes")
+    return codec, recv_exact(client_socket, length)
@@ -0,0 +1,152 @@
+"""
+Logging Configuration
+
+Sets up logging for the process so that log calls never write to stdout on the
+calling thread. Records go through a bounded queue to a single background thread,
+which writes them as one JSON object per line (or plain text).
+
+Per-request lines are marked with extra={"sample": True} and only a fraction of
+them (LOG_SAMPLE_RATE) is kept, so a busy server is not slowed down by its own
+logs. Warnings and errors are never sampled.
+
+Environment variables:
+    LOG_LEVEL: the lowest level logged. Defaults to INFO.
+    LOG_FORMAT: "json" or "text". Defaults to json.
+    LOG_SAMPLE_RATE: the fraction of per-request lines kept, 0 to 1. Defaults to 0.01.
+
+Each server process (master, public gateway, scooter) runs from its own directory
+and imports no shared package, so this module is copied into each of them, like
+common/socket_utils.py. Keep server/master/log_config.py, server/public/common/log_config.py
+and server/scooter/common/log_config.py the same.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+QUEUE_SIZE = 10_000  # Records waiting to be written before new ones are dropped
+
+# Attributes every LogRecord has, anything else was passed through extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single line JSON object, with the fields passed through extra=.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key != "sample":
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records marked with extra={"sample": True}.
+    """
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sample", False) and record.levelno < logging.WARNING:
+            return random.random() < self.rate
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that drops records instead of blocking when the queue is full.
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike QueueHandler.prepare the record is not formatted here: the writer
+        # thread formats it, and needs its extra fields to do so
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT, sample_rate: float = LOG_SAMPLE_RATE,
+                  stream=None) -> logging.handlers.QueueListener:
+    """
+    Routes every log record of the process through a queue to a background writer thread.
+    Calling it again returns the running listener.
+
+    Args:
+        level (str, optional): the lowest level logged. Defaults to LOG_LEVEL.
+        log_format (str, optional): "json" or "text". Defaults to LOG_FORMAT.
+        sample_rate (float, optional): fraction of per-request lines kept. Defaults to LOG_SAMPLE_RATE.
+        stream (file, optional): where the records are written. Defaults to stdout.
+
+    Returns:
+        QueueListener: the writer thread, stopped and flushed when the process exits.
+    """
+    global listener
+    if listener is not None:
+        return listener
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    if log_format == "json":
+        writer.setFormatter(JsonFormatter())
+    else:
+        writer.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SampleFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, writer)
+    listener.start()
+    atexit.register(stop_logging)
+    return listener
+
+
+def stop_logging() -> None:
+    """
+    Writes the records still queued and stops the writer thread.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
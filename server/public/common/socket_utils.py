@@ -8,3 +8,9 @@ PRIVATE_HOST = os.getenv('PRIVATE_HOST', '127.0.0.1')
 MASTER_PORT = int(os.getenv('MASTER_PORT', 5000))
 AGENT_PORT = int(os.getenv('AGENT_PORT', 5001))
 SOCKET_PORT = int(os.getenv('SOCKET_PORT', 63000))
+AACR_HOST = os.getenv('AACR_HOST', '127.0.0.1')
+AACR_PORT = int(os.getenv('AACR_PORT', 54321))
+AACR_POOL_SIZE = int(os.getenv('AACR_POOL_SIZE', 8))
+AACR_POOL_IDLE_TIMEOUT = float(os.getenv('AACR_POOL_IDLE_TIMEOUT', 30))
+AACR_TIMEOUT = float(os.getenv('AACR_TIMEOUT', 10))
+AACR_CODEC = os.getenv('AACR_CODEC', 'json')
@@ -1,7 +1,15 @@
+import logging
+
 from flask import Flask
 from gps3 import gps3
 from geopy.geocoders import Nominatim
 
+from common.log_config import setup_logging
+
+# Log from a background thread instead of the request threads
+setup_logging()
+logger = logging.getLogger(__name__)
+
 gps_socket = gps3.GPSDSocket()
 data_stream = gps3.DataStream()
 gps_socket.connect()
@@ -15,7 +23,9 @@ def hello_world():
     for new_data in gps_socket:
         if new_data:
             data_stream.unpack(new_data)
-            print(str(data_stream.TPV['time']) + " | " + str(data_stream.TPV['lat']) + " | " + str(data_stream.TPV['lon']) + " | " + str(data_stream.TPV['alt']))
+            logger.info("GPS fix", extra={"sample": True, "gps_time": data_stream.TPV['time'],
+                                          "lat": data_stream.TPV['lat'], "lon": data_stream.TPV['lon'],
+                                          "alt": data_stream.TPV['alt']})
     
     return "Hello, World!"
 
@@ -1,3 +1,4 @@
+import logging
 import socket
 import threading
 import json
@@ -8,10 +9,14 @@ from flask import jsonify
 from gps3 import gps3
 from time import time
 
+from common.log_config import setup_logging
+
 PORT = 5000
 HOST = '127.0.0.1'
 MESSAGE_LIMIT = 30_000_000  # 10 MB
 
+logger = logging.getLogger(__name__)
+
 
 class Scooter:
     """
@@ -39,7 +44,7 @@ class Scooter:
         self.data_stream = gps3.DataStream()
         self.gps_socket.connect()
         self.gps_socket.watch()
-        print("[INFO] Server started on {}:{}".format(self.host, self.port))
+        logger.info("Server started on %s:%s", self.host, self.port)
 
     def start_server(self) -> None:
         """
@@ -48,7 +53,7 @@ class Scooter:
         while True:
             # Accept any connection incomming
             client_socket, client_address = self.server_socket.accept()
-            print("[INFO] Connected to {}:{}".format(client_address[0], client_address[1]))
+            logger.info("Connected to %s:%s", client_address[0], client_address[1], extra={"sample": True})
             # Create a new thread to handle the client request
             client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
             client_thread.start()
@@ -68,9 +73,9 @@ class Scooter:
             except KeyboardInterrupt:
                 break
 
-        print("[INFO] Stopping the server...")
+        logger.info("Stopping the server...")
         server_thread.join()
-        print("[INFO] Server stopped.")
+        logger.info("Server stopped.")
 
     def handle_client(self, client_socket: socket.socket) -> None:
         """
@@ -117,7 +122,7 @@ class Scooter:
                 break
 
         client_socket.close()
-        print("[INFO] Disconnected from client, request succeded")
+        logger.info("Disconnected from client, request succeded", extra={"sample": True})
 
     def get_data(self, client_socket: socket.socket) -> bytes:
         """
@@ -143,7 +148,7 @@ class Scooter:
         """
         Gracefully closes the program
         """
-        print("[INFO] Closing server...")
+        logger.info("Closing server...")
         os._exit(0)
 
     def send_response(self, client_socket: socket.socket, response: dict) -> None:
@@ -188,5 +193,7 @@ class Scooter:
 
 
 if __name__ == '__main__':
+    # Log from a background thread, before the server starts logging
+    setup_logging()
     scooter = Scooter(host='192.168.1.108', port=12345)
     scooter.start_server()